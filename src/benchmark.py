@@ -0,0 +1,540 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Offline benchmarks of the parse/aggregate/validate pipeline
+
+The stage suite times each stage of a validation run and measures its peak memory, over
+recorded responses so that no network access is needed:
+
+    process_json_files  read the per-repertoire stats and facet query files
+    decode              stats API responses served from a replay-only response cache and parsed
+    get_total_count     ApiStats.get_total_count
+    get_sum_count       ApiStats.get_sum_count
+    facet_counts        facet count queries from the cache and their post-processing
+                        (validate_md_json_fields, bulk_facet_counts or gene_facet_counts)
+    compare             facet counts vs stats API totals, or gene by gene for gene_usage
+    write_csv           the SumCountTotalStat and FinalCount CSV writers
+
+Responses are recorded into the cache from stats_server.SyntheticRepository, for the repertoires
+of the sample query files (sample-files/JSON-Files) and at larger synthetic scales: 10k repertoires
+queried in batches, and gene_usage responses with many alleles per gene. Results can be saved as a
+baseline, and later runs flag stages that became slower or use more memory than the baseline.
+
+The legacy comparison (--legacy) times the row-by-row implementation that ApiStats used before it
+was vectorized against the current one.
+"""
+import argparse
+import contextlib
+import glob
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import pandas as pd
+
+import curlairripa
+import main as validation
+import response_cache
+import stats_server
+from main import ApiStats
+
+SAMPLE_FILES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "sample-files", "JSON-Files")
+SAMPLE_STATS_QUERIES = os.path.join(SAMPLE_FILES, "stats_query", "covid19-3")
+SAMPLE_FACET_QUERIES = os.path.join(SAMPLE_FILES, "facet_query", "covid19-3")
+
+# Base URL the recorded responses are stored under, never contacted
+OFFLINE_URL = "http://offline.benchmark"
+
+STAGES = ("process_json_files", "decode", "get_total_count", "get_sum_count", "facet_counts", "compare",
+          "write_csv")
+
+# Scenarios of the stage suite:
+#   repertoires: number of synthetic repertoires, None for those of the sample query files
+#   entry: stats API entry point
+#   batch_size: repertoires per stats API query
+#   bulk_facet: one facet count query for all repertoires instead of one per repertoire
+#   alleles: alleles per gene, sets the size of gene_usage responses
+SCENARIOS = {
+    "sample": {"repertoires": None, "entry": "junction_length", "batch_size": 1, "bulk_facet": False,
+               "alleles": 3},
+    "repertoires-10k": {"repertoires": 10000, "entry": "junction_length", "batch_size": 100, "bulk_facet": True,
+                        "alleles": 3},
+    "gene-usage-large": {"repertoires": 20, "entry": "gene_usage", "batch_size": 1, "bulk_facet": False,
+                         "alleles": 40},
+}
+
+
+def sample_repertoire_ids(query_dir=SAMPLE_STATS_QUERIES):
+    """
+    :param query_dir: directory with stats API JSON queries
+    :return: list of repertoire IDs found in the queries
+    """
+    rep_ids = []
+    for query_file in sorted(glob.glob(os.path.join(query_dir, "*.json"))):
+        query_dict = curlairripa.process_json_files(False, False, query_file)
+        rep_ids.extend(item['repertoire']['repertoire_id'] for item in query_dict['repertoires'])
+    return rep_ids
+
+
+def synthetic_stats_response(rep_ids, n_statistics, n_data, seed=0):
+    """
+    :param rep_ids: list of repertoire IDs, one Result entry each
+    :param n_statistics: int, number of statistics per repertoire
+    :param n_data: int, number of data items (key/count pairs) per statistic
+    :param seed: int, random seed
+    :return: JSON object shaped like a Stats API gene_usage response
+    """
+    rng = random.Random(seed)
+    result = []
+    for repertoire_id in rep_ids:
+        statistics = []
+        for i in range(n_statistics):
+            data = [{"key": "IGHV%d-%d*01" % (i, j), "count": rng.randint(0, 1000)} for j in range(n_data)]
+            total = sum(item['count'] for item in data)
+            # Make a few statistics disagree with their data
+            if rng.random() < 0.05:
+                total += 1
+            statistics.append({"statistic_name": "v_call_%d" % i, "total": total, "data": data})
+        result.append({"repertoires": {"repertoire_id": repertoire_id,
+                                       "sample_processing_id": None,
+                                       "data_processing_id": None},
+                       "statistics": statistics})
+    return {"Result": result}
+
+
+def legacy_get_total_count(data_json):
+    """
+    Reference implementation: one json_normalize and DataFrame per Result entry, then concat
+    """
+    all_df = []
+    ids_ = pd.json_normalize(data_json['Result'])
+
+    for entry in range(ids_.shape[0]):
+        df = pd.json_normalize(data_json['Result'][entry]['statistics'])
+
+        df['repertoire_id'] = ids_['repertoires.repertoire_id'].values[entry]
+        df['sample_processing_id'] = ids_['repertoires.sample_processing_id'].values[entry]
+        df['data_processing_id'] = ids_['repertoires.data_processing_id'].values[entry]
+
+        all_df.append(df)
+
+    return pd.concat(all_df, ignore_index=True)
+
+
+def legacy_get_sum_count(data_json, total_count_df):
+    """
+    Reference implementation: two json_normalize calls per statistic and cell by cell writes
+    """
+    statistics = [statistic for entry in data_json['Result'] for statistic in entry['statistics']]
+
+    for i in range(total_count_df.shape[0]):
+        reported_total = total_count_df.iloc[i, :]['total']
+        sub_data = pd.json_normalize(statistics[i])
+        if 'data' not in sub_data.columns:
+            total_count_df.loc[i, 'SumOfCounts(StatsAPI)'] = 0
+            total_count_df.loc[i, 'ResultSum'] = 0
+            continue
+        sub_data = pd.json_normalize(statistics[i]['data'])
+        if "count" in sub_data.columns:
+            sum_count = sub_data['count'].sum()
+            total_count_df.loc[i, 'SumOfCounts(StatsAPI)'] = int(sum_count)
+            total_count_df.loc[i, 'ResultSum'] = bool(reported_total == sum_count)
+        else:
+            total_count_df.loc[i, 'SumOfCounts(StatsAPI)'] = -1
+            total_count_df.loc[i, 'ResultSum'] = -1
+
+    return total_count_df
+
+
+def time_call(func, *args, repeat=3):
+    """
+    :return: (best wall time in seconds over repeat calls, result of the last call)
+    """
+    best = None
+    result = None
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - start_time
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def benchmark_sum_count(rep_ids, n_statistics, n_data, repeat=3):
+    """
+    Time the legacy and vectorized total/sum of count computations on one synthetic response
+
+    :return: dict with timings in seconds and whether both implementations agree
+    """
+    data_json = synthetic_stats_response(rep_ids, n_statistics, n_data)
+
+    def legacy():
+        return legacy_get_sum_count(data_json, legacy_get_total_count(data_json))
+
+    def vectorized():
+        api_stats = ApiStats(0, data_json, 0)
+        return api_stats.get_sum_count(api_stats.get_total_count())
+
+    legacy_time, legacy_df = time_call(legacy, repeat=repeat)
+    vectorized_time, vectorized_df = time_call(vectorized, repeat=repeat)
+
+    agree = (legacy_df['SumOfCounts(StatsAPI)'].astype(int).tolist() ==
+             vectorized_df['SumOfCounts(StatsAPI)'].astype(int).tolist() and
+             legacy_df['ResultSum'].tolist() == vectorized_df['ResultSum'].tolist())
+
+    return {"repertoires": len(rep_ids),
+            "statistics": len(rep_ids) * n_statistics,
+            "data_per_statistic": n_data,
+            "legacy_s": legacy_time,
+            "vectorized_s": vectorized_time,
+            "speedup": legacy_time / vectorized_time,
+            "agree": agree}
+
+
+def record_scenario(scenario, work_dir):
+    """
+    Write the query files of a scenario and record the responses of its queries in a replay-only
+    response cache
+
+    :param scenario: dict, one of SCENARIOS
+    :param work_dir: directory the query files and the cache are written to
+    :return: dict with the repository, the stats and facet query files and the cache
+    """
+    if scenario["repertoires"] is None:
+        rep_ids = sample_repertoire_ids()
+        stats_files = sorted(glob.glob(os.path.join(SAMPLE_STATS_QUERIES, "*.json")))
+        facet_files = sorted(glob.glob(os.path.join(SAMPLE_FACET_QUERIES, "*.json")))
+        relative_path_facet = os.path.join(SAMPLE_FACET_QUERIES, "facet_repertoire_id_")
+    else:
+        query_dir = os.path.join(work_dir, "queries")
+        rep_ids = stats_server.SyntheticRepository(scenario["repertoires"]).repertoire_ids
+        stats_server.write_query_files(query_dir, rep_ids)
+        stats_files = [os.path.join(query_dir, "stats_repertoire_id_" + i + ".json") for i in rep_ids]
+        facet_files = [os.path.join(query_dir, "facet_repertoire_id_" + i + ".json") for i in rep_ids]
+        relative_path_facet = os.path.join(query_dir, "facet_repertoire_id_")
+    repository = stats_server.SyntheticRepository(n_alleles=scenario["alleles"], mismatch_rate=0.05, rep_ids=rep_ids)
+
+    cache = response_cache.ResponseCache(os.path.join(work_dir, "cache"), "readwrite", max_bytes=None)
+    info = {"title": "Synthetic iReceptor node", "version": "1.0"}
+    stats_url = OFFLINE_URL + "/irplus/v1/stats/rearrangement/" + scenario["entry"]
+    facet_url = OFFLINE_URL + "/airr/v1/rearrangement"
+
+    # Stats API responses, one per batch of repertoires
+    batches = list(validation.batched(rep_ids, scenario["batch_size"]))
+    stats_queries = []
+    for batch in batches:
+        query_dict = validation.build_stats_query(batch)
+        result = [{"repertoires": {"repertoire_id": i, "sample_processing_id": None, "data_processing_id": None},
+                   "statistics": repository.statistics(i, scenario["entry"])} for i in batch]
+        cache.put(stats_url, query_dict, json.dumps({"Info": info, "Result": result}))
+        stats_queries.append(query_dict)
+
+    # Facet count responses, as queried by each facet_counts variant
+    if scenario["entry"] == "gene_usage":
+        fields = ["%s_%s" % (segment, level) for segment in stats_server.SEGMENTS for level in stats_server.LEVELS]
+        for repertoire_id in rep_ids:
+            for field in fields:
+                query_dict = {"filters": {"op": "=", "content": {"field": "repertoire_id", "value": repertoire_id}},
+                              "facets": field}
+                cache.put(facet_url, query_dict, json.dumps({"Info": info,
+                                                             "Facet": repository.facet(field, [repertoire_id])}))
+    elif scenario["bulk_facet"]:
+        query_dict = {"facets": "repertoire_id",
+                      "filters": {"op": "in", "content": {"field": "repertoire_id", "value": rep_ids}}}
+        cache.put(facet_url, query_dict, json.dumps({"Info": info, "Facet": repository.facet("repertoire_id",
+                                                                                             rep_ids)}))
+    else:
+        for facet_file in facet_files:
+            query_dict = curlairripa.process_json_files(False, False, facet_file)
+            repertoire_id = query_dict["filters"]["content"]["value"]
+            cache.put(facet_url, query_dict, json.dumps({"Info": info,
+                                                         "Facet": repository.facet("repertoire_id", [repertoire_id])}))
+
+    return {"rep_ids": rep_ids, "stats_files": stats_files, "facet_files": facet_files, "batches": batches,
+            "stats_queries": stats_queries, "stats_url": stats_url, "relative_path_facet": relative_path_facet,
+            "cache": response_cache.ResponseCache(os.path.join(work_dir, "cache"), "replay", max_bytes=None),
+            "output_dir": os.path.join(work_dir, "output", "")}
+
+
+def scenario_stages(scenario, recorded):
+    """
+    :param scenario: dict, one of SCENARIOS
+    :param recorded: dict returned by record_scenario
+    :return: list of (stage name, callable taking the previous stage's output and returning its own)
+    """
+    entry = scenario["entry"]
+    stats_name = "rearrangement_count" if entry == "count" else entry
+    rep_ids = recorded["rep_ids"]
+
+    def process_json_files(_):
+        return [curlairripa.process_json_files(False, False, path)
+                for path in recorded["stats_files"] + recorded["facet_files"]]
+
+    def decode(_):
+        return [validation.execute_query(recorded["stats_url"], query_dict)
+                for query_dict in recorded["stats_queries"]]
+
+    def get_total_count(responses):
+        api_stats = [ApiStats(0, response, 0) for response in responses]
+        return [(stats, stats.get_total_count()) for stats in api_stats]
+
+    def get_sum_count(total_counts):
+        return [stats.get_sum_count(total_count) for stats, total_count in total_counts]
+
+    def facet_counts(sum_counts):
+        if entry == "gene_usage":
+            facets = []
+            for sum_count in sum_counts:
+                repertoire_id = str(sum_count["repertoire_id"].iloc[0])
+                fields = list(sum_count["statistic_name"].map(validation.gene_usage_field).unique())
+                facets.append(validation.gene_facet_counts(OFFLINE_URL, repertoire_id, fields))
+        elif scenario["bulk_facet"]:
+            facets = validation.bulk_facet_counts(OFFLINE_URL, rep_ids)
+        else:
+            facets = [validation.validate_md_json_fields(OFFLINE_URL, path) for path in recorded["facet_files"]]
+        return sum_counts, facets
+
+    def compare(counts):
+        sum_counts, facets = counts
+        if entry == "gene_usage":
+            comparisons = [validation.compare_gene_usage(validation.gene_usage_counts(sum_count), facet)
+                           for sum_count, facet in zip(sum_counts, facets)]
+        elif scenario["bulk_facet"]:
+            totals = pd.concat([sum_count.loc[sum_count["statistic_name"] == stats_name,
+                                              ["statistic_name", "repertoire_id", "total"]]
+                                for sum_count in sum_counts])
+            comparisons = [validation.compare_facet_counts(rep_ids, totals, facets, stats_name)]
+        else:
+            comparisons = [validation.compare_repertoire_counts(sum_count, facet, repertoire_id, stats_name)
+                           for sum_count, facet, repertoire_id in zip(sum_counts, facets, rep_ids)]
+        return sum_counts, comparisons
+
+    def write_csv(results):
+        sum_counts, comparisons = results
+        output_dir = recorded["output_dir"]
+        os.makedirs(output_dir, exist_ok=True)
+        return [validation.write_results(validation.result_path_prefix(output_dir, "BENCHMARK", stats_name,
+                                                                       "SumCountTotalStat"), sum_counts),
+                validation.write_results(validation.result_path_prefix(output_dir, "BENCHMARK", stats_name,
+                                                                       "FinalCount"), comparisons)]
+
+    return [("process_json_files", process_json_files), ("decode", decode), ("get_total_count", get_total_count),
+            ("get_sum_count", get_sum_count), ("facet_counts", facet_counts), ("compare", compare),
+            ("write_csv", write_csv)]
+
+
+def run_stage(stage, stage_input, repeat=3, memory=True):
+    """
+    :param stage: callable taking stage_input
+    :param repeat: int, number of timed runs, the best is reported
+    :param memory: bool, if True one more run is made under tracemalloc to measure peak memory
+    :return: (seconds, peak bytes allocated during the stage or None, output of the stage)
+    """
+    # The pipeline prints as it goes, only the benchmark results are shown
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        seconds, output = time_call(stage, stage_input, repeat=repeat)
+        peak = None
+        if memory:
+            tracemalloc.start()
+            try:
+                stage(stage_input)
+                peak = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+    return seconds, peak, output
+
+
+def benchmark_scenario(name, repeat=3, memory=True):
+    """
+    Record the responses of a scenario and time each stage of the pipeline over them
+
+    :param name: key of SCENARIOS
+    :return: dict stage -> {"seconds": best wall time, "peak_bytes": peak memory or None}
+    """
+    scenario = SCENARIOS[name]
+    results = {}
+    previous_cache = response_cache.get_default_cache()
+    with tempfile.TemporaryDirectory(prefix="stats-benchmark-") as work_dir:
+        recorded = record_scenario(scenario, work_dir)
+        # Queries are answered by the recorded responses, never by the network
+        response_cache.set_default_cache(recorded["cache"])
+        try:
+            output = None
+            for stage_name, stage in scenario_stages(scenario, recorded):
+                seconds, peak, output = run_stage(stage, output, repeat, memory)
+                results[stage_name] = {"seconds": seconds, "peak_bytes": peak}
+        finally:
+            response_cache.set_default_cache(previous_cache)
+    return results
+
+
+def compare_to_baseline(results, baseline, time_tolerance=0.25, memory_tolerance=0.10, min_seconds=0.02,
+                        min_bytes=1 << 20):
+    """
+    :param results: dict scenario -> stage -> {"seconds", "peak_bytes"}, see benchmark_scenario
+    :param baseline: dict loaded from a baseline file, see save_baseline
+    :param time_tolerance: float, fraction by which a stage may be slower than the baseline
+    :param memory_tolerance: float, fraction by which the peak memory of a stage may exceed the baseline
+    :param min_seconds: float, slowdowns smaller than this are noise and never flagged
+    :param min_bytes: int, memory increases smaller than this are never flagged
+    :return: list of (scenario, stage, description) of regressions
+    """
+    regressions = []
+    for scenario, stages in results.items():
+        for stage, result in stages.items():
+            reference = baseline.get("scenarios", {}).get(scenario, {}).get(stage)
+            if reference is None:
+                continue
+            seconds, base_seconds = result["seconds"], reference["seconds"]
+            if seconds > base_seconds * (1 + time_tolerance) and seconds - base_seconds > min_seconds:
+                regressions.append((scenario, stage, "time %.4fs vs %.4fs baseline" % (seconds, base_seconds)))
+            peak, base_peak = result["peak_bytes"], reference.get("peak_bytes")
+            if peak is not None and base_peak is not None and peak > base_peak * (1 + memory_tolerance) and \
+                    peak - base_peak > min_bytes:
+                regressions.append((scenario, stage, "peak memory %.1f MiB vs %.1f MiB baseline"
+                                    % (peak / 2 ** 20, base_peak / 2 ** 20)))
+    return regressions
+
+
+def load_baseline(path):
+    """
+    :return: dict saved by save_baseline
+    """
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def save_baseline(path, results):
+    """
+    :param path: JSON file the baseline is written to
+    :param results: dict scenario -> stage -> {"seconds", "peak_bytes"}. Scenarios already in the
+                    file and not benchmarked this time are kept
+    """
+    baseline = load_baseline(path) if os.path.exists(path) else {"scenarios": {}}
+    baseline["scenarios"].update(results)
+    baseline.update({"created": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": platform.python_version(),
+                     "pandas": pd.__version__, "machine": platform.machine()})
+    with open(path, "w") as f:
+        json.dump(baseline, f, indent=2, sort_keys=True)
+
+
+def print_stage_results(name, stages, baseline=None):
+    """
+    Print the time and peak memory of each stage, and the change from the baseline if there is one
+    """
+    reference = (baseline or {}).get("scenarios", {}).get(name, {})
+    print(name)
+    print("  %-20s %12s %12s %12s" % ("stage", "seconds", "peak (MiB)", "vs baseline"))
+    for stage, result in stages.items():
+        peak = "-" if result["peak_bytes"] is None else "%.1f" % (result["peak_bytes"] / 2 ** 20)
+        change = "-"
+        if stage in reference and reference[stage]["seconds"] > 0:
+            change = "%+.0f%%" % (100 * (result["seconds"] / reference[stage]["seconds"] - 1))
+        print("  %-20s %12.4f %12s %12s" % (stage, result["seconds"], peak, change))
+
+
+def getArguments():
+    """
+    This function facilitates reading parameters
+
+    """
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description="Offline benchmarks of the stats API validation pipeline"
+    )
+    parser.add_argument(
+        "--scenarios",
+        nargs="+",
+        choices=sorted(SCENARIOS),
+        default=sorted(SCENARIOS),
+        help="Scenarios of the stage suite to run, default all")
+    parser.add_argument(
+        "--baseline",
+        default=None,
+        help="Baseline JSON file, stages slower or using more memory than it are flagged as regressions")
+    parser.add_argument(
+        "--save-baseline",
+        default=None,
+        help="Write the results to this baseline JSON file")
+    parser.add_argument(
+        "--time-tolerance",
+        type=float,
+        default=0.25,
+        help="Fraction by which a stage may be slower than the baseline before it is flagged")
+    parser.add_argument(
+        "--memory-tolerance",
+        type=float,
+        default=0.10,
+        help="Fraction by which the peak memory of a stage may exceed the baseline before it is flagged")
+    parser.add_argument(
+        "--no-memory",
+        action="store_true",
+        help="Do not measure peak memory, which takes one more run of each stage under tracemalloc")
+    parser.add_argument(
+        "--legacy",
+        action="store_true",
+        help="Instead of the stage suite, compare ApiStats against its legacy row-by-row implementation")
+    parser.add_argument(
+        "--statistics",
+        type=int,
+        nargs="+",
+        default=[10, 100, 500],
+        help="With --legacy, number of statistics per repertoire to benchmark")
+    parser.add_argument(
+        "--data",
+        type=int,
+        default=20,
+        help="With --legacy, number of data items per statistic")
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=3,
+        help="Number of timed runs, the best is reported")
+    return parser.parse_args()
+
+
+def legacy_main(options):
+    rep_ids = sample_repertoire_ids()
+    print("Repertoires from sample files:", len(rep_ids))
+
+    print("%12s %12s %12s %12s %10s %6s" % ("statistics", "data/stat", "legacy (s)", "vector (s)", "speedup", "agree"))
+    for n_statistics in options.statistics:
+        row = benchmark_sum_count(rep_ids, n_statistics, options.data, options.repeat)
+        print("%12d %12d %12.4f %12.4f %9.1fx %6s" % (row["statistics"], row["data_per_statistic"], row["legacy_s"],
+                                                     row["vectorized_s"], row["speedup"], row["agree"]))
+
+
+def main():
+    options = getArguments()
+    if options.legacy:
+        legacy_main(options)
+        return 0
+
+    baseline = load_baseline(options.baseline) if options.baseline else None
+    results = {}
+    for name in options.scenarios:
+        results[name] = benchmark_scenario(name, options.repeat, not options.no_memory)
+        print_stage_results(name, results[name], baseline)
+
+    if options.save_baseline:
+        save_baseline(options.save_baseline, results)
+        print("Baseline written to", options.save_baseline)
+
+    if baseline is not None:
+        regressions = compare_to_baseline(results, baseline, options.time_tolerance, options.memory_tolerance)
+        for scenario, stage, description in regressions:
+            print("REGRESSION:", scenario, stage, description)
+        if regressions:
+            return 1
+        print("No regression against", options.baseline)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
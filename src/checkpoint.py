@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+
+"""
+Per-repertoire checkpoints of a validation run
+
+Each repertoire's results are appended to a JSONL file as soon as they are available, one line
+per repertoire:
+
+    {"repertoire_id": ..., "status": "ok", "time": ..., "sum_count": {...}, "result": {...}}
+    {"repertoire_id": ..., "status": "failed", "time": ..., "reason": "..."}
+
+sum_count and result are dataframes in pandas' 'split' orientation. When a run is restarted with
+the same file, repertoires with an 'ok' line are skipped and only missing or failed ones are
+queried again. Later lines for a repertoire replace earlier ones. Only the status and file offset
+of each repertoire's last line are kept in memory, results are read back from the file on demand.
+"""
+import json
+import os
+import threading
+import time
+
+import pandas as pd
+
+
+def dataframe_to_json(df):
+    """
+    :param df: dataframe or None
+    :return: JSON object with the dataframe in 'split' orientation, None for None
+    """
+    if df is None:
+        return None
+    return json.loads(df.to_json(orient="split", index=False))
+
+
+def dataframe_from_json(json_df):
+    """
+    :param json_df: JSON object resulting from dataframe_to_json
+    :return: dataframe, None for None
+    """
+    if json_df is None:
+        return None
+    return pd.DataFrame(json_df["data"], columns=json_df["columns"])
+
+
+class Checkpoint:
+
+    def __init__(self, path):
+        """
+        :param path: JSONL checkpoint file, appended to. Existing entries are loaded
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        # Repertoire ID -> (status, offset of its last line in the file)
+        self._entries = {}
+        self._truncated = False
+        if os.path.exists(path):
+            self._load()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._file = open(path, "ab")
+        if self._truncated:
+            # Start the next line after the partial one
+            self._file.write(b"\n")
+
+    def _load(self):
+        with open(self.path, "rb") as f:
+            offset = 0
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Last line of a run that was killed while writing
+                    entry = None
+                if entry is not None:
+                    self._entries[entry["repertoire_id"]] = (entry["status"], offset)
+                offset += len(line)
+            self._truncated = offset > 0 and not line.endswith(b"\n")
+
+    def _append(self, entry):
+        line = (json.dumps(entry) + "\n").encode("utf-8")
+        with self._lock:
+            offset = self._file.seek(0, os.SEEK_END)
+            self._file.write(line)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._entries[entry["repertoire_id"]] = (entry["status"], offset)
+
+    def _read_entry(self, offset):
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            return json.loads(f.readline())
+
+    def done(self, repertoire_id):
+        """
+        :return: True if the repertoire already has results
+        """
+        entry = self._entries.get(str(repertoire_id))
+        return entry is not None and entry[0] == "ok"
+
+    def failed_ids(self):
+        """
+        :return: list of repertoire IDs whose last attempt failed
+        """
+        return [repertoire_id for repertoire_id, entry in self._entries.items() if entry[0] == "failed"]
+
+    def save(self, repertoire_id, sum_count_df, result_df):
+        """
+        :param repertoire_id: ID uniquely identifying repertoire
+        :param sum_count_df: dataframe with sum of count vs reported total results
+        :param result_df: dataframe with facet count vs reported total results, or None
+        :return: None
+        """
+        self._append({"repertoire_id": str(repertoire_id), "status": "ok", "time": time.time(),
+                      "sum_count": dataframe_to_json(sum_count_df),
+                      "result": dataframe_to_json(result_df)})
+
+    def mark_failed(self, repertoire_id, reason):
+        """
+        :param repertoire_id: ID uniquely identifying repertoire
+        :param reason: string describing the failure
+        :return: None
+        """
+        self._append({"repertoire_id": str(repertoire_id), "status": "failed", "time": time.time(),
+                      "reason": str(reason)})
+
+    def results(self, repertoire_id):
+        """
+        :return: [sum_count_df, result_df] of a repertoire with results, None otherwise
+        """
+        if not self.done(repertoire_id):
+            return None
+        entry = self._read_entry(self._entries[str(repertoire_id)][1])
+        return [dataframe_from_json(entry["sum_count"]), dataframe_from_json(entry["result"])]
+
+    def close(self):
+        with self._lock:
+            self._file.close()
@@ -0,0 +1,725 @@
+# -*- coding: utf-8 -*-
+
+"""
+Command line interface of the Stats API validation
+
+    python cli.py fetch BASE_URL ENTRY_POINT QUERY_FILE      one stats API (or ADC API) response, as JSON
+    python cli.py validate BASE_URL ENTRY_POINT ...         stats API vs facet count validation, see main.main
+    python cli.py report RESULTS_FILE [RESULTS_FILE ...]    pass/fail summary of results files
+    python cli.py load BASE_URL ADC_JSON_FILE               open-loop load test, see loadtest
+    python cli.py diff REFERENCE_URL CANDIDATE_URL ...      staging vs production comparison, see differential
+    python cli.py history DATABASE QUERY ...                results of past runs, see history
+
+Only the standard library and light local modules are imported to parse the command line. Each
+subcommand imports what it needs when it runs: fetch only needs the HTTP client and starts in tens
+of milliseconds, validate loads pandas and the rest of main, report loads pandas to read the
+results files. Exit status is 0 on success, 1 if a query failed or a report has failing rows, for
+use from cron and scripts.
+"""
+import argparse
+import sys
+import time
+
+import response_cache
+import result_writer
+
+# Where each API is served from, relative to the base URL
+API_PATHS = {"stats": "/irplus/v1/stats/", "adc": "/airr/v1/"}
+# Pass/fail column of results files, FinalCount and HistogramChecks use Result, SumCountTotalStat ResultSum
+RESULT_COLUMNS = ("Result", "ResultSum")
+
+
+def add_validate_arguments(parser):
+    """
+    :param parser: argparse parser the options of main.main() are added to, see main_options
+    """
+    # URL associated with API
+    parser.add_argument(
+        "base_url",
+        help="HTTP address associated with stats API"
+    )
+
+    # Entry point, options include:
+    # /rearrangement/junction_length
+    # /rearrangement/gene_usage
+    # /rearrangement/count
+    parser.add_argument(
+        "entry_point",
+        help="Options: string 'rearragement' or string 'repertoire'"
+    )
+
+    # JSON files containing query
+    parser.add_argument(
+        "stats_json_files",
+        help="Enter full path to JSON queries"
+    )
+
+    # JSON files containing query
+    parser.add_argument(
+        "adc_json_files",
+        help="Enter full path to ADC API JSON queries"
+    )
+
+    # Stats API YAML schema
+    parser.add_argument(
+        "yaml_file",
+        help="Enter full path to YAML schema"
+    )
+
+    # Stats API YAML schema
+    parser.add_argument(
+        "validator_arr",
+        help="Comma-separated list of words, each of which is an element from the list 'headers', 'rows', 'objects'"
+    )
+
+    # Directory where results will be saved
+    parser.add_argument(
+        "details_dir",
+        help="Enter full path to JSON queries"
+    )
+
+    # JSON files containing facet count queries
+    parser.add_argument(
+        "--facet-json-files",
+        default=None,
+        help="Path prefix of the facet count JSON queries, one file per repertoire")
+
+    # Number of repertoires queried at the same time
+    parser.add_argument(
+        "--max-workers",
+        type=int,
+        default=1,
+        help="Number of repertoires queried concurrently. Default 1 (serial)")
+
+    # Bulk facet count
+    parser.add_argument(
+        "--bulk-facet",
+        action="store_true",
+        help="Fetch facet counts for all repertoires in a single query")
+
+    # Stats API batch size
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=1,
+        help="Number of repertoires packed into each stats API query. Default 1")
+
+    # Streaming stats API responses
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Parse stats API responses incrementally, keeping memory bounded")
+
+    # Response cache
+    parser.add_argument(
+        "--cache-dir",
+        default=None,
+        help="Directory of the on-disk response cache. Disabled by default")
+    parser.add_argument(
+        "--cache-mode",
+        choices=response_cache.MODES,
+        default="readwrite",
+        help="readwrite (default), record (always query), replay (never touch the network) or off")
+    parser.add_argument(
+        "--cache-max-bytes",
+        type=int,
+        default=1 << 30,
+        help="Size above which least recently used cached responses are evicted. Default 1 GiB")
+    parser.add_argument(
+        "--cache-ttl",
+        type=float,
+        default=None,
+        help="Seconds after which a cached response is no longer served. Default no expiry")
+
+    # Query timings
+    parser.add_argument(
+        "--timings-file",
+        default=None,
+        help="JSONL file where the phase timings of every query are appended")
+
+    # Checkpoint
+    parser.add_argument(
+        "--checkpoint-file",
+        default=None,
+        help="JSONL file where each repertoire's results are saved; re-running resumes from it")
+    # Results files
+    parser.add_argument(
+        "--repository-name",
+        default="COVID19-3",
+        help="Prefix of the results files")
+    parser.add_argument(
+        "--output-format",
+        choices=result_writer.FORMATS,
+        default="csv",
+        help="Format of the results files; parquet and arrow require pyarrow")
+    parser.add_argument(
+        "--compression",
+        default=None,
+        help="'gzip' for csv output, Parquet codec (snappy, zstd, gzip, ...) for parquet output")
+    # Adaptive rate limit and retries
+    parser.add_argument(
+        "--query-delay",
+        type=float,
+        default=1,
+        help="Seconds between queries to start with, the rate then adapts to how the API responds")
+    parser.add_argument(
+        "--max-rate",
+        type=float,
+        default=20.0,
+        help="Highest number of queries per second sent to the API")
+    parser.add_argument(
+        "--max-retries",
+        type=int,
+        default=4,
+        help="Retries of a query failing with 429, 502, 503, 504, a timeout or a connection error")
+    # Deadlines and hedged requests
+    parser.add_argument(
+        "--connect-timeout",
+        type=float,
+        default=10.0,
+        help="Seconds allowed to open a connection to the API")
+    parser.add_argument(
+        "--read-timeout",
+        type=float,
+        default=300.0,
+        help="Seconds allowed for each wait for data from the API, timed out queries are retried")
+    parser.add_argument(
+        "--hedge",
+        action="store_true",
+        help="Send a duplicate of queries slower than the --hedge-quantile latency, use the first response")
+    parser.add_argument(
+        "--hedge-quantile",
+        type=float,
+        default=0.95,
+        help="Latency quantile of an endpoint after which its queries are hedged")
+    # Results kept across runs
+    parser.add_argument(
+        "--history-db",
+        default=None,
+        help="SQLite database the results and latencies of the run are added to, see the history command")
+    # Profiling
+    parser.add_argument(
+        "--profile-dir",
+        default=None,
+        help="Directory where CPU (cProfile) and memory (tracemalloc) profiles of each stage of the run are "
+             "written")
+    parser.add_argument(
+        "--profile-sample-rate",
+        type=float,
+        default=0.05,
+        help="Fraction of the calls of each stage profiled with cProfile, default 0.05")
+    parser.add_argument(
+        "--profile-memory-rate",
+        type=float,
+        default=0.01,
+        help="Fraction of the calls of each stage traced with tracemalloc, default 0.01")
+    # Repertoire enumeration
+    parser.add_argument(
+        "--page-size",
+        type=int,
+        default=1000,
+        help="Number of repertoire IDs requested per ADC API repertoire query")
+    # Junction length distribution checks
+    parser.add_argument(
+        "--histogram-checks",
+        action="store_true",
+        help="For junction_length, check the distributions of all repertoires at once")
+    parser.add_argument(
+        "--histogram-facets",
+        action="store_true",
+        help="With --histogram-checks, compare every length against facet counts")
+    parser.add_argument(
+        "--max-junction-length",
+        type=int,
+        default=400,
+        help="Longest valid junction length for --histogram-checks")
+
+    # Verbosity flag
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        action="store_true",
+        help="Run the program in verbose mode.")
+
+
+def add_fetch_arguments(parser):
+    """
+    :param parser: argparse parser the options of fetch are added to
+    """
+    parser.add_argument(
+        "base_url",
+        help="HTTP address associated with the API")
+    parser.add_argument(
+        "entry_point",
+        help="Entry point, e.g. rearrangement/count for the stats API or repertoire for the ADC API")
+    parser.add_argument(
+        "query_file",
+        help="JSON file with the query")
+    parser.add_argument(
+        "--api",
+        choices=sorted(API_PATHS),
+        default="stats",
+        help="API the entry point belongs to, default stats")
+    parser.add_argument(
+        "-o",
+        "--output",
+        default=None,
+        help="File the response is written to, default standard output")
+    parser.add_argument(
+        "--connect-timeout",
+        type=float,
+        default=10.0,
+        help="Seconds allowed to open a connection to the API")
+    parser.add_argument(
+        "--read-timeout",
+        type=float,
+        default=300.0,
+        help="Seconds allowed for each wait for data from the API")
+    parser.add_argument(
+        "--max-retries",
+        type=int,
+        default=4,
+        help="Retries of a query failing with 429, 502, 503, 504, a timeout or a connection error")
+
+
+def add_report_arguments(parser):
+    """
+    :param parser: argparse parser the options of report are added to
+    """
+    parser.add_argument(
+        "results_files",
+        nargs="+",
+        help="Results files written by validate (csv, csv.gz, parquet or arrows)")
+    parser.add_argument(
+        "--failures",
+        action="store_true",
+        help="Also print the failing rows of each file")
+
+
+def add_load_arguments(parser):
+    """
+    :param parser: argparse parser the options of the load test are added to, see loadtest.main
+    """
+    parser.add_argument(
+        "base_url",
+        help="HTTP address associated with the API")
+    parser.add_argument(
+        "adc_json_files",
+        help="JSON file with the ADC API repertoire query the repertoire IDs are enumerated with")
+    parser.add_argument(
+        "--stats-json-files",
+        default=None,
+        help="Path prefix of the per-repertoire stats API query files, as for validate. "
+             "Repertoires without a file are queried by repertoire_id")
+    parser.add_argument(
+        "--facet-json-files",
+        default=None,
+        help="Path prefix of the per-repertoire facet count query files, as for validate")
+    parser.add_argument(
+        "--repertoire-ids",
+        default=None,
+        type=lambda value: [i for i in value.split(",") if i],
+        help="Comma-separated repertoire IDs to query instead of enumerating them from the ADC API")
+    parser.add_argument(
+        "--max-repertoires",
+        type=int,
+        default=None,
+        help="Only query the first repertoires enumerated")
+    parser.add_argument(
+        "--page-size",
+        type=int,
+        default=1000,
+        help="Number of repertoire IDs requested per ADC API repertoire query")
+    parser.add_argument(
+        "--mix",
+        default="count=1,junction_length=1,gene_usage=1,facet=1",
+        help="Comma-separated query kinds and their weights, kinds are count, junction_length, gene_usage "
+             "and facet")
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=10.0,
+        help="Target queries per second over all kinds, sent whether or not earlier queries have answered")
+    parser.add_argument(
+        "--duration",
+        type=float,
+        default=60.0,
+        help="Seconds of the measured run")
+    parser.add_argument(
+        "--warmup",
+        type=float,
+        default=5.0,
+        help="Seconds of load sent before the measured run, not recorded")
+    parser.add_argument(
+        "--poisson",
+        action="store_true",
+        help="Send queries as a Poisson process instead of evenly spaced")
+    parser.add_argument(
+        "--max-in-flight",
+        type=int,
+        default=256,
+        help="Maximum number of queries in flight, later queries wait and the wait counts in their latency")
+    parser.add_argument(
+        "--connect-timeout",
+        type=float,
+        default=10.0,
+        help="Seconds allowed to open a connection to the API")
+    parser.add_argument(
+        "--read-timeout",
+        type=float,
+        default=60.0,
+        help="Seconds allowed for each wait for data, slower queries count as errors")
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="Random seed of the query mix and arrivals")
+    parser.add_argument(
+        "-o",
+        "--output",
+        default=None,
+        help="JSON file the results and latency histograms are written to")
+
+
+def add_diff_arguments(parser):
+    """
+    :param parser: argparse parser the options of differential.differential() are added to
+    """
+    parser.add_argument(
+        "reference_url",
+        help="HTTP address of the reference server, e.g. production")
+    parser.add_argument(
+        "candidate_url",
+        help="HTTP address of the candidate server, e.g. staging")
+    parser.add_argument(
+        "entry_point",
+        help="Stats API entry point, e.g. rearrangement/junction_length")
+    parser.add_argument(
+        "adc_json_files",
+        help="JSON file with the ADC API repertoire query, run on both servers")
+    parser.add_argument(
+        "details_dir",
+        help="Directory where the results are saved")
+    parser.add_argument(
+        "--stats-json-files",
+        default=None,
+        help="Path prefix of the per-repertoire stats API query files. "
+             "Repertoires without a file are queried by repertoire_id")
+    parser.add_argument(
+        "--repository-name",
+        default="COVID19-3",
+        help="Prefix of the results files")
+    parser.add_argument(
+        "--max-workers",
+        type=int,
+        default=1,
+        help="Number of repertoires compared concurrently, each on both servers at once")
+    parser.add_argument(
+        "--page-size",
+        type=int,
+        default=1000,
+        help="Number of repertoire IDs requested per ADC API repertoire query")
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Parse stats API responses incrementally as they are downloaded")
+    parser.add_argument(
+        "--output-format",
+        choices=result_writer.FORMATS,
+        default="csv",
+        help="Format of the results files")
+    parser.add_argument(
+        "--compression",
+        default=None,
+        help="Compression of the results files, gzip for csv or a Parquet codec")
+    parser.add_argument(
+        "--timings-file",
+        default=None,
+        help="JSONL file where the phase timings of every query are appended")
+    parser.add_argument(
+        "--time-tolerance",
+        type=float,
+        default=0.1,
+        help="Relative slowdown of the candidate's median or p95 latency tolerated, default 0.1")
+    parser.add_argument(
+        "--alpha",
+        type=float,
+        default=0.01,
+        help="P-value of the rank test below which a latency difference counts, default 0.01")
+    parser.add_argument(
+        "--query-delay",
+        type=float,
+        default=0,
+        help="Seconds between queries to start with, 0 to start at the maximum rate")
+    parser.add_argument(
+        "--max-rate",
+        type=float,
+        default=20.0,
+        help="Highest number of queries per second, over both servers")
+    parser.add_argument(
+        "--max-retries",
+        type=int,
+        default=4,
+        help="Retries of a query failing with 429, 502, 503, 504, a timeout or a connection error")
+    parser.add_argument(
+        "--connect-timeout",
+        type=float,
+        default=10.0,
+        help="Seconds allowed to open a connection to the API")
+    parser.add_argument(
+        "--read-timeout",
+        type=float,
+        default=300.0,
+        help="Seconds allowed for each wait for data from the API")
+
+
+def add_history_arguments(parser):
+    """
+    :param parser: argparse parser the history queries are added to, one subcommand each
+    """
+    parser.add_argument(
+        "database",
+        help="SQLite history database, see validate --history-db")
+    queries = parser.add_subparsers(dest="query", metavar="query")
+    queries.required = True
+
+    runs = queries.add_parser("runs", help="Most recent runs and their number of failures")
+    runs.add_argument("--repository", default=None, help="Only runs of this repository")
+    runs.add_argument("--limit", type=int, default=20, help="Number of runs, default 20")
+
+    repertoire = queries.add_parser("repertoire", help="Facet count results of a repertoire in every run, and "
+                                                       "the run since which it has been failing")
+    repertoire.add_argument("repository", help="Repository name")
+    repertoire.add_argument("repertoire_id", help="Repertoire ID")
+    repertoire.add_argument("--statistic", default=None, help="Only this statistic, e.g. junction_length")
+    repertoire.add_argument("--key", default=None,
+                            help="Run since which only this key of the statistic, e.g. a gene, has been failing")
+
+    regressions = queries.add_parser("regressions", help="Results that passed in the previous run and fail now")
+    regressions.add_argument("repository", help="Repository name")
+    regressions.add_argument("--run", type=int, default=None, help="Run checked, default the latest one")
+    regressions.add_argument("--previous-run", type=int, default=None,
+                             help="Run compared against, default the previous run of the same statistic")
+
+    trend = queries.add_parser("trend", help="Latency percentiles of endpoints over the most recent runs")
+    trend.add_argument("repository", help="Repository name")
+    trend.add_argument("--endpoint", default=None, help="Only this endpoint, e.g. /airr/v1/rearrangement")
+    trend.add_argument("--phase", default="total", help="Query phase, default total")
+    trend.add_argument("--limit", type=int, default=100, help="Number of rows, default 100")
+
+    imported = queries.add_parser("import", help="Add a run from results files written without --history-db")
+    imported.add_argument("repository", help="Repository name")
+    imported.add_argument("statistic", help="Statistic of the files, e.g. junction_length")
+    imported.add_argument("--sum-count", default=None, help="SumCountTotalStat results file")
+    imported.add_argument("--final-count", default=None, help="FinalCount results file")
+    imported.add_argument("--failed", default=None, help="FailedRepertoires results file")
+    imported.add_argument("--base-url", default=None, help="HTTP address of the repository")
+
+
+def getArguments(argv=None):
+    """
+    This function facilitates reading parameters
+
+    :param argv: list of command line arguments, default sys.argv[1:]
+    """
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description=__doc__
+    )
+    subparsers = parser.add_subparsers(dest="command", metavar="command")
+    subparsers.required = True
+    add_fetch_arguments(subparsers.add_parser(
+        "fetch", help="Perform one query and print its JSON response"))
+    add_validate_arguments(subparsers.add_parser(
+        "validate", help="Validate the stats API against facet counts"))
+    add_report_arguments(subparsers.add_parser(
+        "report", help="Summarize results files"))
+    add_load_arguments(subparsers.add_parser(
+        "load", help="Open-loop load test of the stats API and facet count endpoints"))
+    add_diff_arguments(subparsers.add_parser(
+        "diff", help="Compare the results and latencies of two servers"))
+    add_history_arguments(subparsers.add_parser(
+        "history", help="Query the results of past runs"))
+    return parser.parse_args(argv)
+
+
+def main_options(options):
+    """
+    :param options: parsed validate options, see add_validate_arguments
+    :return: dict with the main.main() keyword arguments
+    """
+    kwargs = {"base_url": options.base_url,
+              "entry_pt": options.entry_point,
+              "validator_arr": options.validator_arr,
+              "details_dir": options.details_dir,
+              "adc_json_files": options.adc_json_files,
+              "relative_path_stats": options.stats_json_files,
+              "yaml_file": options.yaml_file}
+    if options.facet_json_files is not None:
+        kwargs["relative_path_facet"] = options.facet_json_files
+    for name in ("max_workers", "bulk_facet", "batch_size", "stream", "cache_dir", "cache_mode", "cache_max_bytes",
+                 "cache_ttl", "timings_file", "checkpoint_file", "repository_name", "output_format", "compression",
+                 "query_delay", "max_rate", "max_retries", "connect_timeout", "read_timeout", "hedge",
+                 "hedge_quantile", "history_db", "profile_dir", "profile_sample_rate", "profile_memory_rate",
+                 "page_size", "histogram_checks", "histogram_facets", "max_junction_length"):
+        kwargs[name] = getattr(options, name)
+    return kwargs
+
+
+def fetch(options):
+    """
+    Perform one query and write its response as it was received
+
+    :param options: parsed fetch options, see add_fetch_arguments
+    :return: exit status
+    """
+    import curlairripa
+    import ratelimit
+
+    query_url = options.base_url.rstrip("/") + API_PATHS[options.api] + options.entry_point.lstrip("/")
+    query_dict = curlairripa.process_json_files(True, False, options.query_file)
+    client = curlairripa.HTTPClient(connect_timeout=options.connect_timeout, read_timeout=options.read_timeout)
+    try:
+        response = ratelimit.call(
+            lambda: curlairripa.processQuery(query_url, client.header_dict, True, query_dict, client=client,
+                                             raise_errors=True),
+            query_url, policy=ratelimit.RetryPolicy(options.max_retries))
+    except Exception as e:
+        print("ERROR: Query to", query_url, "failed:", repr(e), file=sys.stderr)
+        return 1
+    finally:
+        client.close()
+
+    if options.output is None:
+        sys.stdout.write(response + "\n")
+    else:
+        with open(options.output, "w") as f:
+            f.write(response)
+    return 0
+
+
+def validate(options):
+    """
+    :param options: parsed validate options, see add_validate_arguments
+    :return: exit status, 1 if some repertoires failed
+    """
+    import main
+
+    paths = main.main(**main_options(options))
+    return 1 if paths.get("failed_repertoires") else 0
+
+
+def report(options):
+    """
+    Print the number of rows of each results file, and how many pass, for files with a pass/fail column
+
+    :param options: parsed report options, see add_report_arguments
+    :return: exit status, 1 if a file has failing rows or could not be read
+    """
+    status = 0
+    for path in options.results_files:
+        try:
+            df = result_writer.read_results(path)
+        except Exception as e:
+            print("%s: could not be read: %r" % (path, e))
+            status = 1
+            continue
+
+        result_columns = [column for column in RESULT_COLUMNS if column in df.columns]
+        if not result_columns:
+            # Schema violations or failed repertoires, every row is a failure
+            failing = df
+            print("%s: %d rows" % (path, len(df)))
+        else:
+            passed = df[result_columns[0]].astype(str).str.lower() == "true"
+            failing = df[~passed]
+            print("%s: %d rows, %d pass, %d fail" % (path, len(df), passed.sum(), len(failing)))
+        if len(failing):
+            status = 1
+            if options.failures:
+                print(failing.to_string())
+    return status
+
+
+def load(options):
+    """
+    :param options: parsed load options, see add_load_arguments
+    :return: exit status, 1 if some queries failed
+    """
+    import loadtest
+
+    return loadtest.main(options)
+
+
+def diff(options):
+    """
+    :param options: parsed diff options, see add_diff_arguments
+    :return: exit status, 1 if the servers disagree on a statistic or the candidate is slower
+    """
+    import differential
+
+    result = differential.differential(
+        options.reference_url, options.candidate_url, options.entry_point, options.adc_json_files,
+        options.stats_json_files, options.details_dir, options.repository_name, options.max_workers,
+        options.page_size, options.stream, options.output_format, options.compression, options.timings_file,
+        options.time_tolerance, options.alpha, options.query_delay, options.max_rate, options.max_retries,
+        options.connect_timeout, options.read_timeout)
+    return 1 if result["mismatches"] or result["slower"] else 0
+
+
+def history(options):
+    """
+    :param options: parsed history options, see add_history_arguments
+    :return: exit status, 1 if a repertoire is failing or a run has regressions
+    """
+    import history as history_store
+
+    store = history_store.HistoryStore(options.database)
+    status = 0
+    try:
+        if options.query == "runs":
+            print(store.runs(options.repository, options.limit).to_string(index=False))
+        elif options.query == "repertoire":
+            print(store.repertoire_history(options.repository, options.repertoire_id,
+                                           options.statistic).to_string(index=False))
+            statistics = [options.statistic] if options.statistic is not None else \
+                list(store.repertoire_history(options.repository, options.repertoire_id)["statistic_name"].unique())
+            for statistic in statistics:
+                run = store.failing_since(options.repository, options.repertoire_id, statistic, options.key)
+                if run is not None:
+                    status = 1
+                    label = statistic if options.key is None else statistic + " " + options.key
+                    print("%s failing since run %d (%s)" % (label, run["run_id"],
+                                                           time.strftime("%Y-%m-%d %H:%M:%S",
+                                                                         time.localtime(run["started"]))))
+        elif options.query == "regressions":
+            run_id = options.run if options.run is not None else store.latest_run(options.repository)
+            if run_id is None:
+                print("No finished run of", options.repository)
+                return 1
+            regressions = store.regressions(run_id, options.previous_run)
+            print(len(regressions), "regression(s) in run", run_id)
+            if len(regressions):
+                status = 1
+                print(regressions.to_string(index=False))
+        elif options.query == "trend":
+            print(store.endpoint_trend(options.repository, options.endpoint, options.phase,
+                                       options.limit).to_string(index=False))
+        elif options.query == "import":
+            run_id = history_store.import_results(store, options.repository, options.statistic, options.sum_count,
+                                                  options.final_count, options.failed, options.base_url)
+            print("Imported run", run_id)
+    finally:
+        store.close()
+    return status
+
+
+def main(argv=None):
+    options = getArguments(argv)
+    commands = {"fetch": fetch, "validate": validate, "report": report, "load": load, "diff": diff,
+                "history": history}
+    return commands[options.command](options)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -6,20 +6,386 @@
 
 import urllib.request
 import urllib.parse
+import urllib.error
+import contextlib
+import http.client
+import io
 import json
 import os
 import ssl
+import threading
 import time
+import zlib
+
+# Brotli is optional, responses are only requested brotli compressed when
+# it is installed
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 
 #############################################################################
 #################### ADC-API (File) Performance Testing #####################
 #############################################################################
 
-def processQuery(query_url, header_dict, expect_pass, query_dict={}, verbose=False, force=False):
+# Default deadlines of every query in seconds, so that a stalled server fails
+# the query (and lets it be retried) instead of blocking its thread forever.
+# The read deadline applies to each wait for data, not to the whole response.
+DEFAULT_CONNECT_TIMEOUT = 10.0
+DEFAULT_READ_TIMEOUT = 300.0
+
+
+class HTTPResponse:
+    # Fully read response returned by HTTPClient.post(). Mirrors the parts of
+    # the urllib response that processQuery() relies on.
+    def __init__(self, url, status, reason, headers, body):
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+
+    def read(self):
+        return self.body
+
+
+class HTTPClient:
+    # Reusable HTTP client. It keeps a pool of keep-alive connections per
+    # host so that consecutive queries against the same node do not pay for
+    # a new TCP connection and TLS handshake, and it sets up the SSL context
+    # and the request headers only once. The client is thread safe: each
+    # connection is checked out of the pool by one thread at a time.
+    # connect_timeout and read_timeout are in seconds, None waits forever.
+    # read_timeout applies to every wait for data once connected: for the
+    # response headers and for each read of the body.
+
+    # Number of redirects followed before giving up
+    MAX_REDIRECTS = 5
+
+    def __init__(self, header_dict=None, max_idle_connections=10, ssl_context=None,
+                 connect_timeout=DEFAULT_CONNECT_TIMEOUT, read_timeout=DEFAULT_READ_TIMEOUT):
+        # Headers sent with every request unless the caller provides its own
+        if header_dict is None:
+            header_dict = getHeaderDict()
+        self.header_dict = header_dict
+        # Maximum number of idle connections kept per host
+        self.max_idle_connections = max_idle_connections
+        if ssl_context is None:
+            ssl_context = getSSLContext()
+        self.ssl_context = ssl_context
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        # (scheme, host, port) -> list of idle connections
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    def _newConnection(self, scheme, host, port):
+        if scheme == 'https':
+            return http.client.HTTPSConnection(host, port, timeout=self.connect_timeout,
+                                               context=self.ssl_context)
+        return http.client.HTTPConnection(host, port, timeout=self.connect_timeout)
+
+    def _getConnection(self, key):
+        # Reuse an idle connection if there is one, otherwise open a new one.
+        # Returns the connection and whether it was reused.
+        with self._lock:
+            pool = self._pools.get(key)
+            if pool:
+                return pool.pop(), True
+        return self._newConnection(*key), False
+
+    def _releaseConnection(self, key, connection):
+        with self._lock:
+            pool = self._pools.setdefault(key, [])
+            if len(pool) < self.max_idle_connections:
+                pool.append(connection)
+                return
+        connection.close()
+
+    def _splitURL(self, query_url):
+        parsed = urllib.parse.urlsplit(query_url)
+        if parsed.scheme not in ('http', 'https'):
+            raise urllib.error.URLError('unsupported URL scheme ' + repr(parsed.scheme))
+        port = parsed.port
+        if port is None:
+            port = 443 if parsed.scheme == 'https' else 80
+        path = parsed.path or '/'
+        if parsed.query:
+            path = path + '?' + parsed.query
+        return (parsed.scheme, parsed.hostname, port), path
+
+    def _send(self, key, path, body, header_dict, timing):
+        # Send one request and wait for the response headers, retrying once on
+        # a fresh connection if a reused keep-alive connection turns out to
+        # have been closed by the server.
+        while True:
+            connection, reused = self._getConnection(key)
+            try:
+                # Connect explicitly so that TCP/TLS set up is timed on its own
+                if connection.sock is None:
+                    start_time = time.perf_counter()
+                    connection.connect()
+                    addTiming(timing, 'connect', time.perf_counter() - start_time)
+                    connection.sock.settimeout(self.read_timeout)
+                start_time = time.perf_counter()
+                connection.request('POST', path, body, header_dict)
+                response = connection.getresponse()
+                addTiming(timing, 'ttfb', time.perf_counter() - start_time)
+            except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+                connection.close()
+                if reused:
+                    continue
+                raise
+            except Exception:
+                connection.close()
+                raise
+            return connection, response
+
+    def _finish(self, key, connection, response):
+        # Return the connection to the pool if its response was read to the
+        # end and the server keeps it alive, otherwise close it.
+        if response.isclosed() and not response.will_close:
+            self._releaseConnection(key, connection)
+        else:
+            connection.close()
+
+    def _read(self, key, connection, response, timing=None):
+        start_time = time.perf_counter()
+        try:
+            data = response.read()
+        except (OSError, http.client.HTTPException) as e:
+            connection.close()
+            raise urllib.error.URLError(e)
+        addTiming(timing, 'transfer', time.perf_counter() - start_time)
+        self._finish(key, connection, response)
+        return data
+
+    def _open(self, query_url, body, header_dict, timing=None):
+        # Send the request, following redirects, and return the connection
+        # and the response with its body still unread. HTTP errors are raised
+        # as urllib.error.HTTPError and connection errors as
+        # urllib.error.URLError, like urllib.request.urlopen() does. Phase
+        # times are added to the timing dict if one is given.
+        if header_dict is None:
+            header_dict = self.header_dict
+
+        for _ in range(self.MAX_REDIRECTS + 1):
+            key, path = self._splitURL(query_url)
+            try:
+                connection, response = self._send(key, path, body, header_dict, timing)
+            except (OSError, http.client.HTTPException) as e:
+                raise urllib.error.URLError(e)
+
+            location = response.getheader('Location')
+            if response.status in (301, 302, 303, 307, 308) and location:
+                self._read(key, connection, response, timing)
+                query_url = urllib.parse.urljoin(query_url, location)
+                continue
+            if response.status >= 400:
+                data = self._read(key, connection, response, timing)
+                raise urllib.error.HTTPError(query_url, response.status, response.reason,
+                                             response.headers, io.BytesIO(data))
+            return key, connection, response, query_url
+
+        raise urllib.error.URLError('too many redirects for ' + query_url)
+
+    def post(self, query_url, body, header_dict=None, timing=None):
+        # Perform a POST request and return a fully read HTTPResponse. If a
+        # timing dict is given, the seconds spent in the connect, ttfb and
+        # transfer phases are added to it.
+        key, connection, response, query_url = self._open(query_url, body, header_dict, timing)
+        data = self._read(key, connection, response, timing)
+        return HTTPResponse(query_url, response.status, response.reason, response.headers, data)
+
+    @contextlib.contextmanager
+    def stream(self, query_url, body, header_dict=None, timing=None):
+        # Perform a POST request and yield the response with its body unread,
+        # so that it can be consumed incrementally. The connection goes back
+        # to the pool on exit if the body was read to the end. Only the
+        # connect and ttfb phases are added to the timing dict, the caller
+        # times its own reads.
+        key, connection, response, query_url = self._open(query_url, body, header_dict, timing)
+        try:
+            yield response
+        finally:
+            self._finish(key, connection, response)
+
+    def close(self):
+        # Close all idle connections
+        with self._lock:
+            pools, self._pools = self._pools, {}
+        for pool in pools.values():
+            for connection in pool:
+                connection.close()
+
+
+class DeflateDecompressor:
+    # Incremental decoder for 'deflate' content. The standard asks for a
+    # zlib stream but some servers send raw deflate data, so the format is
+    # worked out from the first bytes.
+    def __init__(self):
+        self._decompressor = None
+
+    def decompress(self, data):
+        if self._decompressor is None:
+            if not data:
+                return b''
+            self._decompressor = zlib.decompressobj()
+            try:
+                return self._decompressor.decompress(data)
+            except zlib.error:
+                self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        return self._decompressor.decompress(data)
+
+    def flush(self):
+        if self._decompressor is None:
+            return b''
+        return self._decompressor.flush()
+
+
+class BrotliDecompressor:
+    # Incremental decoder for 'br' content, same interface as zlib's
+    def __init__(self):
+        self._decompressor = brotli.Decompressor()
+
+    def decompress(self, data):
+        return self._decompressor.process(data)
+
+    def flush(self):
+        return b''
+
+
+def getAcceptEncoding():
+    # Content codings the client can decode, sent as Accept-Encoding
+    encodings = ['gzip', 'deflate']
+    if brotli is not None:
+        encodings.append('br')
+    return ', '.join(encodings)
+
+
+def getContentEncodings(headers):
+    # Content codings applied to a response, in the order they were applied.
+    # 'identity' and a missing header mean the body is not compressed.
+    value = headers.get('Content-Encoding') if headers is not None else None
+    if not value:
+        return []
+    return [encoding.strip().lower() for encoding in value.split(',')
+            if encoding.strip() and encoding.strip().lower() != 'identity']
+
+
+def newDecompressor(encoding):
+    # Incremental decoder for one content coding
+    if encoding in ('gzip', 'x-gzip'):
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if encoding == 'deflate':
+        return DeflateDecompressor()
+    if encoding == 'br' and brotli is not None:
+        return BrotliDecompressor()
+    raise urllib.error.URLError('unsupported Content-Encoding ' + repr(encoding))
+
+
+def decodeBody(body, headers):
+    # Decompress a fully read response body according to its headers
+    for encoding in reversed(getContentEncodings(headers)):
+        decompressor = newDecompressor(encoding)
+        body = decompressor.decompress(body) + decompressor.flush()
+    return body
+
+
+class DecodedResponse:
+    # Wraps a response whose body is compressed so that read() returns the
+    # decompressed body as it streams in. Only one compressed chunk is held
+    # in memory at a time. Other attributes (headers, status, ...) are those
+    # of the wrapped response, so the charset is still read from headers.
+
+    CHUNK_SIZE = 65536
+
+    def __init__(self, response, encodings):
+        self.response = response
+        # Decoders are applied in the reverse order of the encodings
+        self._decompressors = [newDecompressor(encoding) for encoding in reversed(encodings)]
+        self._buffer = b''
+        self._eof = False
+        # Number of compressed bytes read from the response
+        self.wire_bytes = 0
+
+    def __getattr__(self, name):
+        return getattr(self.response, name)
+
+    def _decode(self, data, final):
+        for decompressor in self._decompressors:
+            data = decompressor.decompress(data)
+            if final:
+                data += decompressor.flush()
+        return data
+
+    def _fill(self, size):
+        # Read and decode until size bytes are buffered or the body ends
+        while not self._eof and (size < 0 or len(self._buffer) < size):
+            data = self.response.read(self.CHUNK_SIZE)
+            self.wire_bytes += len(data)
+            if not data:
+                self._eof = True
+                self._buffer += self._decode(b'', True)
+            else:
+                self._buffer += self._decode(data, False)
+
+    def read(self, size=-1):
+        if size is None:
+            size = -1
+        self._fill(size)
+        if size < 0:
+            data, self._buffer = self._buffer, b''
+        else:
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+def decodedResponse(response):
+    # Response whose read() returns the decompressed body
+    encodings = getContentEncodings(response.headers)
+    if not encodings:
+        return response
+    return DecodedResponse(response, encodings)
+
+
+def addTiming(timing, phase, seconds):
+    # Accumulate the seconds spent in a phase into a timing dict, if any
+    if timing is not None:
+        timing[phase] = timing.get(phase, 0.0) + seconds
+
+
+# Client shared by all callers that do not provide their own
+_default_client = None
+_default_client_lock = threading.Lock()
+
+
+def getDefaultClient():
+    # Return the shared HTTPClient, creating it (and doing the HTTP set up)
+    # on first use.
+    global _default_client
+    with _default_client_lock:
+        if _default_client is None:
+            initHTTP()
+            _default_client = HTTPClient()
+        return _default_client
+
+
+def processQuery(query_url, header_dict, expect_pass, query_dict={}, verbose=False, force=False, client=None,
+                 timing=None, raise_errors=False, timeout=DEFAULT_READ_TIMEOUT):
 
     # Build the required JSON data for the post request. The user
-    # of the function provides both the header and the query data
+    # of the function provides both the header and the query data.
+    # If an HTTPClient is given, its pooled keep-alive connections are
+    # used instead of opening a new connection with urlopen. If a timing
+    # dict is given, the seconds spent in each phase of the request
+    # (connect, ttfb, transfer) and the response size are stored in it.
+    # If raise_errors is True, errors are raised instead of returning an
+    # empty JSON array, so that the caller can tell them apart and retry.
+    # timeout is the deadline in seconds of urlopen when no client is given
+    # (None waits forever), a client applies its own connect and read
+    # timeouts.
 
     # Convert the query dictionary to JSON
     query_json = json.dumps(query_dict)
@@ -30,12 +396,29 @@ def processQuery(query_url, header_dict, expect_pass, query_dict={}, verbose=Fal
     # Try to connect the URL and get a response. On error return an
     # empty JSON array.
     try:
-        # Build the request
-        request = urllib.request.Request(query_url, query_json_encoded, header_dict)
-        # Make the request and get a handle for the response.
-        response = urllib.request.urlopen(request)
-        # Read the response
-        url_response = response.read()
+        if client is not None:
+            # Make the request on a pooled connection
+            response = client.post(query_url, query_json_encoded, header_dict, timing)
+            url_response = response.read()
+        else:
+            # Build the request
+            request = urllib.request.Request(query_url, query_json_encoded, header_dict)
+            # Make the request and get a handle for the response. urlopen
+            # does not separate connecting from waiting for the response.
+            start_time = time.perf_counter()
+            response = urllib.request.urlopen(request, timeout=timeout)
+            addTiming(timing, 'ttfb', time.perf_counter() - start_time)
+            # Read the response
+            start_time = time.perf_counter()
+            url_response = response.read()
+            addTiming(timing, 'transfer', time.perf_counter() - start_time)
+        # Decompress gzip, deflate or br encoded responses. The sizes
+        # before and after are stored in the timing dict.
+        if timing is not None:
+            timing['wire_size'] = len(url_response)
+        url_response = decodeBody(url_response, response.headers)
+        if timing is not None:
+            timing['size'] = len(url_response)
         # If we have a charset for the response, decode using it, otherwise assume utf-8
         if not response.headers.get_content_charset() is None:
             url_response = url_response.decode(response.headers.get_content_charset())
@@ -49,19 +432,49 @@ def processQuery(query_url, header_dict, expect_pass, query_dict={}, verbose=Fal
             if e.code == 400:
                 # correct failure
                 return json.loads('[400]')
+        if raise_errors:
+            raise
         print('ERROR: Server could not fullfil the request to ' + query_url)
         print('ERROR: Error code = ' + str(e.code))  # + ', Message = ', e.read())
         return json.loads('[]')
     except urllib.error.URLError as e:
+        if raise_errors:
+            raise
         print('ERROR: Failed to reach the server')
         print('ERROR: Reason =', e.reason)
         return json.loads('[]')
     except Exception as e:
+        if raise_errors:
+            raise
         print('ERROR: Unable to process response')
         print('ERROR: Reason =' + str(e))
         return json.loads('[]')
 
 
+@contextlib.contextmanager
+def processQueryStream(query_url, header_dict, query_dict={}, client=None, timing=None,
+                       timeout=DEFAULT_READ_TIMEOUT):
+
+    # Same request as processQuery(), but yields the response with its body
+    # still unread so that large responses can be parsed as they arrive.
+    # Compressed bodies are decompressed as they are read.
+    # Errors are raised (urllib.error.HTTPError / URLError) rather than
+    # turned into an empty JSON array, since the caller is reading the body.
+    # timeout is the deadline of urlopen when no client is given, as in
+    # processQuery().
+    query_json_encoded = json.dumps(query_dict).encode('utf-8')
+
+    if client is not None:
+        with client.stream(query_url, query_json_encoded, header_dict, timing) as response:
+            yield decodedResponse(response)
+    else:
+        request = urllib.request.Request(query_url, query_json_encoded, header_dict)
+        start_time = time.perf_counter()
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            addTiming(timing, 'ttfb', time.perf_counter() - start_time)
+            yield decodedResponse(response)
+
+
 def parse_query(url_response, filename):
     # This function takes as input a url_response obtained using the processQuery() function, and a file name
     # and creates either a JSON or TSV file with the query response
@@ -91,10 +504,21 @@ def getHeaderDict():
 
     # Set up the header for the post request.
     header_dict = {'accept': 'application/json',
-                   'Content-Type': 'application/json'}
+                   'Content-Type': 'application/json',
+                   'Accept-Encoding': getAcceptEncoding()}
     return header_dict
 
 
+def getSSLContext():
+    # Build the SSL context used for HTTPS connections, following the same
+    # rule as initHTTP(): certificate errors are ignored unless
+    # PYTHONHTTPSVERIFY is set.
+    if (not os.environ.get('PYTHONHTTPSVERIFY', '') and
+            getattr(ssl, '_create_unverified_context', None)):
+        return ssl._create_unverified_context()
+    return ssl.create_default_context()
+
+
 def initHTTP():
     # Deafult OS do not have create cient certificate bundles. It is
     # easiest for us to ignore HTTPS certificate errors in this case.
@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+
+"""
+Differential comparison of two servers, e.g. a staging deploy against production
+
+The same repertoires are queried on both servers at the same time, and for every statistic of
+every repertoire the results are compared:
+
+    total         reported total of the statistic
+    sum of count  sum of the counts of its data, and whether it matches the total (ResultSum)
+    data          the full statistic payload, value by value
+
+Repertoires only one server has are reported too. The latencies of every query are recorded per
+server, and the latency distributions of each endpoint are compared: the candidate server is slower
+when its median (or p95) is more than the tolerance above the reference one and a rank test says the
+difference is not chance. Both servers share the rate limiter, so they are paced alike.
+"""
+import json
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+import main as validation
+import result_writer
+import timings
+
+# Columns identifying a statistic in a stats API response
+STATISTIC_KEYS = ("repertoire_id", "sample_processing_id", "data_processing_id", "statistic_name")
+# Phases whose latency distributions are compared, see timings.PHASES
+LATENCY_PHASES = ("ttfb", "total")
+# Number of differing values described per statistic
+MAX_DATA_DIFFERENCES = 5
+
+
+def data_counts(data):
+    """
+    :param data: list of data items of a statistic, e.g. [{"key": "15", "count": 12}], or None
+    :return: dict canonical item without its count -> count
+    """
+    counts = {}
+    for item in data if isinstance(data, list) else []:
+        value = {key: item[key] for key in item if key != "count"}
+        counts[json.dumps(value, sort_keys=True)] = item.get("count")
+    return counts
+
+
+def diff_data(reference_data, candidate_data, limit=MAX_DATA_DIFFERENCES):
+    """
+    :param reference_data: list of data items of a statistic on the reference server
+    :param candidate_data: list of data items of the same statistic on the candidate server
+    :param limit: int, number of differences described
+    :return: (number of values whose count differs or that only one server has, description of the first ones)
+    """
+    reference = data_counts(reference_data)
+    candidate = data_counts(candidate_data)
+    differences = []
+    for value in sorted(set(reference) | set(candidate)):
+        if reference.get(value) != candidate.get(value):
+            differences.append("%s: %s != %s" % (value, reference.get(value), candidate.get(value)))
+    return len(differences), "; ".join(differences[:limit])
+
+
+def query_statistics(stats_url, repertoire_id, relative_path_stats=None, stream=False):
+    """
+    :param stats_url: URL entry point for stats API
+    :param repertoire_id: ID uniquely identifying repertoire
+    :param relative_path_stats: path prefix of the per-repertoire stats API query files. Repertoires without a
+                                file are queried by repertoire_id
+    :param stream: bool, if True the response is parsed incrementally
+    :return: get_sum_count dataframe of the repertoire, with its data column
+    :raises RuntimeError: if the query failed or returned no statistics
+    """
+    query_file = (relative_path_stats or "") + repertoire_id + ".json"
+    if relative_path_stats is None or not os.path.exists(query_file):
+        query_file = validation.build_stats_query([repertoire_id])
+    api_stats = validation.query_stats(stats_url, query_file, stream, keep_data=True)
+    stats_api_ct = api_stats.get_total_count()
+    if stats_api_ct.empty:
+        raise RuntimeError("no statistics returned")
+    return api_stats.get_sum_count(stats_api_ct)
+
+
+def statistics_by_key(sum_count):
+    """
+    :return: dict STATISTIC_KEYS tuple -> row of a get_sum_count dataframe, as a dict
+    """
+    if sum_count is None:
+        return {}
+    return {tuple(str(row[key]) if row[key] is not None else None for key in STATISTIC_KEYS): row
+            for row in sum_count.to_dict("records")}
+
+
+def compare_statistics(repertoire_id, reference, candidate):
+    """
+    :param repertoire_id: ID uniquely identifying repertoire
+    :param reference: get_sum_count dataframe of the reference server, or an exception if its query failed
+    :param candidate: get_sum_count dataframe of the candidate server, or an exception if its query failed
+    :return: dataframe with one row per statistic, Result is True if both servers agree on it
+    """
+    errors = {}
+    for label, result in (("reference", reference), ("candidate", candidate)):
+        if isinstance(result, Exception):
+            errors[label] = repr(result)
+    reference_rows = statistics_by_key(None if "reference" in errors else reference)
+    candidate_rows = statistics_by_key(None if "candidate" in errors else candidate)
+
+    rows = []
+    for key in sorted(set(reference_rows) | set(candidate_rows), key=str) or [(repertoire_id, None, None, None)]:
+        row = dict(zip(STATISTIC_KEYS, key))
+        reference_row = reference_rows.get(key, {})
+        candidate_row = candidate_rows.get(key, {})
+        for column, name in (("total", "Total"), ("SumOfCounts(StatsAPI)", "SumOfCounts"), ("ResultSum", "ResultSum")):
+            row[name + "(reference)"] = reference_row.get(column)
+            row[name + "(candidate)"] = candidate_row.get(column)
+        row["DataDifferences"], row["DataDiff"] = diff_data(reference_row.get("data"), candidate_row.get("data"))
+        row["Error(reference)"] = errors.get("reference", "" if reference_row else "missing")
+        row["Error(candidate)"] = errors.get("candidate", "" if candidate_row else "missing")
+        row["Result"] = bool(reference_row and candidate_row and row["DataDifferences"] == 0 and
+                             all(row[name + "(reference)"] == row[name + "(candidate)"]
+                                 for name in ("Total", "SumOfCounts", "ResultSum")))
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def mann_whitney(reference, candidate):
+    """
+    Mann-Whitney U rank test, with the normal approximation
+
+    :param reference: list of latencies
+    :param candidate: list of latencies
+    :return: (probability that a candidate latency is above a reference one, two-sided p-value). None
+             if either list is empty
+    """
+    n, m = len(reference), len(candidate)
+    if not n or not m:
+        return None
+    values = sorted([(value, 0) for value in reference] + [(value, 1) for value in candidate])
+    # Average ranks of tied values
+    rank_sum = 0.0
+    tie_term = 0.0
+    i = 0
+    while i < len(values):
+        j = i
+        while j + 1 < len(values) and values[j + 1][0] == values[i][0]:
+            j += 1
+        rank = (i + j) / 2.0 + 1
+        rank_sum += rank * sum(1 for k in range(i, j + 1) if values[k][1] == 1)
+        tie_term += (j - i + 1) ** 3 - (j - i + 1)
+        i = j + 1
+    u = rank_sum - m * (m + 1) / 2.0
+    mean = n * m / 2.0
+    variance = n * m / 12.0 * ((n + m + 1) - tie_term / ((n + m) * (n + m - 1))) if n + m > 1 else 0.0
+    if variance <= 0:
+        return u / (n * m), 1.0
+    z = (abs(u - mean) - 0.5) / math.sqrt(variance)
+    return u / (n * m), min(math.erfc(max(z, 0.0) / math.sqrt(2)), 1.0)
+
+
+def compare_latencies(recorder, reference_url, candidate_url, tolerance=0.1, alpha=0.01):
+    """
+    :param recorder: timings.TimingRecorder with endpoints by host
+    :param reference_url: base URL of the reference server
+    :param candidate_url: base URL of the candidate server
+    :param tolerance: float, relative slowdown of the median or p95 tolerated
+    :param alpha: float, p-value below which a difference is not chance
+    :return: dataframe with one row per endpoint and phase, Result is False if the candidate is slower
+    """
+    reference_host = timings.endpoint_of(reference_url, True).split("/")[0]
+    candidate_host = timings.endpoint_of(candidate_url, True).split("/")[0]
+    endpoints = sorted(set(endpoint.split("/", 1)[1] for endpoint in recorder.summary()
+                           if endpoint.split("/")[0] in (reference_host, candidate_host)))
+
+    rows = []
+    for path in endpoints:
+        for phase in LATENCY_PHASES:
+            reference = recorder.samples(reference_host + "/" + path, phase)
+            candidate = recorder.samples(candidate_host + "/" + path, phase)
+            if not reference or not candidate:
+                continue
+            row = {"endpoint": "/" + path, "phase": phase, "Count(reference)": len(reference),
+                   "Count(candidate)": len(candidate)}
+            for fraction in (0.5, 0.95, 0.99):
+                name = "p%g" % (100 * fraction)
+                row[name + "(reference)"] = timings.percentile(reference, fraction)
+                row[name + "(candidate)"] = timings.percentile(candidate, fraction)
+            row["MedianRatio"] = row["p50(candidate)"] / row["p50(reference)"] if row["p50(reference)"] else None
+            row["ProbabilitySlower"], row["PValue"] = mann_whitney(reference, candidate)
+            slower = any(row[name + "(candidate)"] > (1 + tolerance) * row[name + "(reference)"]
+                         for name in ("p50", "p95"))
+            row["Result"] = not (slower and row["ProbabilitySlower"] > 0.5 and row["PValue"] < alpha)
+            rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def print_latencies(latency_df):
+    if latency_df.empty:
+        return
+    print("LATENCY, REFERENCE VS CANDIDATE (in seconds)")
+    print("%-45s %-6s %9s %9s %9s %9s %7s %9s %6s" % ("endpoint", "phase", "p50 ref", "p50 cand", "p95 ref",
+                                                      "p95 cand", "ratio", "p-value", "result"))
+    for row in latency_df.to_dict("records"):
+        print("%-45s %-6s %9.4f %9.4f %9.4f %9.4f %7.2f %9.2g %6s" % (
+            row["endpoint"], row["phase"], row["p50(reference)"], row["p50(candidate)"], row["p95(reference)"],
+            row["p95(candidate)"], row["MedianRatio"] or 0, row["PValue"], "ok" if row["Result"] else "SLOWER"))
+    print("------------------------------------------------------")
+
+
+def differential(reference_url, candidate_url, entry_pt="rearrangement/count",
+                 adc_json_files="./JSON-Files/repertoire/nofilters.json", relative_path_stats=None,
+                 details_dir="./", repository_name="COVID19-3", max_workers=1, page_size=1000, stream=False,
+                 output_format="csv", compression=None, timings_file=None, time_tolerance=0.1, alpha=0.01,
+                 query_delay=0, max_rate=20.0, max_retries=4, connect_timeout=10.0, read_timeout=300.0):
+    """
+    Query the same repertoires on two servers concurrently and compare their statistics and latencies
+
+    :param reference_url: HTTP address of the reference server, e.g. production
+    :param candidate_url: HTTP address of the candidate server, e.g. staging
+    :param entry_pt: stats API entry point, one of rearrangement/count, rearrangement/junction_length,
+                     rearrangement/gene_usage
+    :param adc_json_files: path to JSON file with the ADC API repertoire query, run on both servers
+    :param relative_path_stats: path prefix of JSON input files for Stats API queries, None to query every
+                                repertoire by repertoire_id
+    :param details_dir: path to directory where results should be stored
+    :param repository_name: string, prefix of the results files
+    :param max_workers: int, number of repertoires compared concurrently, each on both servers at once
+    :param page_size: int, number of repertoire IDs requested per ADC API repertoire query
+    :param stream: bool, if True stats API responses are parsed incrementally as they are downloaded
+    :param output_format: format of the results files, one of 'csv', 'parquet', 'arrow'
+    :param compression: 'gzip' or None for csv, Parquet codec for parquet
+    :param timings_file: path to JSONL file where the phase timings of every query are appended
+    :param time_tolerance: float, relative slowdown of the candidate's median or p95 latency tolerated
+    :param alpha: float, p-value below which a latency difference counts
+    :param query_delay: float, seconds between queries to start with, see main.configure_queries
+    :param max_rate: float, highest number of queries per second, over both servers
+    :param max_retries: int, number of times a query failing with a transient error is retried
+    :param connect_timeout: float, seconds allowed to open a connection
+    :param read_timeout: float, seconds allowed for each wait for data
+    :return: dict with the paths of the 'differential' and 'latency' results files, and the number of
+             'mismatches' (statistics the servers disagree on) and 'slower' (endpoint phases slower on the
+             candidate)
+    """
+    print("STATS API DIFFERENTIAL TEST")
+    print("Reference:", reference_url)
+    print("Candidate:", candidate_url)
+
+    recorder = timings.TimingRecorder(timings_file, by_host=True)
+    timings.set_default_recorder(recorder)
+    validation.configure_queries(query_delay, max_rate, max_retries, connect_timeout, read_timeout)
+    stats_name = validation.statistic_name_of(entry_pt)
+
+    def repertoire_ids(base_url):
+        return [str(i) for i in validation.iter_repertoire_ids(base_url + "/airr/v1/" + "repertoire",
+                                                               adc_json_files, page_size)]
+
+    executor = ThreadPoolExecutor(max_workers=2 * max_workers)
+    try:
+        reference_ids, candidate_ids = executor.map(repertoire_ids, (reference_url, candidate_url))
+        reference_set = set(reference_ids)
+        candidate_set = set(candidate_ids)
+        rep_ids = reference_ids + [i for i in candidate_ids if i not in reference_set]
+        only_reference = len(reference_set - candidate_set)
+        print(len(rep_ids), "repertoires,", only_reference, "only on the reference server,",
+              len(rep_ids) - len(reference_ids), "only on the candidate server")
+
+        def query(base_url, repertoire_id):
+            try:
+                with timings.tagged(repertoire_id=repertoire_id):
+                    return query_statistics(base_url + "/irplus/v1/stats/" + entry_pt, repertoire_id,
+                                            relative_path_stats, stream)
+            except Exception as e:
+                return e
+
+        def task(repertoire_id):
+            # Both servers at the same time, so that they see the same load
+            reference = executor.submit(query, reference_url, repertoire_id)
+            candidate = executor.submit(query, candidate_url, repertoire_id)
+            return compare_statistics(repertoire_id, reference.result(), candidate.result())
+
+        sink = result_writer.ResultSink(
+            validation.result_path_prefix(details_dir, repository_name, stats_name, "Differential"), output_format,
+            compression)
+        mismatches = 0
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            for diff_df in pool.map(task, rep_ids):
+                failing = diff_df[~diff_df["Result"]]
+                mismatches += len(failing)
+                if len(failing):
+                    print("DIFFERENCE:", failing["repertoire_id"].iloc[0], len(failing), "statistic(s)")
+                sink.append(diff_df)
+        paths = {"differential": sink.close()}
+    finally:
+        executor.shutdown()
+
+    latency_df = compare_latencies(recorder, reference_url, candidate_url, time_tolerance, alpha)
+    print_latencies(latency_df)
+    paths["latency"] = validation.write_results(
+        validation.result_path_prefix(details_dir, repository_name, stats_name, "DifferentialLatency"),
+        [latency_df], output_format, compression)
+    paths["mismatches"] = mismatches
+    paths["slower"] = int((~latency_df["Result"]).sum()) if not latency_df.empty else 0
+    print(mismatches, "statistic(s) differ,", paths["slower"], "endpoint phase(s) slower on the candidate")
+
+    recorder.close()
+    timings.set_default_recorder(None)
+    return paths
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+
+"""
+Hedged requests for tail latency
+
+A query that has not answered within the observed p95 latency of its endpoint is sent a second
+time, and whichever response arrives first is used. The slower copy is left to finish in the
+background and its response is discarded. Until enough latencies have been observed for an
+endpoint, its queries are not hedged.
+
+Only about one query in twenty is duplicated at p95, so hedging adds little load while cutting
+the time lost to the few queries stuck behind a slow node or connection. Duplicates go through the
+rate limiter like any other query, and none are sent while the limiter is backing off: a node slow
+enough to cut the rate would only be slowed down further.
+"""
+import collections
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import ratelimit
+import timings
+
+# Duplicates are not retried, the original query is
+_NO_RETRY = ratelimit.RetryPolicy(0)
+
+
+class Hedger:
+
+    def __init__(self, quantile=0.95, min_samples=20, window=200, max_workers=16, limiter=None):
+        """
+        :param quantile: float, fraction of queries expected to answer before a duplicate is sent
+        :param min_samples: int, number of latencies observed for an endpoint before its queries are hedged
+        :param window: int, number of most recent latencies per endpoint the quantile is computed from
+        :param max_workers: int, number of threads querying through the hedger at once, e.g. the
+                            max_workers of main. Originals and duplicates each get a pool of that size
+        :param limiter: ratelimit.AdaptiveLimiter duplicates go through, defaults to
+                        ratelimit.get_default_limiter()
+        """
+        self.quantile = quantile
+        self.min_samples = min_samples
+        self.window = window
+        self.limiter = limiter
+        self.hedged = 0
+        self.won = 0
+        # Duplicates have their own threads, so that they never queue behind originals or delay them
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._hedge_executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._lock = threading.Lock()
+        # endpoint -> deque of the most recent latencies in seconds
+        self._latencies = {}
+
+    def observe(self, endpoint, seconds):
+        """
+        :param endpoint: string, see timings.endpoint_of
+        :param seconds: float, latency of a query to the endpoint
+        """
+        with self._lock:
+            latencies = self._latencies.get(endpoint)
+            if latencies is None:
+                latencies = self._latencies[endpoint] = collections.deque(maxlen=self.window)
+            latencies.append(seconds)
+
+    def delay(self, endpoint):
+        """
+        :param endpoint: string, see timings.endpoint_of
+        :return: float, seconds after which a query to the endpoint is hedged, None if too few latencies
+                 have been observed yet
+        """
+        with self._lock:
+            latencies = self._latencies.get(endpoint)
+            if latencies is None or len(latencies) < self.min_samples:
+                return None
+            latencies = sorted(latencies)
+        return timings.percentile(latencies, self.quantile)
+
+    def _timed(self, request, timing, started=None):
+        if started is not None:
+            started.set()
+        start_time = time.perf_counter()
+        result = request(timing)
+        return result, time.perf_counter() - start_time
+
+    def call(self, request, query_url, timing=None):
+        """
+        Perform a query, sending a duplicate if it is slower than usual
+
+        :param request: callable taking a timing dict and performing one query, raising on failure.
+                        It must be safe to run twice at the same time
+        :param query_url: string, URL of the query, latencies are tracked per endpoint
+        :param timing: dict the phase timings of the response used are added to, or None
+        :return: whatever request returns, from the first copy that succeeds
+        :raises: the error of the original query if both copies fail
+        """
+        endpoint = timings.endpoint_of(query_url)
+        delay = self.delay(endpoint)
+        if delay is None:
+            result, seconds = self._timed(request, timing)
+            self.observe(endpoint, seconds)
+            return result
+
+        # Each copy gets its own timing dict, only the one used is kept
+        copies = {}
+        primary_timing = {}
+        started = threading.Event()
+        primary = self._executor.submit(self._timed, request, primary_timing, started)
+        copies[primary] = primary_timing
+
+        # The latency of the original query is observed even when the duplicate wins, so that hedging
+        # does not hide the tail it is measured on
+        def observe_primary(future):
+            if future.exception() is None:
+                self.observe(endpoint, future.result()[1])
+
+        primary.add_done_callback(observe_primary)
+        # The delay runs from the start of the original query, time spent waiting for a thread (e.g.
+        # behind the slower copies of earlier queries) does not make it hedged
+        started.wait()
+        done, _ = wait([primary], timeout=delay)
+        limiter = self.limiter if self.limiter is not None else ratelimit.get_default_limiter()
+        if not done and not (limiter is not None and limiter.cooling_down()):
+            with self._lock:
+                self.hedged += 1
+            hedge_timing = {}
+            copies[self._hedge_executor.submit(ratelimit.call, lambda: self._timed(request, hedge_timing),
+                                               query_url, limiter, _NO_RETRY)] = hedge_timing
+
+        pending = set(copies)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is not None:
+                    continue
+                result, _ = future.result()
+                if future is not primary:
+                    with self._lock:
+                        self.won += 1
+                if timing is not None:
+                    timing.update(copies[future])
+                return result
+        raise primary.exception()
+
+    def close(self):
+        """
+        Stop the worker threads, duplicates still in flight finish in the background
+        """
+        self._executor.shutdown(wait=False)
+        self._hedge_executor.shutdown(wait=False)
+
+
+# Hedger used by callers that do not provide their own
+_default_hedger = None
+
+
+def set_default_hedger(hedger):
+    """
+    :param hedger: Hedger used by default, or None to not hedge queries
+    """
+    global _default_hedger
+    _default_hedger = hedger
+
+
+def get_default_hedger():
+    """
+    :return: Hedger used by default, None if queries are not hedged
+    """
+    return _default_hedger
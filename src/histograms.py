@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+
+"""
+Bulk checks of junction length distributions
+
+The junction_length and junction_aa_length statistics of every repertoire are loaded into one
+dense 2-D array per statistic (repertoire x length) and checked all at once with NumPy:
+
+    sum:          sum of counts equals the reported total
+    gaps:         lengths with no count between the shortest and longest length observed
+    negative:     keys with a negative count
+    out of range: keys outside 0..max_length, or that are not integers
+    duplicates:   keys reported more than once
+    facet:        optionally, bins that differ from facet counts on the same field. A repertoire
+                  missing from the facet counts fails, its bins are compared with no counts
+
+Gaps are reported but do not fail a histogram, junction_length distributions commonly have empty
+lengths between in-frame ones.
+"""
+import numpy as np
+import pandas as pd
+
+# Statistics of the junction_length entry point
+JUNCTION_STATISTICS = ("junction_length", "junction_aa_length")
+
+CHECK_COLUMNS = ["repertoire_id", "statistic_name", "total", "SumOfCounts", "ResultSum", "min_length",
+                 "max_length", "gaps", "negative_counts", "out_of_range", "duplicate_keys", "FacetMismatchBins",
+                 "Result"]
+
+
+def _parse_keys(keys):
+    # Integer value of each key, and whether the key was an integer at all
+    try:
+        # Fast path, every key is an integer or a string of one
+        lengths = np.array(keys, dtype=str if keys and isinstance(keys[0], str) else None).astype(np.int64)
+        return lengths, np.ones(len(lengths), dtype=bool)
+    except (ValueError, TypeError, OverflowError):
+        pass
+    lengths = pd.to_numeric(pd.Series(keys, dtype=object), errors="coerce").values.astype(np.float64)
+    integer = ~np.isnan(lengths) & (np.floor(lengths) == lengths)
+    return np.where(integer, lengths, -1).astype(np.int64), integer
+
+
+class HistogramSet:
+    """
+    Junction length histograms of many repertoires, collected one repertoire at a time and checked
+    in bulk. Keys are parsed as each repertoire is added, only NumPy arrays of lengths and counts
+    are kept
+    """
+
+    def __init__(self, statistic_names=JUNCTION_STATISTICS, max_length=400):
+        """
+        :param statistic_names: statistics collected
+        :param max_length: int, longest valid length, longer ones are reported as out of range
+        """
+        self.statistic_names = statistic_names
+        self.max_length = max_length
+        # statistic_name -> list of (repertoire_id, total, lengths, integer keys mask, counts)
+        self._histograms = {name: [] for name in statistic_names}
+
+    def add(self, stats_api_ct):
+        """
+        :param stats_api_ct: dataframe resulting from ApiStats.get_total_count, with its data column
+        :return: None
+        """
+        rows = stats_api_ct[stats_api_ct["statistic_name"].isin(self.statistic_names)]
+        for repertoire_id, statistic_name, total, data in zip(rows["repertoire_id"].values,
+                                                               rows["statistic_name"].values,
+                                                               rows["total"].values, rows["data"].values):
+            if not isinstance(data, list):
+                data = []
+            lengths, integer = _parse_keys([item.get("key") for item in data])
+            counts = np.array([item.get("count", 0) for item in data], dtype=np.int64)
+            self._histograms[statistic_name].append((str(repertoire_id), total, lengths, integer, counts))
+
+    def repertoire_ids(self, statistic_name):
+        """
+        :return: list of repertoire IDs with a histogram for the statistic, in row order
+        """
+        return [histogram[0] for histogram in self._histograms[statistic_name]]
+
+    def matrix(self, statistic_name):
+        """
+        :param statistic_name: one of statistic_names
+        :return: (rep_ids, totals, counts, flags). counts is an int64 array of shape
+                 (repertoires, max_length + 1), counts[i, length]. flags is a dict of per-repertoire
+                 arrays negative_counts, out_of_range and duplicate_keys
+        """
+        histograms = self._histograms[statistic_name]
+        n_rows = len(histograms)
+        width = self.max_length + 1
+        rep_ids = [histogram[0] for histogram in histograms]
+        totals = np.array([-1 if histogram[1] is None else histogram[1] for histogram in histograms],
+                          dtype=np.int64)
+
+        # Flatten every histogram into one (row, length, count) list
+        sizes = np.array([len(histogram[2]) for histogram in histograms], dtype=np.int64)
+        rows = np.repeat(np.arange(n_rows), sizes)
+        if n_rows:
+            lengths = np.concatenate([histogram[2] for histogram in histograms])
+            integer = np.concatenate([histogram[3] for histogram in histograms])
+            counts = np.concatenate([histogram[4] for histogram in histograms])
+        else:
+            lengths, integer, counts = np.zeros(0, np.int64), np.zeros(0, bool), np.zeros(0, np.int64)
+
+        in_range = integer & (lengths >= 0) & (lengths <= self.max_length)
+        negative = counts < 0
+        flat_index = rows * width + lengths
+        matrix = np.bincount(flat_index[in_range], weights=counts[in_range],
+                             minlength=n_rows * width).astype(np.int64).reshape(n_rows, width)
+
+        # Keys seen more than once in the same histogram
+        occurrences = np.bincount(flat_index[in_range], minlength=n_rows * width).reshape(n_rows, width)
+        duplicates = np.clip(occurrences - 1, 0, None).sum(axis=1)
+
+        flags = {"negative_counts": np.bincount(rows[negative], minlength=n_rows),
+                 "out_of_range": np.bincount(rows[~in_range], minlength=n_rows),
+                 "duplicate_keys": duplicates,
+                 # Sum of count includes keys that are out of range
+                 "sum_count": np.bincount(rows, weights=counts, minlength=n_rows).astype(np.int64)}
+        return rep_ids, totals, matrix, flags
+
+    def check(self, facet_matrices=None):
+        """
+        :param facet_matrices: dict statistic_name -> (rep_ids, matrix) of facet counts on the same
+                               field, see facet_matrix. Statistics without one are not compared
+        :return: dataframe with one row per repertoire and statistic, columns CHECK_COLUMNS
+        """
+        checks = []
+        for statistic_name in self.statistic_names:
+            if not self._histograms[statistic_name]:
+                continue
+            rep_ids, totals, matrix, flags = self.matrix(statistic_name)
+            checks.append(check_matrix(statistic_name, rep_ids, totals, matrix, flags,
+                                       (facet_matrices or {}).get(statistic_name)))
+        if not checks:
+            return pd.DataFrame(columns=CHECK_COLUMNS)
+        return pd.concat(checks, ignore_index=True)
+
+
+def check_matrix(statistic_name, rep_ids, totals, matrix, flags, facet=None):
+    """
+    :param statistic_name: string, name of the statistic checked
+    :param rep_ids: list of repertoire IDs, one per row of matrix
+    :param totals: int64 array with the total reported for each repertoire
+    :param matrix: int64 array (repertoires x length) of counts
+    :param flags: dict of per-repertoire arrays, see HistogramSet.matrix
+    :param facet: (rep_ids, matrix) with facet counts, or None
+    :return: dataframe with one row per repertoire, columns CHECK_COLUMNS
+    """
+    n_rows, width = matrix.shape
+    nonzero = matrix != 0
+    has_counts = nonzero.any(axis=1)
+    first = np.where(has_counts, nonzero.argmax(axis=1), -1)
+    last = np.where(has_counts, width - 1 - nonzero[:, ::-1].argmax(axis=1), -1)
+    gaps = np.where(has_counts, last - first + 1 - nonzero.sum(axis=1), 0)
+
+    sum_count = flags["sum_count"]
+    result_sum = sum_count == totals
+
+    # -1 when facet counts are not compared
+    facet_mismatch = np.full(n_rows, -1, dtype=np.int64)
+    facet_result = np.ones(n_rows, dtype=bool)
+    if facet is not None:
+        facet_ids, facet_counts = facet
+        position = pd.Index(facet_ids).get_indexer(rep_ids)
+        found = position >= 0
+        aligned = facet_counts[position[found]]
+        facet_mismatch[found] = (aligned != matrix[found]).sum(axis=1)
+        facet_mismatch[~found] = nonzero[~found].sum(axis=1)
+        facet_result = found & (facet_mismatch == 0)
+
+    result = result_sum & (flags["negative_counts"] == 0) & (flags["out_of_range"] == 0) & \
+        (flags["duplicate_keys"] == 0) & facet_result
+
+    return pd.DataFrame({"repertoire_id": rep_ids,
+                         "statistic_name": statistic_name,
+                         "total": totals,
+                         "SumOfCounts": sum_count,
+                         "ResultSum": result_sum,
+                         "min_length": first,
+                         "max_length": last,
+                         "gaps": gaps,
+                         "negative_counts": flags["negative_counts"],
+                         "out_of_range": flags["out_of_range"],
+                         "duplicate_keys": flags["duplicate_keys"],
+                         "FacetMismatchBins": facet_mismatch,
+                         "Result": result}, columns=CHECK_COLUMNS)
+
+
+def facet_matrix(facets, field, max_length):
+    """
+    :param facets: dict repertoire ID -> list of facet count entries {field: length, "count": count}
+    :param field: string, field the facet counts are on
+    :param max_length: int, longest length kept, longer ones are dropped
+    :return: (rep_ids, matrix) with the facet counts of each repertoire, matrix as in HistogramSet.matrix
+    """
+    rep_ids = list(facets)
+    width = max_length + 1
+    sizes = np.array([len(facets[i]) for i in rep_ids], dtype=np.int64)
+    rows = np.repeat(np.arange(len(rep_ids)), sizes)
+    lengths, integer = _parse_keys([entry.get(field) for i in rep_ids for entry in facets[i]])
+    counts = np.array([entry.get("count", 0) for i in rep_ids for entry in facets[i]], dtype=np.int64)
+    keep = integer & (lengths >= 0) & (lengths <= max_length)
+    matrix = np.bincount(rows[keep] * width + lengths[keep], weights=counts[keep],
+                         minlength=len(rep_ids) * width).astype(np.int64).reshape(len(rep_ids), width)
+    return rep_ids, matrix
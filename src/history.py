@@ -0,0 +1,416 @@
+# -*- coding: utf-8 -*-
+
+"""
+Historical results of validation runs in an indexed SQLite database
+
+Every run of main() with a history database adds one row to runs, and the results of each
+repertoire as they are produced:
+
+    runs           run_id, repository, base_url, entry point, statistic, start and end time, status
+    sum_counts     per run, repository, repertoire and statistic: reported total, sum of count, passed
+    facet_counts   per run, repository, repertoire and statistic (and gene for gene_usage):
+                   facet count, stats API count, passed
+    failures       repertoires that failed after retries, and why
+    timings        per run and endpoint phase: count, mean, p50, p95, p99 latency
+
+Rows are indexed by (repository, repertoire_id, statistic_name, run_id), so the history of a
+repertoire, the run since which it has been failing or the regressions of a run against the
+previous one are index lookups, in milliseconds whatever the number of runs. The database is in
+WAL mode, so that the worker processes of repositories.py can add their runs to the same file.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    repository TEXT NOT NULL,
+    base_url TEXT,
+    entry_point TEXT,
+    statistic TEXT,
+    started REAL NOT NULL,
+    finished REAL,
+    status TEXT NOT NULL DEFAULT 'running',
+    options TEXT
+);
+CREATE INDEX IF NOT EXISTS runs_repository ON runs (repository, statistic, run_id);
+
+CREATE TABLE IF NOT EXISTS sum_counts (
+    run_id INTEGER NOT NULL REFERENCES runs (run_id),
+    repository TEXT NOT NULL,
+    repertoire_id TEXT NOT NULL,
+    statistic_name TEXT,
+    sample_processing_id TEXT,
+    data_processing_id TEXT,
+    total INTEGER,
+    sum_count INTEGER,
+    passed INTEGER
+);
+CREATE INDEX IF NOT EXISTS sum_counts_repertoire ON sum_counts (repository, repertoire_id, statistic_name, run_id);
+CREATE INDEX IF NOT EXISTS sum_counts_run ON sum_counts (run_id, passed);
+
+CREATE TABLE IF NOT EXISTS facet_counts (
+    run_id INTEGER NOT NULL REFERENCES runs (run_id),
+    repository TEXT NOT NULL,
+    repertoire_id TEXT NOT NULL,
+    statistic_name TEXT,
+    key TEXT,
+    facet_count INTEGER,
+    stats_count INTEGER,
+    passed INTEGER
+);
+CREATE INDEX IF NOT EXISTS facet_counts_repertoire ON facet_counts (repository, repertoire_id, statistic_name, run_id);
+CREATE INDEX IF NOT EXISTS facet_counts_run ON facet_counts (run_id, passed);
+
+CREATE TABLE IF NOT EXISTS failures (
+    run_id INTEGER NOT NULL REFERENCES runs (run_id),
+    repository TEXT NOT NULL,
+    repertoire_id TEXT NOT NULL,
+    reason TEXT
+);
+CREATE INDEX IF NOT EXISTS failures_repertoire ON failures (repository, repertoire_id, run_id);
+
+CREATE TABLE IF NOT EXISTS timings (
+    run_id INTEGER NOT NULL REFERENCES runs (run_id),
+    repository TEXT NOT NULL,
+    endpoint TEXT NOT NULL,
+    phase TEXT NOT NULL,
+    count INTEGER,
+    mean REAL,
+    p50 REAL,
+    p95 REAL,
+    p99 REAL
+);
+CREATE INDEX IF NOT EXISTS timings_endpoint ON timings (repository, endpoint, phase, run_id);
+"""
+
+def passed_of(value):
+    """
+    :param value: Result or ResultSum value, True, False, 'True', 'False', or 0 / -1 for statistics
+                  without data or without count
+    :return: 1 if passed, 0 if failed, None if there was nothing to check
+    """
+    if isinstance(value, str):
+        value = {"true": True, "false": False}.get(value.strip().lower(), value)
+    if isinstance(value, (bool, np.bool_)):
+        return int(value)
+    return None
+
+
+def integer_of(value):
+    """
+    :return: value as an int, None if it is missing or not a number
+    """
+    try:
+        if value is None or pd.isna(value):
+            return None
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def text_of(value):
+    """
+    :return: value as a string, None if it is missing
+    """
+    if value is None or (not isinstance(value, str) and pd.isna(value)):
+        return None
+    return str(value)
+
+
+class HistoryStore:
+
+    def __init__(self, path):
+        """
+        :param path: SQLite database file, created with its tables if needed
+        """
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Worker processes of repositories.py write to the same file, wait for each other's transactions
+        self._connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.executescript(SCHEMA)
+        self._lock = threading.Lock()
+        # run_id -> repository
+        self._repositories = {}
+
+    def _insert(self, sql, rows):
+        rows = list(rows)
+        if not rows:
+            return
+        # One short transaction per result, so that other processes writing to the database are never
+        # kept waiting while this one queries the API. Commits are cheap in WAL mode with synchronous=NORMAL
+        with self._lock:
+            self._connection.executemany(sql, rows)
+            self._connection.commit()
+
+    def start_run(self, repository, base_url=None, entry_point=None, statistic=None, options=None, started=None):
+        """
+        :param repository: string, repository name
+        :param base_url: HTTP address of the repository
+        :param entry_point: stats API entry point
+        :param statistic: string, one of rearrangement_count, junction_length, gene_usage
+        :param options: dict of run options stored as JSON, e.g. main() arguments
+        :param started: float, start time (seconds since the epoch), default now
+        :return: int, ID of the new run
+        """
+        with self._lock:
+            cursor = self._connection.execute(
+                "INSERT INTO runs (repository, base_url, entry_point, statistic, started, options) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (repository, base_url, entry_point, statistic, time.time() if started is None else started,
+                 json.dumps(options, default=str) if options is not None else None))
+            self._connection.commit()
+            self._repositories[cursor.lastrowid] = repository
+            return cursor.lastrowid
+
+    def finish_run(self, run_id, status="ok", finished=None):
+        """
+        :param run_id: int, see start_run
+        :param status: string, e.g. 'ok', or 'partial' if some repertoires failed
+        :param finished: float, end time, default now
+        """
+        with self._lock:
+            self._connection.execute("UPDATE runs SET finished = ?, status = ? WHERE run_id = ?",
+                                     (time.time() if finished is None else finished, status, run_id))
+            self._connection.commit()
+
+    def add_sum_count(self, run_id, sum_count_df):
+        """
+        :param run_id: int, see start_run
+        :param sum_count_df: dataframe resulting from ApiStats.get_sum_count, or read from a SumCountTotalStat file
+        """
+        repository = self._repositories[run_id]
+        self._insert("INSERT INTO sum_counts VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                     ((run_id, repository, text_of(row.get("repertoire_id")), text_of(row.get("statistic_name")),
+                       text_of(row.get("sample_processing_id")), text_of(row.get("data_processing_id")),
+                       integer_of(row.get("total")), integer_of(row.get("SumOfCounts(StatsAPI)")),
+                       passed_of(row.get("ResultSum")))
+                      for row in sum_count_df.to_dict("records")))
+
+    def add_facet_counts(self, run_id, result_df, statistic_name):
+        """
+        :param run_id: int, see start_run
+        :param result_df: dataframe resulting from compare_repertoire_counts, compare_facet_counts or
+                          compare_gene_usage, or read from a FinalCount file
+        :param statistic_name: string, statistic compared, used for rows without a statistic_name column
+        """
+        repository = self._repositories[run_id]
+        self._insert("INSERT INTO facet_counts VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                     ((run_id, repository, text_of(row.get("RepertoireID(JSON)")),
+                       text_of(row.get("statistic_name", statistic_name)), text_of(row.get("key")),
+                       integer_of(row.get("FacetCountAPI")), integer_of(row.get("StatsAPICount")),
+                       passed_of(row.get("Result")))
+                      for row in result_df.to_dict("records")))
+
+    def add_failures(self, run_id, failed):
+        """
+        :param run_id: int, see start_run
+        :param failed: list of (repertoire_id, reason)
+        """
+        repository = self._repositories[run_id]
+        self._insert("INSERT INTO failures VALUES (?, ?, ?, ?)",
+                     ((run_id, repository, str(repertoire_id), reason) for repertoire_id, reason in failed))
+
+    def add_timings(self, run_id, summary):
+        """
+        :param run_id: int, see start_run
+        :param summary: dict endpoint -> phase -> {count, mean, p50, p95, p99}, see TimingRecorder.summary
+        """
+        repository = self._repositories[run_id]
+        self._insert("INSERT INTO timings VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                     ((run_id, repository, endpoint, phase, stats["count"], stats["mean"], stats["p50"],
+                       stats["p95"], stats["p99"])
+                      for endpoint, phases in summary.items() for phase, stats in phases.items()))
+
+    def query(self, sql, params=()):
+        """
+        :return: dataframe with the rows of a SQL query on the database
+        """
+        with self._lock:
+            return pd.read_sql_query(sql, self._connection, params=params)
+
+    def runs(self, repository=None, limit=20):
+        """
+        :param repository: string, repository name, None for all repositories
+        :param limit: int, number of most recent runs
+        :return: dataframe with the most recent runs and their number of failing results, latest first
+        """
+        where = "WHERE repository = ?" if repository is not None else ""
+        return self.query("SELECT r.run_id, r.repository, r.base_url, r.entry_point, r.statistic, "
+                          "datetime(r.started, 'unixepoch', 'localtime') AS started, "
+                          "datetime(r.finished, 'unixepoch', 'localtime') AS finished, r.status, "
+                          "(SELECT COUNT(*) FROM facet_counts f WHERE f.run_id = r.run_id AND f.passed = 0) "
+                          "AS facet_failures, "
+                          "(SELECT COUNT(*) FROM sum_counts s WHERE s.run_id = r.run_id AND s.passed = 0) "
+                          "AS sum_count_failures, "
+                          "(SELECT COUNT(*) FROM failures x WHERE x.run_id = r.run_id) AS failed_repertoires "
+                          "FROM runs r " + where + " ORDER BY r.run_id DESC LIMIT ?",
+                          ((repository,) if repository is not None else ()) + (limit,))
+
+    def repertoire_history(self, repository, repertoire_id, statistic_name=None):
+        """
+        :param repository: string, repository name
+        :param repertoire_id: ID uniquely identifying repertoire
+        :param statistic_name: string, only this statistic. None for all
+        :return: dataframe with the facet count results of the repertoire in every run, oldest first
+        """
+        params = [repository, str(repertoire_id)]
+        where = ""
+        if statistic_name is not None:
+            where = " AND f.statistic_name = ?"
+            params.append(statistic_name)
+        return self.query("SELECT f.run_id, datetime(r.started, 'unixepoch', 'localtime') AS started, f.statistic_name, f.key, f.facet_count, f.stats_count, "
+                          "f.passed FROM facet_counts f JOIN runs r USING (run_id) "
+                          "WHERE f.repository = ? AND f.repertoire_id = ?" + where +
+                          " ORDER BY f.run_id, f.statistic_name, f.key", params)
+
+    def failing_since(self, repository, repertoire_id, statistic_name, key=None):
+        """
+        :param repository: string, repository name
+        :param repertoire_id: ID uniquely identifying repertoire
+        :param statistic_name: string, statistic compared with facet counts
+        :param key: string, only this key of the statistic, e.g. a gene of a gene_usage statistic. None for
+                    the whole statistic, which fails in a run if any of its keys fails
+        :return: dict with the run (run_id, started, ...) since which the facet count of the repertoire has
+                 disagreed with the stats API in every run, None if it agrees in its latest run
+        """
+        params = [repository, str(repertoire_id), statistic_name]
+        where = ""
+        if key is not None:
+            where = " AND key IS ?"
+            params.append(key)
+        with self._lock:
+            # Whether the statistic (or key) passed in each run, gene_usage has one row per gene
+            cursor = self._connection.execute(
+                "WITH results AS (SELECT run_id, MIN(passed) AS passed FROM facet_counts "
+                "WHERE repository = ? AND repertoire_id = ? AND statistic_name = ?" + where + " GROUP BY run_id) "
+                "SELECT MIN(run_id) FROM results WHERE passed = 0 AND run_id > "
+                "COALESCE((SELECT MAX(run_id) FROM results WHERE passed = 1), 0)", params)
+            run_id = cursor.fetchone()[0]
+            if run_id is None:
+                return None
+            cursor = self._connection.execute("SELECT * FROM runs WHERE run_id = ?", (run_id,))
+            return dict(zip([column[0] for column in cursor.description], cursor.fetchone()))
+
+    def previous_run(self, run_id):
+        """
+        :return: int, ID of the latest earlier finished run of the same repository and statistic, None if none
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT MAX(p.run_id) FROM runs p JOIN runs r ON p.repository = r.repository "
+                "AND p.statistic IS r.statistic WHERE r.run_id = ? AND p.run_id < r.run_id "
+                "AND p.finished IS NOT NULL", (run_id,)).fetchone()
+        return row[0]
+
+    def latest_run(self, repository, statistic=None):
+        """
+        :return: int, ID of the latest finished run of a repository (and statistic), None if none
+        """
+        sql = "SELECT MAX(run_id) FROM runs WHERE repository = ? AND finished IS NOT NULL"
+        params = (repository,)
+        if statistic is not None:
+            sql += " AND statistic = ?"
+            params += (statistic,)
+        with self._lock:
+            return self._connection.execute(sql, params).fetchone()[0]
+
+    def regressions(self, run_id, previous_run_id=None):
+        """
+        :param run_id: int, run checked
+        :param previous_run_id: int, run compared against, default the previous run (see previous_run)
+        :return: dataframe with the facet count and sum of count results that passed in the previous run and
+                 fail in this one. count is the facet count or sum of count, reported the stats API total
+        """
+        if previous_run_id is None:
+            previous_run_id = self.previous_run(run_id)
+        if previous_run_id is None:
+            return pd.DataFrame(columns=["check_name", "repertoire_id", "statistic_name", "key"])
+        return self.query(
+            "SELECT 'facet_count' AS check_name, f.repertoire_id, f.statistic_name, f.key, "
+            "p.facet_count AS previous_count, p.stats_count AS previous_reported, f.facet_count AS count, "
+            "f.stats_count AS reported FROM facet_counts f JOIN facet_counts p ON p.run_id = ? "
+            "AND p.repository = f.repository AND p.repertoire_id = f.repertoire_id "
+            "AND p.statistic_name IS f.statistic_name AND p.key IS f.key "
+            "WHERE f.run_id = ? AND f.passed = 0 AND p.passed = 1 "
+            "UNION ALL "
+            "SELECT 'sum_count', s.repertoire_id, s.statistic_name, NULL, p.sum_count, p.total, s.sum_count, "
+            "s.total FROM sum_counts s JOIN sum_counts p ON p.run_id = ? "
+            "AND p.repository = s.repository AND p.repertoire_id = s.repertoire_id "
+            "AND p.statistic_name IS s.statistic_name "
+            "AND p.sample_processing_id IS s.sample_processing_id "
+            "AND p.data_processing_id IS s.data_processing_id "
+            "WHERE s.run_id = ? AND s.passed = 0 AND p.passed = 1 "
+            "ORDER BY 2, 3, 4", (previous_run_id, run_id, previous_run_id, run_id))
+
+    def endpoint_trend(self, repository, endpoint=None, phase="total", limit=100):
+        """
+        :param repository: string, repository name
+        :param endpoint: string, endpoint path, None for all endpoints
+        :param phase: string, one of timings.PHASES
+        :param limit: int, number of most recent runs
+        :return: dataframe with the latency summary of the endpoint(s) in the most recent runs, oldest first
+        """
+        params = [repository, phase]
+        where = ""
+        if endpoint is not None:
+            where = " AND t.endpoint = ?"
+            params.append(endpoint)
+        params.append(limit)
+        return self.query(
+            "SELECT * FROM (SELECT t.run_id, datetime(r.started, 'unixepoch', 'localtime') AS started, t.endpoint, t.phase, t.count, t.mean, t.p50, t.p95, t.p99 "
+            "FROM timings t JOIN runs r USING (run_id) WHERE t.repository = ? AND t.phase = ?" + where +
+            " ORDER BY t.run_id DESC LIMIT ?) ORDER BY run_id, endpoint", params)
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+
+def import_results(store, repository, statistic, sum_count_path=None, final_count_path=None, failed_path=None,
+                   base_url=None):
+    """
+    Add a run from results files written before the history database was used
+
+    :param store: HistoryStore
+    :param repository: string, repository name
+    :param statistic: string, one of rearrangement_count, junction_length, gene_usage
+    :param sum_count_path: SumCountTotalStat results file, or None
+    :param final_count_path: FinalCount results file, or None
+    :param failed_path: FailedRepertoires results file, or None
+    :param base_url: HTTP address of the repository, if known
+    :return: int, ID of the run, started and finished at the modification time of the files
+    """
+    import result_writer
+
+    # Repertoire IDs are strings even when they look like numbers
+    dtype = {"repertoire_id": str, "RepertoireID(JSON)": str, "sample_processing_id": str,
+             "data_processing_id": str, "key": str}
+    paths = [path for path in (sum_count_path, final_count_path, failed_path) if path is not None]
+    if not paths:
+        raise ValueError("no results file to import")
+    modified = max(os.path.getmtime(path) for path in paths)
+    run_id = store.start_run(repository, base_url, None, statistic, {"imported": paths}, started=modified)
+    if sum_count_path is not None:
+        store.add_sum_count(run_id, result_writer.read_results(sum_count_path, dtype))
+    if final_count_path is not None:
+        store.add_facet_counts(run_id, result_writer.read_results(final_count_path, dtype), statistic)
+    failed = []
+    if failed_path is not None:
+        failed_df = result_writer.read_results(failed_path, dtype)
+        failed = list(zip(failed_df["repertoire_id"], failed_df["reason"]))
+        store.add_failures(run_id, failed)
+    store.finish_run(run_id, "partial" if failed else "ok", finished=modified)
+    return run_id
@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+
+"""
+Incremental parsing of Stats API responses
+
+A Stats API response has the form {"Result": [{"repertoires": {...}, "statistics": [...]}, ...], ...}.
+iter_stats_stream() reads such a response from a binary file object (for example an HTTP response)
+chunk by chunk and yields the items of every Result entry as soon as they are complete, so only one
+statistic needs to be held in memory at a time. iter_stats_json() yields the same items from a
+response that has already been parsed.
+
+Empty Result entries and empty 'statistics' arrays yield no item of their own, so both generators
+yield (result_index, EMPTY, key) for them instead, key being None for an empty entry. Consumers that
+only look at 'repertoires' and 'statistics' ignore these items, a schema validator needs them to know
+that a key was present. For the same reason the keys of the response outside of Result (e.g. Info)
+yield (None, key, value), and Result itself (None, 'Result', None) before its entries.
+"""
+import codecs
+import json
+import re
+
+# Next character of interest outside and inside a JSON string
+_STRUCTURE = re.compile(r'[\[\]{}"]')
+_STRING = re.compile(r'["\\]')
+_WHITESPACE = ' \t\r\n'
+
+# Key of the items marking an empty Result entry or an empty 'statistics' array
+EMPTY = '<empty>'
+
+
+class _StreamReader:
+    # Text buffer over a binary file object. Consumed text is dropped from the
+    # buffer whenever more data is read, so memory is bounded by the largest
+    # single value read plus one chunk.
+
+    def __init__(self, fp, encoding, chunk_size):
+        self.fp = fp
+        self.decoder = codecs.getincrementaldecoder(encoding)()
+        self.chunk_size = chunk_size
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        # Read one more chunk. Returns False at the end of the stream.
+        if self.eof:
+            return False
+        chunk = self.fp.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            text = self.decoder.decode(b'', final=True)
+        else:
+            text = self.decoder.decode(chunk)
+        self.buf = self.buf[self.pos:] + text
+        self.pos = 0
+        return bool(chunk) or bool(text)
+
+    def peek(self):
+        # Return the next non whitespace character without consuming it
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill():
+                raise ValueError("unexpected end of JSON stream")
+
+    def expect(self, char):
+        found = self.peek()
+        if found != char:
+            raise ValueError("expected %r in JSON stream, found %r" % (char, found))
+        self.pos += 1
+
+    def read_value(self):
+        # Parse and consume the next complete JSON value
+        first = self.peek()
+        if first in '{["':
+            end = self._scan_container()
+        else:
+            end = self._scan_scalar()
+        text = self.buf[self.pos:end]
+        self.pos = end
+        return json.loads(text)
+
+    def _scan_container(self):
+        # Find the end of the object, array or string starting at self.pos.
+        # The scan offset is kept relative to self.pos as fill() moves it.
+        offset = 0
+        depth = 0
+        in_string = False
+        while True:
+            buf = self.buf
+            i = self.pos + offset
+            while i < len(buf):
+                if in_string:
+                    match = _STRING.search(buf, i)
+                    if match is None:
+                        i = len(buf)
+                        break
+                    if match.group() == '\\':
+                        # Skip the escaped character
+                        i = match.end() + 1
+                        continue
+                    in_string = False
+                    i = match.end()
+                    if depth == 0:
+                        return i
+                else:
+                    match = _STRUCTURE.search(buf, i)
+                    if match is None:
+                        i = len(buf)
+                        break
+                    char = match.group()
+                    i = match.end()
+                    if char == '"':
+                        in_string = True
+                    elif char in '{[':
+                        depth += 1
+                    else:
+                        depth -= 1
+                        if depth == 0:
+                            return i
+            offset = i - self.pos
+            if not self.fill():
+                raise ValueError("unexpected end of JSON stream")
+
+    def _scan_scalar(self):
+        # Find the end of the number, true, false or null starting at self.pos
+        offset = 0
+        while True:
+            buf = self.buf
+            i = self.pos + offset
+            while i < len(buf):
+                if buf[i] in ',:]}' or buf[i] in _WHITESPACE:
+                    return i
+                i += 1
+            offset = i - self.pos
+            if not self.fill():
+                return len(self.buf)
+
+    def iter_object(self):
+        # Consume an object, yielding each key. The caller must consume the
+        # value of each key before asking for the next one.
+        self.expect('{')
+        first = True
+        while True:
+            if self.peek() == '}':
+                self.pos += 1
+                return
+            if not first:
+                self.expect(',')
+            first = False
+            key = self.read_value()
+            self.expect(':')
+            yield key
+
+    def iter_array(self):
+        # Consume an array, yielding once per element. The caller must
+        # consume each element before asking for the next one.
+        self.expect('[')
+        first = True
+        while True:
+            if self.peek() == ']':
+                self.pos += 1
+                return
+            if not first:
+                self.expect(',')
+            first = False
+            yield
+
+
+def iter_stats_stream(fp, encoding='utf-8', chunk_size=65536):
+    """
+    Incrementally parse a Stats API response
+
+    :param fp: binary file object with the response body, e.g. an HTTP response
+    :param encoding: charset of the response body
+    :param chunk_size: int, number of bytes read at a time
+    :return: generator of (result_index, key, value). For the 'statistics' key of a Result entry
+             one item is yielded per statistic, other keys of the entry yield their whole value.
+             Empty entries and statistics yield (result_index, EMPTY, key), and keys of the
+             response itself (None, key, value), see the module documentation
+    :raises ValueError: if the body is not a Stats API response
+    """
+    reader = _StreamReader(fp, encoding, chunk_size)
+
+    for key in reader.iter_object():
+        if key != 'Result':
+            yield None, key, reader.read_value()
+            continue
+
+        yield None, 'Result', None
+        for index, _ in enumerate(reader.iter_array()):
+            empty_entry = True
+            for entry_key in reader.iter_object():
+                empty_entry = False
+                if entry_key == 'statistics':
+                    empty = True
+                    for _ in reader.iter_array():
+                        empty = False
+                        yield index, 'statistics', reader.read_value()
+                    if empty:
+                        yield index, EMPTY, 'statistics'
+                else:
+                    yield index, entry_key, reader.read_value()
+            if empty_entry:
+                yield index, EMPTY, None
+
+
+def iter_stats_json(json_resp):
+    """
+    Yield the same items as iter_stats_stream from an already parsed Stats API response
+
+    :param json_resp: JSON object with stats API response
+    :return: generator of (result_index, key, value)
+    """
+    entries = json_resp['Result']
+    for key, value in json_resp.items():
+        if key != 'Result':
+            yield None, key, value
+            continue
+
+        yield None, 'Result', None
+        for index, entry in enumerate(entries):
+            if not entry:
+                yield index, EMPTY, None
+            for entry_key, value in entry.items():
+                if entry_key == 'statistics':
+                    if not value:
+                        yield index, EMPTY, 'statistics'
+                    for statistic in value:
+                        yield index, 'statistics', statistic
+                else:
+                    yield index, entry_key, value
@@ -0,0 +1,396 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Open-loop load generation against the Stats API and ADC facet count endpoints
+
+Queries are sent on a fixed schedule at a target arrival rate, whether or not earlier queries have
+answered, from a mix of query kinds:
+
+    count, junction_length, gene_usage    POST /irplus/v1/stats/rearrangement/<kind>
+    facet                                 POST /airr/v1/rearrangement, facet count on repertoire_id
+
+Latency is measured from the time each query was due to be sent, not from when it was actually
+sent. When the node (or this client) falls behind, queries wait for a free connection and that
+wait counts, so the results are not skewed by coordinated omission. Service time, from the actual
+send, is recorded as well to show how much of the latency is queueing.
+
+Latencies go into HDR-style histograms, log-linear buckets with a bounded relative error, one
+per endpoint. Queries are built from the same per-repertoire query files as main(), for repertoire
+IDs enumerated from the ADC API.
+"""
+import argparse
+import collections
+import itertools
+import json
+import math
+import os
+import random
+import threading
+import time
+import urllib.error
+from concurrent.futures import ThreadPoolExecutor
+
+import cli
+import curlairripa
+import timings
+
+STATS_KINDS = ("count", "junction_length", "gene_usage")
+KINDS = STATS_KINDS + ("facet",)
+# Seconds a query may be dispatched after its intended time before the load generator counts as saturated
+LATE_WARNING = 0.01
+
+
+class LatencyHistogram:
+    """
+    HDR-style histogram of latencies. Values are counted in log-linear buckets: exact below
+    2 * 10^digits microseconds, and above that each power of two is split into 10^digits or more
+    sub-buckets, so any value is reported within 10^-digits of its true value, at constant memory
+    """
+
+    def __init__(self, digits=2):
+        """
+        :param digits: int, number of significant decimal digits kept
+        """
+        self.digits = digits
+        self._sub_bits = int(math.ceil(math.log2(2 * 10 ** digits)))
+        self._sub_count = 1 << self._sub_bits
+        self._half = self._sub_count >> 1
+        # bucket index -> count
+        self._counts = collections.Counter()
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def _index(self, value):
+        # Bucket of a value in microseconds
+        if value < self._sub_count:
+            return value
+        shift = value.bit_length() - self._sub_bits
+        return self._sub_count + (shift - 1) * self._half + (value >> shift) - self._half
+
+    def _highest(self, index):
+        # Largest value in microseconds counted in a bucket
+        if index < self._sub_count:
+            return index
+        shift = (index - self._sub_count) // self._half + 1
+        top = (index - self._sub_count) % self._half + self._half
+        return ((top + 1) << shift) - 1
+
+    def record(self, seconds):
+        """
+        :param seconds: float, latency
+        """
+        value = max(int(round(seconds * 1e6)), 0)
+        self._counts[self._index(value)] += 1
+        self.count += 1
+        self.total += seconds
+        self.min = seconds if self.min is None else min(self.min, seconds)
+        self.max = seconds if self.max is None else max(self.max, seconds)
+
+    def merge(self, other):
+        """
+        :param other: LatencyHistogram with the same digits, added to this one
+        """
+        self._counts.update(other._counts)
+        self.count += other.count
+        self.total += other.total
+        for value in (other.min, other.max):
+            if value is not None:
+                self.min = value if self.min is None else min(self.min, value)
+                self.max = value if self.max is None else max(self.max, value)
+
+    def percentile(self, fraction):
+        """
+        :param fraction: float between 0 and 1
+        :return: float, seconds below which fraction of the latencies fall. None if empty
+        """
+        if not self.count:
+            return None
+        rank = max(int(math.ceil(fraction * self.count)), 1)
+        seen = 0
+        for index in sorted(self._counts):
+            seen += self._counts[index]
+            if seen >= rank:
+                return min(self._highest(index) / 1e6, self.max)
+        return self.max
+
+    def summary(self, fractions=(0.5, 0.9, 0.99, 0.999)):
+        """
+        :return: dict with count, mean, max and p50, p90, p99, p99.9 in seconds
+        """
+        summary = {"count": self.count, "mean": self.total / self.count if self.count else None,
+                   "max": self.max}
+        for fraction in fractions:
+            summary["p%g" % (100 * fraction)] = self.percentile(fraction)
+        return summary
+
+    def to_dict(self):
+        """
+        :return: dict with the summary and the non-empty buckets as [highest value in seconds, count]
+        """
+        return dict(self.summary(), digits=self.digits,
+                    buckets=[[self._highest(index) / 1e6, self._counts[index]] for index in sorted(self._counts)])
+
+
+class EndpointStats:
+
+    def __init__(self, digits=2):
+        # Latency from the intended send time, and service time from the actual send time
+        self.latency = LatencyHistogram(digits)
+        self.service = LatencyHistogram(digits)
+        # Status code (or exception name) -> count, for queries that failed
+        self.errors = collections.Counter()
+        self.first_done = None
+        self.last_done = None
+
+    def record(self, latency, service, done_time, status=None):
+        self.latency.record(latency)
+        self.service.record(service)
+        if status is not None:
+            self.errors[str(status)] += 1
+        self.first_done = done_time if self.first_done is None else min(self.first_done, done_time)
+        self.last_done = done_time if self.last_done is None else max(self.last_done, done_time)
+
+    def summary(self, window):
+        """
+        :param window: float, seconds of the measurement window, throughput is computed over it
+        :return: dict with the latency and service time summaries, errors and throughput
+        """
+        ok = self.latency.count - sum(self.errors.values())
+        return {"latency": self.latency.to_dict(), "service": self.service.summary(),
+                "errors": dict(self.errors), "ok": ok,
+                "throughput": ok / window if window > 0 else None}
+
+
+def parse_mix(mix):
+    """
+    :param mix: string, comma-separated kind=weight, e.g. "count=5,gene_usage=1,facet=2"
+    :return: dict kind -> float weight
+    """
+    weights = {}
+    for item in mix.split(","):
+        kind, _, weight = item.partition("=")
+        kind = kind.strip()
+        if kind not in KINDS:
+            raise ValueError("unknown query kind " + repr(kind) + ", expected one of " + ", ".join(KINDS))
+        weights[kind] = float(weight) if weight else 1.0
+    if not weights or sum(weights.values()) <= 0:
+        raise ValueError("the query mix needs a positive weight")
+    return weights
+
+
+def query_url_of(base_url, kind):
+    """
+    :return: URL queries of a kind are sent to
+    """
+    if kind == "facet":
+        return base_url + "/airr/v1/" + "rearrangement"
+    return base_url + "/irplus/v1/stats/rearrangement/" + kind
+
+
+def load_queries(rep_ids, kinds, relative_path_stats=None, relative_path_facet=None):
+    """
+    Read the query of every repertoire once, before the run, so that no file is read while load
+    is generated
+
+    :param rep_ids: list of repertoire IDs
+    :param kinds: query kinds used
+    :param relative_path_stats: path prefix of the per-repertoire stats API query files, as for main().
+                                Repertoires without a file get the query main() would build
+    :param relative_path_facet: path prefix of the per-repertoire facet count query files
+    :return: dict (kind is 'facet', repertoire ID) -> query dict
+    """
+    queries = {}
+    for repertoire_id in rep_ids:
+        repertoire_id = str(repertoire_id)
+        if any(kind in STATS_KINDS for kind in kinds):
+            path = (relative_path_stats or "") + repertoire_id + ".json"
+            if relative_path_stats and os.path.exists(path):
+                query_dict = curlairripa.process_json_files(False, False, path)
+            else:
+                query_dict = {"repertoires": [{"repertoire": {"repertoire_id": repertoire_id}}]}
+            queries[(False, repertoire_id)] = query_dict
+        if "facet" in kinds:
+            path = (relative_path_facet or "") + repertoire_id + ".json"
+            if relative_path_facet and os.path.exists(path):
+                query_dict = curlairripa.process_json_files(False, False, path)
+            else:
+                query_dict = {"filters": {"op": "=", "content": {"field": "repertoire_id", "value": repertoire_id}},
+                              "facets": "repertoire_id"}
+            queries[(True, repertoire_id)] = query_dict
+    return queries
+
+
+def arrival_offsets(rate, duration, poisson=False, seed=0):
+    """
+    :param rate: float, queries per second
+    :param duration: float, seconds
+    :param poisson: bool, if True arrivals are a Poisson process, otherwise evenly spaced
+    :return: generator of send times in seconds from the start of the run
+    """
+    rng = random.Random(seed)
+    offset = 0.0
+    while offset < duration:
+        yield offset
+        offset += rng.expovariate(rate) if poisson else 1.0 / rate
+
+
+def run_load(base_url, rep_ids, mix, rate, duration, warmup=0.0, poisson=False, max_in_flight=256,
+             relative_path_stats=None, relative_path_facet=None, connect_timeout=10.0, read_timeout=60.0,
+             digits=2, seed=0):
+    """
+    Send queries at a target arrival rate and measure their latency from their intended send time
+
+    :param base_url: HTTP address of the node
+    :param rep_ids: list of repertoire IDs queries are picked from
+    :param mix: dict kind -> weight, see parse_mix
+    :param rate: float, target queries per second, over all kinds
+    :param duration: float, seconds of the measured run
+    :param warmup: float, seconds of load sent before the measured run and not recorded
+    :param poisson: bool, if True arrivals are a Poisson process, otherwise evenly spaced
+    :param max_in_flight: int, maximum number of queries in flight, later ones wait and the wait counts
+                          in their latency
+    :param relative_path_stats: path prefix of the per-repertoire stats API query files
+    :param relative_path_facet: path prefix of the per-repertoire facet count query files
+    :param connect_timeout: float, seconds allowed to open a connection
+    :param read_timeout: float, seconds allowed for each wait for data, longer queries count as errors
+    :param digits: int, significant digits of the latency histograms
+    :param seed: int, random seed of the query mix and arrivals
+    :return: dict with the run settings, 'endpoints' with an EndpointStats summary per endpoint and
+             'total' with all endpoints merged
+    """
+    if not rep_ids:
+        raise ValueError("no repertoire to query")
+    rep_ids = [str(i) for i in rep_ids]
+    kinds = list(mix)
+    weights = [mix[kind] for kind in kinds]
+    queries = load_queries(rep_ids, kinds, relative_path_stats, relative_path_facet)
+    urls = {kind: query_url_of(base_url, kind) for kind in kinds}
+
+    # A connection per query in flight, no retries: failures are results of the test
+    client = curlairripa.HTTPClient(max_idle_connections=max_in_flight, connect_timeout=connect_timeout,
+                                    read_timeout=read_timeout)
+    stats = {kind: EndpointStats(digits) for kind in kinds}
+    lock = threading.Lock()
+    rng = random.Random(seed)
+    late = LatencyHistogram(digits)
+
+    def send(kind, query_dict, intended, measured):
+        sent = time.perf_counter()
+        status = None
+        try:
+            curlairripa.processQuery(urls[kind], client.header_dict, True, query_dict, client=client,
+                                     raise_errors=True)
+        except urllib.error.HTTPError as e:
+            status = e.code
+        except Exception as e:
+            status = type(e).__name__
+        done = time.perf_counter()
+        if measured:
+            with lock:
+                stats[kind].record(done - intended, done - sent, done, status)
+
+    start = time.perf_counter()
+    measure_start = start + warmup
+    print("Sending %.1f queries per second for %.0f s (+%.0f s warm-up) to %s" % (rate, duration, warmup, base_url))
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        for offset in arrival_offsets(rate, warmup + duration, poisson, seed):
+            intended = start + offset
+            delay = intended - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                # The dispatcher itself fell behind, the query still counts from its intended time
+                late.record(-delay)
+            kind = rng.choices(kinds, weights)[0]
+            query_dict = queries[(kind == "facet", rng.choice(rep_ids))]
+            executor.submit(send, kind, query_dict, intended, intended >= measure_start)
+    client.close()
+
+    window = max(max([s.last_done for s in stats.values() if s.last_done is not None], default=measure_start)
+                 - measure_start, duration)
+    total = EndpointStats(digits)
+    for endpoint_stats in stats.values():
+        total.latency.merge(endpoint_stats.latency)
+        total.service.merge(endpoint_stats.service)
+        total.errors.update(endpoint_stats.errors)
+    return {"base_url": base_url, "rate": rate, "duration": duration, "warmup": warmup, "poisson": poisson,
+            "mix": mix, "max_in_flight": max_in_flight, "window": window,
+            "dispatch_late": late.summary(),
+            "endpoints": {timings.endpoint_of(urls[kind]): stats[kind].summary(window) for kind in kinds},
+            "total": total.summary(window)}
+
+
+def print_report(report):
+    """
+    Print throughput, errors and latency percentiles per endpoint
+    """
+    def ms(value):
+        return "-" if value is None else "%.1f" % (1000 * value)
+
+    print("LOAD TEST RESULTS, latency from intended send time (in ms)")
+    print("%-48s %8s %8s %8s %8s %8s %8s %8s %9s" % ("endpoint", "count", "errors", "qps", "p50", "p90", "p99",
+                                                   "p99.9", "max"))
+    rows = list(report["endpoints"].items()) + [("total", report["total"])]
+    for endpoint, summary in rows:
+        latency = summary["latency"]
+        print("%-48s %8d %8d %8.1f %8s %8s %8s %8s %9s" % (endpoint, latency["count"], sum(summary["errors"].values()),
+                                                         summary["throughput"] or 0, ms(latency["p50"]),
+                                                         ms(latency["p90"]), ms(latency["p99"]),
+                                                         ms(latency["p99.9"]), ms(latency["max"])))
+        if summary["errors"]:
+            print("    errors:", ", ".join("%s x%d" % item for item in sorted(summary["errors"].items())))
+    service = report["total"]["service"]
+    print("Service time from actual send, all endpoints: p50 %s ms, p99 %s ms" % (ms(service["p50"]),
+                                                                                 ms(service["p99"])))
+    late = report["dispatch_late"]
+    if late["count"] and late["max"] > LATE_WARNING:
+        print("WARNING: %d queries were dispatched late (max %s ms), the load generator is saturated"
+              % (late["count"], ms(late["max"])))
+    print("------------------------------------------------------")
+
+
+def getArguments():
+    """
+    This function facilitates reading parameters, the same as the load subcommand of cli
+
+    """
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description="Open-loop load test of the Stats API and facet count endpoints"
+    )
+    cli.add_load_arguments(parser)
+    return parser.parse_args()
+
+
+def main(options=None):
+    if options is None:
+        options = getArguments()
+
+    if options.repertoire_ids:
+        rep_ids = options.repertoire_ids
+    else:
+        # Same repertoire enumeration as main(), pandas is only needed for it
+        import main as validation
+        # Enumeration stops at the page holding the last repertoire needed
+        rep_ids = list(itertools.islice(validation.iter_repertoire_ids(options.base_url + "/airr/v1/" + "repertoire",
+                                                                       options.adc_json_files, options.page_size),
+                                        options.max_repertoires or None))
+    print("Load test over", len(rep_ids), "repertoires")
+
+    report = run_load(options.base_url, rep_ids, parse_mix(options.mix), options.rate, options.duration,
+                      options.warmup, options.poisson, options.max_in_flight, options.stats_json_files,
+                      options.facet_json_files, options.connect_timeout, options.read_timeout,
+                      seed=options.seed)
+    print_report(report)
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print("Results written to", options.output)
+    return 1 if sum(report["total"]["errors"].values()) else 0
+
+
+if __name__ == "__main__":
+    main()
@@ -9,22 +9,137 @@
 Validating Stats API schema against JSON response
 """
 import curlairripa
+import jsonstream
+import ratelimit
+import hedging
+import response_cache
+import timings
+import checkpoint
+import result_writer
+import schema_validator
+import histograms
+import history
+import profiling
+import cli
 import pandas as pd
-import airr
+import numpy as np
 import argparse
 import time
+import collections
 import yaml
 import json
-import sys
-from xlrd import open_workbook, XLRDError
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Values of the has_data flag returned by flatten_stats_response
+NO_DATA = 0
+NO_COUNT = 1
+HAS_COUNT = 2
+
+# Entry points whose statistics' data is kept when responses are streamed, it is compared
+# against facet counts (gene_usage) or checked as a histogram (junction_length)
+DATA_STATISTICS = ("gene_usage", "junction_length")
+
+# Suffixes of gene_usage statistic names, removed to get the ADC field they count
+GENE_USAGE_SUFFIXES = ("_unique",)
+
+
+def flatten_stats_items(items, keep_data=True):
+    """
+    Flatten the items of a stats API response into columnar arrays in a single pass
+
+    :param items: iterable of (result_index, key, value) as produced by jsonstream.iter_stats_json or
+                  jsonstream.iter_stats_stream
+    :param keep_data: bool, if False the data of each statistic is reduced to its sum of count and
+                      not kept, so memory does not grow with the size of the response
+    :return: dict of columns, one entry per statistic: repertoire_id, sample_processing_id,
+             data_processing_id, statistic_name, total, data (lists) and sum_count, has_data (numpy arrays).
+             has_data is NO_DATA if the statistic has no data, NO_COUNT if its data has no count
+             and HAS_COUNT otherwise
+    """
+    repertoires = {}
+    entry_index = []
+    statistic_name = []
+    total = []
+    data = []
+    sum_count = []
+    has_data = []
+
+    for index, key, value in items:
+        # Keys of the response itself, e.g. Info
+        if index is None:
+            continue
+        # The repertoire of an entry may come before or after its statistics
+        if key == 'repertoires':
+            repertoires[index] = value
+            continue
+        if key != 'statistics':
+            continue
+
+        entry_index.append(index)
+        statistic_name.append(value.get('statistic_name'))
+        total.append(value.get('total'))
+
+        stat_data = value.get('data')
+        data.append(stat_data if keep_data else None)
+        if not isinstance(stat_data, list):
+            sum_count.append(0)
+            has_data.append(NO_DATA)
+            continue
+
+        counts = [item['count'] for item in stat_data if 'count' in item]
+        if counts:
+            sum_count.append(sum(counts))
+            has_data.append(HAS_COUNT)
+        else:
+            sum_count.append(-1)
+            has_data.append(NO_COUNT)
+
+    entry_repertoires = [repertoires.get(index, {}) for index in entry_index]
+
+    return {"repertoire_id": [repertoire.get('repertoire_id') for repertoire in entry_repertoires],
+            "sample_processing_id": [repertoire.get('sample_processing_id') for repertoire in entry_repertoires],
+            "data_processing_id": [repertoire.get('data_processing_id') for repertoire in entry_repertoires],
+            "statistic_name": statistic_name,
+            "total": total,
+            "data": data,
+            "sum_count": np.array(sum_count, dtype=np.int64),
+            "has_data": np.array(has_data, dtype=np.int8)}
+
+
+def flatten_stats_response(json_resp):
+    """
+    Flatten a parsed stats API response into columnar arrays, see flatten_stats_items
+
+    :param json_resp: JSON object with stats API response
+    :return: dict of columns, one entry per statistic
+    """
+    return flatten_stats_items(jsonstream.iter_stats_json(json_resp))
 
 
 class ApiStats:
 
-    def __init__(self, yaml_f, json_resp, facet_ct):
+    def __init__(self, yaml_f, json_resp, facet_ct, flat=None):
         self.yaml_f = yaml_f
         self.json_resp = json_resp
         self.facet_ct = facet_ct
+        # Columnar view of json_resp. Can be given directly when the response
+        # was parsed as a stream (see execute_query_stream)
+        self._flat = flat
+
+    def flatten(self):
+        """
+        Returns
+        -------
+        dict
+            columnar view of the json response, see flatten_stats_response.
+            Computed once per instance.
+
+        """
+        if self._flat is None:
+            self._flat = flatten_stats_response(self.json_resp)
+        return self._flat
 
     def load_yaml_schema(self):
         """
@@ -52,6 +167,7 @@ class ApiStats:
         except:
             print("Could not read YAML file")
 
+    @profiling.profiled("aggregation")
     def get_total_count(self):
         """
 
@@ -62,26 +178,22 @@ class ApiStats:
 
         """
         try:
-            all_df = []
-            data_json = self.json_resp
-
-            ids_ = pd.json_normalize(data_json['Result'])
+            flat = self.flatten()
+            if not flat['statistic_name']:
+                raise ValueError("no statistics in json response")
 
-            for entry in range(ids_.shape[0]):
-                df = pd.json_normalize(data_json['Result'][entry]['statistics'])
-
-                df['repertoire_id'] = ids_['repertoires.repertoire_id'].values[entry]
-                df['sample_processing_id'] = ids_['repertoires.sample_processing_id'].values[entry]
-                df['data_processing_id'] = ids_['repertoires.data_processing_id'].values[entry]
-
-                all_df.append(df)
-
-            return pd.concat(all_df)
+            return pd.DataFrame({"statistic_name": flat['statistic_name'],
+                                 "total": flat['total'],
+                                 "data": flat['data'],
+                                 "repertoire_id": flat['repertoire_id'],
+                                 "sample_processing_id": flat['sample_processing_id'],
+                                 "data_processing_id": flat['data_processing_id']})
 
         except:
             print("Could not find entries in json response")
             return pd.DataFrame({})
 
+    @profiling.profiled("aggregation")
     def get_sum_count(self, original_count_df):
         """
 
@@ -105,31 +217,18 @@ class ApiStats:
 
             total_count_df = original_count_df
 
-            data_json = self.json_resp
-
-            for i in range(total_count_df.shape[0]):
-                reported_total = total_count_df.iloc[i, :]['total']
-                sub_data = pd.json_normalize(data_json['Result'][0]['statistics'][i])
-                # print(sub_data.columns)
-                if 'data' not in sub_data.columns:
-                    total_count_df.loc[i, 'SumOfCounts(StatsAPI)'] = 0
-                    total_count_df.loc[i, 'ResultSum'] = 0
-                    continue
-                else:
-                    sub_data = pd.json_normalize(data_json['Result'][0]['statistics'][i]['data'])
+            # Rows of get_total_count follow the statistics of every Result entry in order
+            flat = self.flatten()
+            has_data = flat['has_data']
+            sum_count = flat['sum_count']
 
-                    if "count" in sub_data.columns:
-                        sum_count = sub_data['count'].sum()
-                        total_count_df.loc[i, 'SumOfCounts(StatsAPI)'] = int(sum_count)
+            # Statistics without data report 0, statistics without count report -1
+            result_sum = np.array(total_count_df['total'].values == sum_count, dtype=object)
+            result_sum[has_data == NO_DATA] = 0
+            result_sum[has_data == NO_COUNT] = -1
 
-                        if reported_total == sum_count:
-                            total_count_df.loc[i, 'ResultSum'] = True
-                        else:
-                            total_count_df.loc[i, 'ResultSum'] = False
-                    else:
-                        # print(total_count_df)
-                        total_count_df.loc[i, 'SumOfCounts(StatsAPI)'] = -1
-                        total_count_df.loc[i, 'ResultSum'] = -1
+            total_count_df['SumOfCounts(StatsAPI)'] = sum_count
+            total_count_df['ResultSum'] = result_sum
 
             return total_count_df
         except:
@@ -162,6 +261,234 @@ def validate_md_json_fields(base_url, query_files):
     return result_suite
 
 
+def bulk_facet_counts(base_url, rep_ids=None):
+    """
+    Perform a single facet count on repertoire_id for all repertoires, instead of one
+    facet count query per repertoire
+
+    :param base_url: string with entry point where query will be performed (URL), facet count
+    :param rep_ids: list of repertoire IDs to filter on. If None, the query is unfiltered
+    :return: dataframe object with facet count results indexed by repertoire_id, column FacetCountAPI
+    """
+    query_dict = {"facets": "repertoire_id"}
+    if rep_ids is not None:
+        query_dict["filters"] = {"op": "in",
+                                 "content": {"field": "repertoire_id", "value": [str(i) for i in rep_ids]}}
+
+    query_url = base_url + "/airr/v1/" + "rearrangement"
+    json_data = execute_query(query_url, query_dict)
+
+    fac_count = pd.DataFrame(json_data["Facet"], columns=["repertoire_id", "count"])
+    fac_count = fac_count.rename(columns={"count": "FacetCountAPI"})
+    fac_count["repertoire_id"] = fac_count["repertoire_id"].astype(str)
+
+    return fac_count.set_index("repertoire_id")
+
+
+@profiling.profiled("facet")
+def compare_facet_counts(rep_ids, stats_api_ct, facet_counts, stats_name):
+    """
+    Join facet counts against stats API totals for all repertoires in one merge
+
+    :param rep_ids: list of repertoire IDs that were queried
+    :param stats_api_ct: dataframe with the concatenated output of ApiStats.get_total_count for all repertoires
+    :param facet_counts: dataframe resulting from bulk_facet_counts
+    :param stats_name: string, one of rearrangement_count, junction_length
+    :return: dataframe with columns RepertoireID(JSON), FacetCountAPI, StatsAPICount, Result.
+             Repertoires missing from the facet response get FacetCountAPI -1
+    """
+    stats_of_interest = stats_api_ct[stats_api_ct["statistic_name"] == stats_name]
+    stats_of_interest = stats_of_interest[["repertoire_id", "total"]].rename(columns={"total": "StatsAPICount"})
+    stats_of_interest = stats_of_interest.astype({"repertoire_id": str})
+
+    result = pd.DataFrame({"RepertoireID(JSON)": [str(i) for i in rep_ids]})
+    result = result.merge(facet_counts, how="left", left_on="RepertoireID(JSON)", right_index=True)
+    result = result.merge(stats_of_interest, how="left", left_on="RepertoireID(JSON)", right_on="repertoire_id")
+    result = result.drop(columns="repertoire_id")
+
+    result["FacetCountAPI"] = result["FacetCountAPI"].fillna(-1).astype(int)
+    result["Result"] = result["FacetCountAPI"].values == result["StatsAPICount"].values
+
+    return result
+
+
+def gene_usage_field(statistic_name):
+    """
+    :param statistic_name: string, name of a gene_usage statistic, e.g. v_gene_unique
+    :return: string, ADC rearrangement field the statistic counts, e.g. v_gene
+    """
+    for suffix in GENE_USAGE_SUFFIXES:
+        if statistic_name.endswith(suffix):
+            return statistic_name[:-len(suffix)]
+    return statistic_name
+
+
+@profiling.profiled("facet")
+def gene_usage_counts(stats_api_ct):
+    """
+    Explode the data of gene_usage statistics into one row per gene
+
+    :param stats_api_ct: dataframe resulting from ApiStats.get_total_count, with its data column
+    :return: dataframe with columns repertoire_id, statistic_name, field, key, StatsAPICount
+    """
+    stats = stats_api_ct[["repertoire_id", "statistic_name", "data"]].explode("data")
+    stats = stats[stats["data"].notna()]
+    values = pd.DataFrame.from_records(stats["data"].tolist(), columns=["key", "count"])
+
+    return pd.DataFrame({"repertoire_id": stats["repertoire_id"].astype(str).values,
+                         "statistic_name": stats["statistic_name"].values,
+                         "field": stats["statistic_name"].map(gene_usage_field).values,
+                         "key": values["key"].astype(str).values,
+                         "StatsAPICount": values["count"].values})
+
+
+def gene_facet_counts(base_url, repertoire_id, fields):
+    """
+    Facet count of every value of each field for one repertoire, one query per field
+
+    :param base_url: string with entry point where query will be performed (URL), facet count
+    :param repertoire_id: ID uniquely identifying repertoire
+    :param fields: list of ADC rearrangement fields, e.g. v_call, v_gene
+    :return: dataframe with columns repertoire_id, field, key, FacetCountAPI. Rearrangements
+             without a value for the field are not counted. Fields whose query failed are
+             missing
+    """
+    query_url = base_url + "/airr/v1/" + "rearrangement"
+    facets = []
+    for field in fields:
+        query_dict = {"filters": {"op": "=", "content": {"field": "repertoire_id", "value": str(repertoire_id)}},
+                      "facets": field}
+        json_data = execute_query(query_url, query_dict)
+        if json_data is None or "Facet" not in json_data:
+            print("Facet count query failed for", field, "of repertoire", repertoire_id)
+            continue
+        facet = pd.DataFrame(json_data["Facet"], columns=[field, "count"])
+        facet = facet[facet[field].notna()]
+        facets.append(pd.DataFrame({"repertoire_id": str(repertoire_id), "field": field,
+                                    "key": facet[field].astype(str).values,
+                                    "FacetCountAPI": facet["count"].values}))
+
+    if not facets:
+        return pd.DataFrame(columns=["repertoire_id", "field", "key", "FacetCountAPI"])
+    return pd.concat(facets, ignore_index=True)
+
+
+@profiling.profiled("facet")
+def compare_gene_usage(stats_counts, facet_counts):
+    """
+    Join gene_usage statistics against facet counts on (repertoire, field, gene) in one merge
+
+    :param stats_counts: dataframe resulting from gene_usage_counts
+    :param facet_counts: dataframe resulting from gene_facet_counts
+    :return: dataframe with columns RepertoireID(JSON), statistic_name, field, key, FacetCountAPI,
+             StatsAPICount, Result. A gene reported by only one side counts 0 on the other. Fields
+             without facet counts get FacetCountAPI -1
+    """
+    merged = stats_counts.merge(facet_counts, how="outer", on=["repertoire_id", "field", "key"])
+
+    # Genes only found by the facet count belong to every statistic on their field
+    statistic_names = stats_counts[["repertoire_id", "field", "statistic_name"]].drop_duplicates()
+    missing_name = merged["statistic_name"].isna()
+    if missing_name.any():
+        facet_only = merged[missing_name].drop(columns="statistic_name").merge(
+            statistic_names, how="left", on=["repertoire_id", "field"])
+        merged = pd.concat([merged[~missing_name], facet_only], ignore_index=True)
+
+    faceted = merged["field"].isin(facet_counts["field"].unique())
+    merged["StatsAPICount"] = merged["StatsAPICount"].fillna(0).astype(np.int64)
+    merged["FacetCountAPI"] = merged["FacetCountAPI"].fillna(0).astype(np.int64)
+    merged.loc[~faceted, "FacetCountAPI"] = -1
+    merged["Result"] = merged["FacetCountAPI"].values == merged["StatsAPICount"].values
+
+    merged = merged.rename(columns={"repertoire_id": "RepertoireID(JSON)"})
+    return merged[["RepertoireID(JSON)", "statistic_name", "field", "key", "FacetCountAPI", "StatsAPICount",
+                   "Result"]].sort_values(["statistic_name", "key"], kind="mergesort").reset_index(drop=True)
+
+
+def verify_gene_usage(facet_url, stats_api_ct, repertoire_id):
+    """
+    Compare every gene_usage statistic of a repertoire with facet counts on the matching field
+
+    :param facet_url: URL entry point for facet count
+    :param stats_api_ct: dataframe resulting from ApiStats.get_total_count for the repertoire,
+                         with its data column
+    :param repertoire_id: ID uniquely identifying repertoire
+    :return: dataframe resulting from compare_gene_usage
+    """
+    stats_counts = gene_usage_counts(stats_api_ct)
+    fields = list(stats_counts["field"].unique())
+    print("Facet count query for", ", ".join(fields))
+    facet_counts = gene_facet_counts(facet_url, repertoire_id, fields)
+    result = compare_gene_usage(stats_counts, facet_counts)
+
+    mismatches = result[~result["Result"]]
+    print("GENE USAGE TEST RESULT---->", mismatches.empty, "(%d of %d genes differ)" % (mismatches.shape[0],
+                                                                                       result.shape[0]))
+    if not mismatches.empty:
+        print(mismatches)
+
+    return result
+
+
+def junction_facet_counts(base_url, rep_ids, field, max_workers=1):
+    """
+    Facet count of every length of a junction field, one query per repertoire
+
+    :param base_url: string with entry point where query will be performed (URL), facet count
+    :param rep_ids: list of repertoire IDs
+    :param field: string, junction_length or junction_aa_length
+    :param max_workers: int, number of queries performed at the same time
+    :return: dict repertoire ID -> list of facet count entries, repertoires whose query failed are missing
+    """
+    query_url = base_url + "/airr/v1/" + "rearrangement"
+
+    def facet(repertoire_id):
+        query_dict = {"filters": {"op": "=", "content": {"field": "repertoire_id", "value": str(repertoire_id)}},
+                      "facets": field}
+        return execute_query(query_url, query_dict)
+
+    facets = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for repertoire_id, json_data in zip(rep_ids, executor.map(facet, rep_ids)):
+            if json_data is None or "Facet" not in json_data:
+                print("Facet count query failed for", field, "of repertoire", repertoire_id)
+                continue
+            facets[str(repertoire_id)] = json_data["Facet"]
+    return facets
+
+
+def check_junction_histograms(histogram_set, facet_url=None, max_workers=1):
+    """
+    Check the junction length histograms of all repertoires at once
+
+    :param histogram_set: histograms.HistogramSet with the statistics of every repertoire
+    :param facet_url: URL entry point for facet count. If given, every statistic is also compared
+                      bin by bin against facet counts on the field of the same name
+    :param max_workers: int, number of facet count queries performed at the same time
+    :return: dataframe with one row per repertoire and statistic, see histograms.check_matrix
+    """
+    facet_matrices = {}
+    if facet_url is not None:
+        for statistic_name in histogram_set.statistic_names:
+            rep_ids = histogram_set.repertoire_ids(statistic_name)
+            if not rep_ids:
+                continue
+            print("Facet count query on", statistic_name, "for", len(rep_ids), "repertoires")
+            facets = junction_facet_counts(facet_url, rep_ids, statistic_name, max_workers)
+            facet_matrices[statistic_name] = histograms.facet_matrix(facets, statistic_name,
+                                                                     histogram_set.max_length)
+
+    start_time = time.perf_counter()
+    checks = histogram_set.check(facet_matrices)
+    print("Checked", checks.shape[0], "histograms in %.3f seconds" % (time.perf_counter() - start_time))
+    failed = checks[~checks["Result"].astype(bool)]
+    print("HISTOGRAM TEST RESULT---->", failed.empty, "(%d of %d histograms fail)" % (failed.shape[0],
+                                                                                    checks.shape[0]))
+    if not failed.empty:
+        print(failed)
+    return checks
+
+
 def read_file(path_to_file):
     """
     :param path_to_file:  (str) path to JSON file
@@ -179,6 +506,16 @@ def read_file(path_to_file):
         print("WARNING: check entry points and urls are valid. \nCould not parse json response")
 
 
+@functools.lru_cache(maxsize=None)
+def components_schema():
+    """
+    :return: AIRR components schema, loaded once and shared by the validators below
+    """
+    # airr is slow to import, only runs that validate against the AIRR schema load it
+    import airr
+    return airr.schema.Schema("components")
+
+
 def validate_headers(item_to_val):
     """
         This function uses AIRR's schema header validator function (see library import comment on version)
@@ -187,10 +524,11 @@ def validate_headers(item_to_val):
     :return: None
     """
 
-    iterate_over = airr.schema.Schema("components").definition[item_to_val].keys()
+    schema = components_schema()
+    iterate_over = schema.definition[item_to_val].keys()
 
     for item in iterate_over:
-        print(item, airr.schema.Schema("components").validate_header(item))
+        print(item, schema.validate_header(item))
 
 
 def validate_rows(item_to_val):
@@ -201,11 +539,11 @@ def validate_rows(item_to_val):
     :return: None
     """
 
-    rows = airr.schema.Schema("components").definition[item_to_val].keys()
+    schema = components_schema()
+    rows = schema.definition[item_to_val].keys()
 
     for row in rows:
-        print(row, airr.schema.Schema("components").validate_row(
-            airr.schema.Schema("components").definition[item_to_val][row]))
+        print(row, schema.validate_row(schema.definition[item_to_val][row]))
 
 
 def validate_objects(item_to_val):
@@ -215,15 +553,16 @@ def validate_objects(item_to_val):
     :param item_to_val: (str): either 'schemas' or 'responses' are valid options
     :return: None
     """
-    objects = airr.schema.Schema("components").definition[item_to_val].keys()
+    schema = components_schema()
+    objects = schema.definition[item_to_val].keys()
 
     for obj in objects:
         print("Object", obj)
-        print("Result", airr.schema.Schema("components").validate_object(
-            airr.schema.Schema("components").definition[item_to_val][obj]))
+        print("Result", schema.validate_object(schema.definition[item_to_val][obj]))
         print("---")
 
 
+@profiling.profiled("validation")
 def select_validator(validator_choice):
     """
     :param validator_choice: (string) One of 'None','headers','row','objects'
@@ -253,11 +592,54 @@ def select_validator(validator_choice):
         print("Error: verify you are validating a stats API schema")
 
 
-def execute_query(query_url, query_files):
+@profiling.profiled("validation")
+def check_stats_response(stats_url, json_resp):
+    """
+    Validate a stats API response against the Stats API schema, if a default validator is set
+
+    :param stats_url: URL entry point for stats API the response came from
+    :param json_resp: JSON object with stats API response, None is ignored
+    :return: None, violations are kept by the validator
+    """
+    validator = schema_validator.get_default_validator()
+    if validator is not None and json_resp is not None:
+        validator.check_response(json_resp, stats_url)
+
+
+def check_stats_items(stats_url, items):
+    """
+    :param stats_url: URL entry point for stats API the response came from
+    :param items: iterable of (result_index, key, value) of a response parsed as a stream
+    :return: items, validated against the Stats API schema as they are consumed if a default
+             validator is set
+    """
+    validator = schema_validator.get_default_validator()
+    if validator is None:
+        return items
+    return validator.check_items(items, stats_url)
+
+
+def report_violations(violations):
+    """
+    :param violations: list of violations returned by schema_validator.StatsResponseValidator
+    :return: None
+    """
+    for violation in violations:
+        print("SCHEMA VIOLATION:", violation["repertoire_id"], violation["statistic_name"], violation["path"],
+              violation["message"])
+
+
+def execute_query(query_url, query_files, client=None, cache=None, recorder=None):
     """
 
     :param query_url: string, entry point on which we perform query (URL)
-    :param query_files: JSON file with query input parameters
+    :param query_files: JSON file with query input parameters, or dict with the query itself
+    :param client: curlairripa.HTTPClient used to perform the query. Defaults to the shared
+                   client, which keeps connections alive between queries
+    :param cache: response_cache.ResponseCache consulted before and filled after the query.
+                  Defaults to response_cache.get_default_cache()
+    :param recorder: timings.TimingRecorder the time spent in each phase of the query is recorded in.
+                     Defaults to timings.get_default_recorder()
     :return: parsed_query: (JSON object with response)
     """
     # Query parameters
@@ -265,24 +647,87 @@ def execute_query(query_url, query_files):
     verbose = False
     force = True
 
-    # Ensure our HTTP set up has been done.
-    curlairripa.initHTTP()
-    # Get the HTTP header information (in the form of a dictionary)
-    header_dict = curlairripa.getHeaderDict()
+    # HTTP set up and headers are done once, when the client is created
+    if client is None:
+        client = curlairripa.getDefaultClient()
+    header_dict = client.header_dict
+    if cache is None:
+        cache = response_cache.get_default_cache()
+    if recorder is None:
+        recorder = timings.get_default_recorder()
 
     # Test query is well built, then perform query
     try:
 
         # Process json file into JSON structure readable by Python
-        query_dict = curlairripa.process_json_files(force, verbose, query_files)
-
-        # Perform the query. Time it
-        start_time = time.time()
-        query_json = curlairripa.processQuery(query_url, header_dict, expect_pass, query_dict, verbose, force)
-        total_time = time.time() - start_time
+        if isinstance(query_files, dict):
+            query_dict = query_files
+        else:
+            query_dict = curlairripa.process_json_files(force, verbose, query_files)
+
+        # Serve from the cache if possible
+        if cache is not None and cache.reads:
+            start_time = time.perf_counter()
+            query_json = cache.get(query_url, query_dict)
+            if query_json is not None:
+                phases = {"cache_read": time.perf_counter() - start_time}
+                start_time = time.perf_counter()
+                with profiling.stage("decode"):
+                    parsed_query = json.loads(query_json)
+                phases["decode"] = time.perf_counter() - start_time
+                if recorder is not None:
+                    recorder.record(query_url, phases, len(query_json), cached=True)
+                print("CACHED RESPONSE:", query_url)
+                print("------------------------------------------------------")
+                return parsed_query
+            if cache.offline:
+                print("Replay only: no cached response for", query_url)
+                return None
+
+        # Perform the query through the rate limiter, retrying transient failures, and hedged if it is
+        # slower than usual. Time each phase of the last attempt
+        phases = {}
+
+        def request(timing):
+            return curlairripa.processQuery(query_url, header_dict, expect_pass, query_dict, verbose, force,
+                                            client=client, timing=timing, raise_errors=True)
+
+        def attempt():
+            phases.clear()
+            hedger = hedging.get_default_hedger()
+            if hedger is None:
+                return request(phases)
+            return hedger.call(request, query_url, phases)
+
+        start_time = time.perf_counter()
+        try:
+            with profiling.stage("query"):
+                query_json = ratelimit.call(attempt, query_url)
+        except Exception as e:
+            phases.pop("size", None)
+            phases.pop("wire_size", None)
+            phases["total"] = time.perf_counter() - start_time
+            if recorder is not None:
+                recorder.record(query_url, phases, None, cached=False, ok=False)
+            print("ERROR: Query to", query_url, "failed:", repr(e))
+            raise
+        total_time = time.perf_counter() - start_time
+        size = phases.pop("size", None)
+        # Bytes received, less than size when the response was compressed
+        wire_size = phases.pop("wire_size", size)
 
         # Parse
-        parsed_query = json.loads(query_json)
+        start_time = time.perf_counter()
+        with profiling.stage("decode"):
+            parsed_query = json.loads(query_json)
+        phases["decode"] = time.perf_counter() - start_time
+        phases["total"] = total_time + phases["decode"]
+        if recorder is not None:
+            recorder.record(query_url, phases, size, cached=False, ok=True, wire_size=wire_size)
+
+        # Record successful responses only
+        if cache is not None and cache.writes:
+            cache.put(query_url, query_dict, query_json)
 
         # Time
         print("ELAPSED DOWNLOAD TIME (in seconds): %s" % total_time)
@@ -296,68 +741,146 @@ def execute_query(query_url, query_files):
         print("Error in URL - cannot complete query. Ensure the input provided points to an API")
 
 
-def getArguments():
+def execute_query_stream(query_url, query_files, client=None, cache=None, recorder=None, chunk_size=65536,
+                         keep_data=False):
     """
-    This function facilitates reading parameters
+    Perform a stats API query and parse the response incrementally as it is read from the
+    connection. Each statistic is reduced to its sum of count as soon as it arrives, so memory
+    stays bounded no matter how big the response is
 
+    :param query_url: string, entry point on which we perform query (URL)
+    :param query_files: JSON file with query input parameters, or dict with the query itself
+    :param client: curlairripa.HTTPClient used to perform the query. Defaults to the shared client
+    :param cache: response_cache.ResponseCache consulted before the query. Responses are recorded
+                  while they are parsed. Defaults to response_cache.get_default_cache()
+    :param recorder: timings.TimingRecorder the time spent in each phase of the query is recorded in.
+                     Reading and parsing are interleaved, decode is the part not spent reading.
+                     Defaults to timings.get_default_recorder()
+    :param chunk_size: int, number of bytes read from the connection at a time
+    :param keep_data: bool, if True the data of each statistic is kept, see flatten_stats_items
+    :return: dict of columns as returned by flatten_stats_items, without the data of each statistic
+             unless keep_data is True
     """
-    # Set up the command line parser
-    parser = argparse.ArgumentParser(
-        formatter_class=argparse.RawDescriptionHelpFormatter,
-        description=""
-    )
+    verbose = False
+    force = True
 
-    # URL associated with API
-    parser.add_argument(
-        "base_url",
-        help="HTTP address associated with stats API"
-    )
+    if client is None:
+        client = curlairripa.getDefaultClient()
+    if cache is None:
+        cache = response_cache.get_default_cache()
+    if recorder is None:
+        recorder = timings.get_default_recorder()
 
-    # Entry point, options include:
-    # /rearrangement/junction_length
-    # /rearrangement/gene_usage
-    # /rearrangement/count
-    parser.add_argument(
-        "entry_point",
-        help="Options: string 'rearragement' or string 'repertoire'"
-    )
+    try:
+        if isinstance(query_files, dict):
+            query_dict = query_files
+        else:
+            query_dict = curlairripa.process_json_files(force, verbose, query_files)
+
+        # Serve from the cache if possible, still parsing incrementally
+        if cache is not None and cache.reads:
+            start_time = time.perf_counter()
+            cached = cache.open(query_url, query_dict)
+            if cached is not None:
+                cached_file, charset = cached
+                with cached_file:
+                    reader = timings.TimedReader(cached_file)
+                    items = jsonstream.iter_stats_stream(reader, charset, chunk_size)
+                    flat = flatten_stats_items(check_stats_items(query_url, items), keep_data=keep_data)
+                total_time = time.perf_counter() - start_time
+                if recorder is not None:
+                    recorder.record(query_url, {"cache_read": reader.seconds,
+                                                "decode": total_time - reader.seconds},
+                                    reader.bytes, cached=True)
+                print("CACHED RESPONSE:", query_url)
+                print("------------------------------------------------------")
+                return flat
+            if cache.offline:
+                print("Replay only: no cached response for", query_url)
+                return None
+
+        phases = {}
+
+        def attempt():
+            # Request and parse the whole response again if it fails part way through
+            phases.clear()
+            with curlairripa.processQueryStream(query_url, client.header_dict, query_dict, client=client,
+                                                timing=phases) as response:
+                charset = response.headers.get_content_charset() or "utf-8"
+                reader = timings.TimedReader(response)
+                parse_start = time.perf_counter()
+                if cache is not None and cache.writes:
+                    # Record the body while it is parsed
+                    with cache.store(query_url, query_dict, charset) as cache_file:
+                        items = jsonstream.iter_stats_stream(response_cache.TeeReader(reader, cache_file), charset,
+                                                             chunk_size)
+                        flat = flatten_stats_items(check_stats_items(query_url, items), keep_data=keep_data)
+                else:
+                    items = jsonstream.iter_stats_stream(reader, charset, chunk_size)
+                    flat = flatten_stats_items(check_stats_items(query_url, items), keep_data=keep_data)
+                # Compressed responses are decompressed as they are read, see curlairripa.DecodedResponse
+                wire_size = getattr(response, "wire_bytes", reader.bytes)
+                return flat, reader, wire_size, time.perf_counter() - parse_start
 
-    # JSON files containing query
-    parser.add_argument(
-        "stats_json_files",
-        help="Enter full path to JSON queries"
-    )
+        start_time = time.perf_counter()
+        try:
+            with profiling.stage("query"):
+                flat, reader, wire_size, parse_time = ratelimit.call(attempt, query_url)
+        except Exception:
+            phases["total"] = time.perf_counter() - start_time
+            if recorder is not None:
+                recorder.record(query_url, phases, None, cached=False, ok=False)
+            raise
+        total_time = time.perf_counter() - start_time
+
+        phases["transfer"] = reader.seconds
+        phases["decode"] = parse_time - reader.seconds
+        phases["total"] = total_time
+        if recorder is not None:
+            recorder.record(query_url, phases, reader.bytes, cached=False, ok=True, wire_size=wire_size)
 
-    # JSON files containing query
-    parser.add_argument(
-        "adc_json_files",
-        help="Enter full path to ADC API JSON queries"
-    )
+        print("ELAPSED DOWNLOAD TIME (in seconds): %s" % total_time)
+        print("------------------------------------------------------")
 
-    # Stats API YAML schema
-    parser.add_argument(
-        "yaml_file",
-        help="Enter full path to YAML schema"
-    )
+        return flat
 
-    # Stats API YAML schema
-    parser.add_argument(
-        "validator_arr",
-        help="Comma-separated list of words, each of which is an element from the list 'headers', 'rows', 'objects'"
-    )
+    except Exception as e:
+        print("Read", query_url, " as entry point. Error found.")
+        print("Error in URL - cannot complete query. Ensure the input provided points to an API")
+        print("Reason:", e)
+
+
+def query_stats(stats_url, query_files, stream=False, keep_data=False):
+    """
+    :param stats_url: URL entry point for stats API
+    :param query_files: JSON file with query input parameters, or dict with the query itself
+    :param stream: bool, if True the response is parsed incrementally (see execute_query_stream)
+                   and the data column of get_total_count is left empty
+    :param keep_data: bool, if True the data column is kept when the response is parsed incrementally
+    :return: ApiStats object with the stats API response
+    """
+    if not stream:
+        json_resp = execute_query(stats_url, query_files)
+        check_stats_response(stats_url, json_resp)
+        return ApiStats(0, json_resp, 0)
+
+    flat = execute_query_stream(stats_url, query_files, keep_data=keep_data)
+    if flat is None:
+        flat = flatten_stats_items([])
+    return ApiStats(0, None, 0, flat=flat)
 
-    # Directory where results will be saved
-    parser.add_argument(
-        "details_dir",
-        help="Enter full path to JSON queries"
-    )
 
-    # Verbosity flag
-    parser.add_argument(
-        "-v",
-        "--verbose",
-        action="store_true",
-        help="Run the program in verbose mode.")
+def getArguments():
+    """
+    This function facilitates reading parameters, the same as the validate subcommand of cli
+
+    """
+    # Set up the command line parser
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description=""
+    )
+    cli.add_validate_arguments(parser)
 
     # Parse the command line arguements.
     options = parser.parse_args()
@@ -380,6 +903,7 @@ def stats_vs_facet_counts(stats_url, facet_url, repertoire_id, relative_path_sta
         stats_json_files = relative_path_stats + str(repertoire_id) + ".json"
         # Perform stats api query
         stats_response = execute_query(stats_url, stats_json_files)
+        check_stats_response(stats_url, stats_response)
 
         # Facet count query
         print("Facet count query")
@@ -399,151 +923,644 @@ def stats_vs_facet_counts(stats_url, facet_url, repertoire_id, relative_path_sta
         print("Stats JSON input", relative_path_stats)
 
 
-def generate_sum_count_total_test(details_dir,sum_count_total,stats_name):
+def write_results(path_prefix, dataframes, output_format="csv", compression=None):
     """
-    :param details_dir: path to directory where results should be stored
-    :param sum_count_total: list of dataframes with results of sum of count vs reported total
-    :param stats_name: string, one of rearrangement_count, gene_usage, junction_length
-    :return: None
+    :param path_prefix: path of the output file without extension
+    :param dataframes: iterable of dataframes, each one is written as soon as it is produced
+    :param output_format: one of 'csv', 'parquet', 'arrow', see result_writer
+    :param compression: 'gzip' or None for csv, Parquet codec for parquet
+    :return: path of the file written, None if there were no results
     """
+    sink = result_writer.ResultSink(path_prefix, output_format, compression)
     try:
-        print("Generating sum of count vs total results")
-        final_sum_total_results = pd.concat(sum_count_total)
-        final_sum_total_results.to_csv(details_dir + "COVID19-3" + "_" + stats_name + "_" + "SumCountTotalStat.csv")
-    except:
-        print("Received directory", details_dir)
-        print("Received sum count total data structure", type(sum_count_total), " expected list of dataframes")
-        print("Received", stats_name, " expected string")
+        for df in dataframes:
+            sink.append(df)
+    finally:
+        path = sink.close()
+    return path
+
 
-def generate_results_file(details_dir, result_df,stats_name):
+def result_path_prefix(details_dir, repository_name, stats_name, suffix):
     """
-    :param details_dir: path to directory where results should be stored
-    :param result_df: list of dataframes with results of facet count vs reported total
-    :param stats_name: string, one of rearrangement_count, gene_usage, junction_length
-    :return: None
+    :return: path of a results file without extension, e.g. <details_dir>/COVID19-3_junction_length_FinalCount
     """
-    try:
-        print("Generating facet count vs total results")
-        final_results = pd.concat(result_df)
-        final_results.to_csv(details_dir + "COVID19-3" + "_" + stats_name + "_" + "FinalCount.csv")
-    except:
-        print("Received directory", details_dir)
-        print("Received results df data structure", type(result_df), " expected list of dataframes")
-        print("Received", stats_name, " expected string")
+    return details_dir + repository_name + "_" + stats_name + "_" + suffix
 
 
-def main():
+def record_processing_time(stats_url, seconds):
     """
+    Record the time spent processing a stats API response with pandas in the default timing recorder
 
-    This function performs stats API count vs facet count vs sum of count vs total
-    For iReceptor API and COVID19 API
+    :param stats_url: URL entry point for stats API the response came from
+    :param seconds: float, time spent in ApiStats
     :return: None
     """
-    pd.set_option('display.max_columns', 500)
+    recorder = timings.get_default_recorder()
+    if recorder is not None:
+        recorder.record(stats_url, {"process": seconds})
 
-    print("STATS API TEST \n")
-    # Input reading
-    # =============================================================================
-    #     options = getArguments()
-    #     base_url = options.base_url
-    #     #base_url = 'https://stats-staging.ireceptor.org'
-    #     entry_pt = options.entry_point
-    #     stats_json_files = options.stats_json_files
-    #     adc_json_files = options.adc_json_files
-    #     yaml_file = options.yaml_file
-    #     validator_arr = options.validator_arr
-    #     details_dir = options.details_dir
-    # =============================================================================
-    base_url = "http://covid19-3.ireceptor.org"
-    entry_pt = "rearrangement/gene_usage"
-    validator_arr = "None"
-    details_dir = "./JSON-Files/yaml-verification/output/covid19-3/test/"
-    adc_json_files = "./JSON-Files/repertoire/nofilters.json"
-    # Parameters
-    relative_path_stats = "./JSON-Files/yaml-verification/stats_query/covid19-3/stats_repertoire_id_"
-    relative_path_facet = "./JSON-Files/yaml-verification/facet_query/covid19-3/facet_repertoire_id_"
-
-    # Select validation
-    print("Validation of schema option", validator_arr)
-    select_validator(validator_arr)
-
-    # Form metadata facet counts ADC API query
-    adc_api_query_url = base_url + "/airr/v1/" + "repertoire"
-    print("ADC API no filters query")
-    # Perform metadata ADC API query
-    json_adc_api_resp = execute_query(adc_api_query_url, adc_json_files)
-
-    # Generate list of repertoire id's
-    no_rep = len(json_adc_api_resp['Repertoire'])
-    rep_ids = [json_adc_api_resp['Repertoire'][i]['repertoire_id'] for i in range(no_rep)]
-
-    # Initialize lists with results
-    # Facet count vs reported total
-    result_df = []
-    # Sum of count vs reported total
-    sum_count_total = []
-
-    # Initialize query entry points
-    # Facet count entry point
-    facet_url = base_url
-    # Stats API entry point
-    stats_url = base_url + "/irplus/v1/stats/" + entry_pt
-
-    # Begin iteration
-    for item in rep_ids:
-        print("*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*")
-        time.sleep(1)
-        # Iterate
-        repertoire_id = str(item)
-        print(repertoire_id)
-
-        # Perform stats and facet count
+
+@profiling.profiled("facet")
+def compare_repertoire_counts(stats_api_ct, facet_ct, repertoire_id, stats_name):
+    """
+    Compare the facet count of a single repertoire against the total reported by the stats API
+
+    :param stats_api_ct: dataframe resulting from ApiStats.get_total_count
+    :param facet_ct: dataframe resulting from validate_md_json_fields
+    :param repertoire_id: ID uniquely identifying repertoire
+    :param stats_name: string, one of rearrangement_count, junction_length
+    :return: facet_ct with additional columns StatsAPICount and Result
+    """
+    # annotation_fc_ct = annotation_ct.merge(facet_ct,on='RepertoireID(MD)')
+    annotation_fc_ct = facet_ct
+    stats_of_interest = stats_api_ct[(stats_api_ct["statistic_name"] == stats_name) &
+                                     (stats_api_ct['repertoire_id'] == repertoire_id)]
+    annotation_fc_ct['StatsAPICount'] = stats_of_interest['total'].values
+
+    # Compare values
+    run_test = int(annotation_fc_ct['FacetCountAPI'].values[0]) == int(annotation_fc_ct['StatsAPICount'].values[0])
+    annotation_fc_ct["Result"] = run_test
+    print("TEST RESULT---->", run_test)
+    print(annotation_fc_ct)
+
+    return annotation_fc_ct
+
+
+def process_repertoire(stats_url, facet_url, repertoire_id, relative_path_stats, relative_path_facet, stats_name,
+                       bulk_facet=False, stream=False):
+    """
+    Perform stats API and facet count queries for a single repertoire and compare them
+
+    :param stats_url: URL entry point for stats API
+    :param facet_url: URL entry point for facet count
+    :param repertoire_id: ID uniquely identifying repertoire
+    :param relative_path_stats: path to JSON input files for Stats API queries
+    :param relative_path_facet: path to JSON input files for facet count queries
+    :param stats_name: string, one of rearrangement_count, gene_usage, junction_length
+    :param bulk_facet: bool, if True only the stats API is queried, facet counts are compared later
+                       for all repertoires at once (see bulk_facet_counts)
+    :param stream: bool, if True the stats API response is parsed incrementally
+    :return: [stats_api_sum_count, annotation_fc_ct], annotation_fc_ct is None for bulk_facet. For
+             gene_usage it has one row per gene, see verify_gene_usage. None if the stats API query
+             returned no entries
+    """
+    print("*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*")
+    repertoire_id = str(repertoire_id)
+    print(repertoire_id)
+
+    # Perform stats and facet count
+    if bulk_facet or stream:
+        print("Perform Stats API query")
+        api_stats = query_stats(stats_url, relative_path_stats + repertoire_id + ".json", stream,
+                                keep_data=stats_name in DATA_STATISTICS)
+        facet_ct = None
+        if not bulk_facet and stats_name != 'gene_usage':
+            print("Facet count query")
+            facet_ct = validate_md_json_fields(facet_url, relative_path_facet + repertoire_id + ".json")
+    else:
         [stats_response, facet_ct] = stats_vs_facet_counts(stats_url,
                                                            facet_url,
                                                            repertoire_id,
                                                            relative_path_stats,
                                                            relative_path_facet)
+        api_stats = ApiStats(0, stats_response, 0)
 
-        # Get total counts
-        stats_api_ct = ApiStats(0, stats_response, 0).get_total_count()
-        if stats_api_ct.empty:
-            print("No entries found under stats count")
-            print("Exiting script")
-            sys.exit(0)
+    # Get total counts
+    start_time = time.perf_counter()
+    stats_api_ct = api_stats.get_total_count()
+    if stats_api_ct.empty:
+        print("No entries found under stats count")
+        return None
 
-        # Sanity check
-        stats_name = entry_pt.split("/")[1]
-
-        # Sum of count vs total
-        print("Perform sum of count vs reported total in stats api")
-        stats_api_sum_count = ApiStats(0, stats_response, 0).get_sum_count(stats_api_ct)
-        sum_count_total.append(stats_api_sum_count)
-
-        # annotation_fc_ct = annotation_ct.merge(facet_ct,on='RepertoireID(MD)')
-        annotation_fc_ct = facet_ct
-        if stats_name == 'count':
-            stats_name = "rearrangement_count"
-        elif stats_name == 'gene_usage':
-            stats_name = stats_name
+    # Sum of count vs total
+    print("Perform sum of count vs reported total in stats api")
+    stats_api_sum_count = api_stats.get_sum_count(stats_api_ct)
+    record_processing_time(stats_url, time.perf_counter() - start_time)
+
+    if stats_name == 'gene_usage':
+        return [stats_api_sum_count, verify_gene_usage(facet_url, stats_api_ct, repertoire_id)]
+    if bulk_facet:
+        return [stats_api_sum_count, None]
+
+    return [stats_api_sum_count, compare_repertoire_counts(stats_api_ct, facet_ct, repertoire_id, stats_name)]
+
+
+def statistic_name_of(entry_pt):
+    """
+    :param entry_pt: stats API entry point, e.g. rearrangement/count
+    :return: string, name of the statistic the entry point reports, one of rearrangement_count,
+             gene_usage, junction_length
+    """
+    stats_name = entry_pt.split("/")[1]
+    if stats_name == 'count':
+        stats_name = "rearrangement_count"
+    return stats_name
+
+
+def iter_repertoire_ids(repertoire_url, query_files, page_size=1000):
+    """
+    Enumerate the repertoires of an ADC API repository one page at a time, requesting only their IDs
+
+    :param repertoire_url: string, ADC API repertoire entry point (URL)
+    :param query_files: JSON file with the ADC API repertoire query, or dict with the query itself.
+                        Its filters are kept, from, size and fields are set for each page
+    :param page_size: int, number of repertoires requested per query
+    :return: generator of repertoire IDs, the next page is only queried once the previous one is consumed
+    :raises RuntimeError: if a page could not be queried
+    """
+    if isinstance(query_files, dict):
+        base_query = query_files
+    else:
+        base_query = curlairripa.process_json_files(True, False, query_files)
+
+    start = 0
+    while True:
+        query_dict = dict(base_query, fields=["repertoire_id"], size=page_size)
+        query_dict["from"] = start
+        with profiling.stage("enumeration"):
+            json_adc_api_resp = execute_query(repertoire_url, query_dict)
+        if json_adc_api_resp is None or 'Repertoire' not in json_adc_api_resp:
+            raise RuntimeError("ADC API repertoire query failed for repertoires from " + str(start))
+
+        page = json_adc_api_resp['Repertoire']
+        for repertoire in page:
+            yield str(repertoire['repertoire_id'])
+        if len(page) < page_size:
+            return
+        start += len(page)
+
+
+def batched(iterable, size):
+    """
+    :param iterable: iterable of repertoire IDs
+    :param size: int, batch size
+    :return: generator of lists of up to size consecutive items
+    """
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def build_stats_query(rep_ids):
+    """
+    :param rep_ids: list of repertoire IDs
+    :return: dict with a Stats API query covering all repertoires in rep_ids
+    """
+    return {"repertoires": [{"repertoire": {"repertoire_id": str(i)}} for i in rep_ids]}
+
+
+def process_stats_batch(stats_url, facet_url, rep_ids, relative_path_facet, stats_name, bulk_facet=False,
+                        stream=False):
+    """
+    Perform a single stats API query for a batch of repertoires, split the results back out
+    per repertoire and compare them against facet counts
+
+    :param stats_url: URL entry point for stats API
+    :param facet_url: URL entry point for facet count
+    :param rep_ids: list of repertoire IDs sent in one stats API query
+    :param relative_path_facet: path to JSON input files for facet count queries
+    :param stats_name: string, one of rearrangement_count, gene_usage, junction_length
+    :param bulk_facet: bool, if True facet counts are compared later for all repertoires at once
+    :param stream: bool, if True the stats API response is parsed incrementally
+    :return: list with one process_repertoire() style result per repertoire, in rep_ids order.
+             The result is None for repertoires missing from the stats API response
+    """
+    print("*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*-*")
+    rep_ids = [str(i) for i in rep_ids]
+    print("Perform Stats API query for", len(rep_ids), "repertoires")
+    api_stats = query_stats(stats_url, build_stats_query(rep_ids), stream, keep_data=stats_name in DATA_STATISTICS)
+
+    # Get total counts and sum of count vs total for the whole batch
+    start_time = time.perf_counter()
+    stats_api_ct = api_stats.get_total_count()
+    if stats_api_ct.empty:
+        print("No entries found under stats count")
+        return [None] * len(rep_ids)
+
+    print("Perform sum of count vs reported total in stats api")
+    stats_api_sum_count = api_stats.get_sum_count(stats_api_ct)
+    per_repertoire = {str(repertoire_id): group.reset_index(drop=True)
+                      for repertoire_id, group in stats_api_sum_count.groupby('repertoire_id', sort=False)}
+    record_processing_time(stats_url, time.perf_counter() - start_time)
+
+    results = []
+    for repertoire_id in rep_ids:
+        if repertoire_id not in per_repertoire:
+            print("No entries found under stats count for repertoire", repertoire_id)
+            results.append(None)
+            continue
+
+        repertoire_sum_count = per_repertoire[repertoire_id]
+        if stats_name == 'gene_usage':
+            results.append([repertoire_sum_count,
+                            verify_gene_usage(facet_url, repertoire_sum_count, repertoire_id)])
             continue
+        if bulk_facet:
+            results.append([repertoire_sum_count, None])
+            continue
+
+        print("Facet count query", repertoire_id)
+        facet_ct = validate_md_json_fields(facet_url, relative_path_facet + repertoire_id + ".json")
+        results.append([repertoire_sum_count,
+                        compare_repertoire_counts(repertoire_sum_count, facet_ct, repertoire_id, stats_name)])
+
+    return results
+
+
+def run_serial_queries(task, items):
+    """
+    Perform stats API vs facet count comparison one item at a time. The load on the API is limited
+    by the rate limiter every query goes through (see ratelimit)
+
+    :param task: callable taking one item and returning a list of process_repertoire() results
+    :param items: list of repertoire IDs, or of batches of repertoire IDs
+    :return: generator of process_repertoire() results, in items order, yielded as each item
+             finishes
+    """
+    for item in items:
+        for result in task(item):
+            yield result
+
+
+def run_concurrent_queries(task, items, max_workers):
+    """
+    Perform stats API vs facet count comparison for many items at once using a thread pool
+
+    :param task: callable taking one item and returning a list of process_repertoire() results
+    :param items: iterable of repertoire IDs, or of batches of repertoire IDs. Only a few items more
+                  than max_workers are taken from it ahead of the results, so it can be a generator
+                  that is still enumerating repertoires
+    :param max_workers: int, maximum number of items queried at the same time
+    :return: generator of process_repertoire() results, in items order, yielded as each item
+             finishes
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = collections.deque()
+        for item in items:
+            pending.append(executor.submit(task, item))
+            if len(pending) >= 2 * max_workers:
+                for result in pending.popleft().result():
+                    yield result
+        while pending:
+            for result in pending.popleft().result():
+                yield result
+
+
+def guarded(task, failed, run_checkpoint=None):
+    """
+    Wrap a task so that repertoires that fail, or have no stats, are marked as failed instead of
+    aborting the run. With a checkpoint, the result of every repertoire is also saved as soon as it
+    finishes
+
+    :param task: callable taking a repertoire ID, or a batch of repertoire IDs, and returning a list of
+                 process_repertoire() results
+    :param failed: list the (repertoire_id, reason) of every failed repertoire is appended to
+    :param run_checkpoint: checkpoint.Checkpoint where results are saved, or None
+    :return: callable taking the same items and returning the results of the repertoires that did not
+             fail. With a checkpoint it returns an empty list, results are read back from run_checkpoint
+    """
+    def run(item):
+        rep_ids = [str(i) for i in item] if isinstance(item, list) else [str(item)]
+        reason = "no entries found under stats count"
+        try:
+            results = task(item)
+        except Exception as e:
+            print("Could not process repertoire(s)", rep_ids, ":", repr(e))
+            reason = repr(e)
+            results = [None] * len(rep_ids)
+
+        for repertoire_id, result in zip(rep_ids, results):
+            if result is None:
+                print("Repertoire", repertoire_id, "failed:", reason)
+                failed.append((repertoire_id, reason))
+                if run_checkpoint is not None:
+                    run_checkpoint.mark_failed(repertoire_id, reason)
+            elif run_checkpoint is not None:
+                run_checkpoint.save(repertoire_id, result[0], result[1])
+        if run_checkpoint is not None:
+            return []
+        return [result for result in results if result is not None]
+
+    return run
+
+
+def configure_queries(query_delay=1, max_rate=20.0, max_retries=4, connect_timeout=10.0, read_timeout=300.0):
+    """
+    Set the rate limiter, retry policy and deadlines every query goes through, see main
+
+    :param query_delay: float, seconds between queries to start with, 0 to start at max_rate
+    :param max_rate: float, highest number of queries per second
+    :param max_retries: int, number of times a query failing with a transient error is retried
+    :param connect_timeout: float, seconds allowed to open a connection, None to wait forever
+    :param read_timeout: float, seconds allowed for each wait for data, None to wait forever
+    :return: None
+    """
+    initial_rate = 1.0 / query_delay if query_delay > 0 else max_rate
+    ratelimit.set_default_limiter(ratelimit.AdaptiveLimiter(min(initial_rate, max_rate), max_rate=max_rate))
+    ratelimit.set_default_policy(ratelimit.RetryPolicy(max_retries))
+
+    client = curlairripa.getDefaultClient()
+    client.connect_timeout = connect_timeout
+    client.read_timeout = read_timeout
+
+
+def main(base_url="http://covid19-3.ireceptor.org",
+         entry_pt="rearrangement/gene_usage",
+         validator_arr="None",
+         details_dir="./JSON-Files/yaml-verification/output/covid19-3/test/",
+         adc_json_files="./JSON-Files/repertoire/nofilters.json",
+         relative_path_stats="./JSON-Files/yaml-verification/stats_query/covid19-3/stats_repertoire_id_",
+         relative_path_facet="./JSON-Files/yaml-verification/facet_query/covid19-3/facet_repertoire_id_",
+         max_workers=1, bulk_facet=False, batch_size=1, stream=False, cache_dir=None, cache_mode="readwrite",
+         cache_max_bytes=1 << 30, cache_ttl=None, timings_file=None, checkpoint_file=None,
+         repository_name="COVID19-3", output_format="csv", compression=None, query_delay=1, page_size=1000,
+         yaml_file=None, histogram_checks=False, histogram_facets=False, max_junction_length=400, max_rate=20.0,
+         max_retries=4, connect_timeout=10.0, read_timeout=300.0, hedge=False, hedge_quantile=0.95,
+         history_db=None, profile_dir=None, profile_sample_rate=0.05, profile_memory_rate=0.01):
+    """
+
+    This function performs stats API count vs facet count vs sum of count vs total
+    For iReceptor API and COVID19 API
+    :param base_url: HTTP address associated with stats API, e.g. a local stats_server for testing
+    :param entry_pt: stats API entry point, one of rearrangement/count, rearrangement/junction_length,
+                     rearrangement/gene_usage
+    :param validator_arr: comma-separated list of AIRR schema validations, see select_validator
+    :param details_dir: path to directory where results should be stored
+    :param adc_json_files: path to JSON file with the ADC API repertoire query
+    :param relative_path_stats: path prefix of JSON input files for Stats API queries
+    :param relative_path_facet: path prefix of JSON input files for facet count queries
+    :param max_workers: int, number of repertoires (or batches) queried concurrently. 1 queries them serially
+    :param bulk_facet: bool, if True facet counts for all repertoires are fetched in a single query
+    :param batch_size: int, number of repertoires packed into each stats API query
+    :param stream: bool, if True stats API responses are parsed incrementally as they are downloaded
+    :param cache_dir: directory of the on-disk response cache. None disables the cache
+    :param cache_mode: one of 'readwrite', 'record', 'replay' (never touches the network), 'off'
+    :param cache_max_bytes: int, size above which least recently used cached responses are evicted
+    :param cache_ttl: float, seconds after which a cached response is no longer served. None for no expiry
+    :param timings_file: path to JSONL file where the phase timings of every query are appended.
+                         A p50/p95/p99 summary per endpoint is printed at the end of the run in any case
+    :param checkpoint_file: path to JSONL file where each repertoire's results are saved as soon as they are
+                            available. Repertoires already saved there by a previous run are not queried
+                            again, failed ones are. Failures are recorded instead of aborting the run
+    :param repository_name: string, prefix of the results files
+    :param output_format: format of the results files, one of 'csv', 'parquet', 'arrow'. Results are appended
+                          as each repertoire finishes
+    :param compression: 'gzip' or None for csv, Parquet codec (default snappy) for parquet
+    :param query_delay: float, seconds between queries to start with. The rate limiter then raises the rate
+                        while the API answers promptly, up to max_rate, and backs off on 429/503/timeouts
+    :param page_size: int, number of repertoire IDs requested per ADC API repertoire query
+    :param yaml_file: path to the Stats API YAML schema. If given, every stats API response is validated
+                      against it and violations are written per repertoire and statistic
+    :param histogram_checks: bool, for junction_length, also check the distributions of all repertoires at
+                             once at the end of the run (see histograms)
+    :param histogram_facets: bool, with histogram_checks, also compare every length against facet counts
+    :param max_junction_length: int, longest valid junction length for histogram_checks
+    :param max_rate: float, highest number of queries per second sent to the API
+    :param max_retries: int, number of times a query failing with a transient error (429, 502, 503, 504,
+                        timeout, connection error) is retried, with exponential backoff
+    :param connect_timeout: float, seconds allowed to open a connection to the API, None to wait forever
+    :param read_timeout: float, seconds allowed for each wait for data once connected (response headers or
+                         a read of the body), None to wait forever. Queries that time out are retried
+    :param hedge: bool, if True a query that has not answered within the hedge_quantile latency of its
+                  endpoint is sent again, and the first response is used (see hedging). Streamed stats
+                  API queries are not hedged
+    :param hedge_quantile: float, latency quantile after which queries are hedged
+    :param history_db: path to SQLite database where the results and latency summary of the run are added,
+                       with those of previous runs (see history). None to not keep history
+    :param profile_dir: directory where the CPU and memory profiles of each stage of the run are written
+                        (see profiling). None to not profile
+    :param profile_sample_rate: float, fraction of the calls of each stage profiled with cProfile
+    :param profile_memory_rate: float, fraction of the calls of each stage traced with tracemalloc
+    :return: dict with the paths of the 'sum_count' and 'final_count' results files, None for a file
+             without results. Repertoires that failed after retries are listed in the 'failed_repertoires'
+             results file, and the run goes on without them
+    """
+    pd.set_option('display.max_columns', 500)
+
+    print("STATS API TEST \n")
+
+    # CPU and memory profiles of a sample of the calls of each stage
+    profiler = None
+    if profile_dir is not None:
+        print("Profiling %g%% (memory %g%%) of the calls of each stage to" % (100 * profile_sample_rate,
+                                                                             100 * profile_memory_rate), profile_dir)
+        profiler = profiling.Profiler(profile_dir, profile_sample_rate, profile_memory_rate)
+    profiling.set_default_profiler(profiler)
+
+    # Per-phase query timings
+    recorder = timings.TimingRecorder(timings_file)
+    timings.set_default_recorder(recorder)
+
+    # Response cache of this run only, a later run in the same process (e.g. a reused worker process
+    # of repositories.py) must not reuse it
+    previous_cache = response_cache.get_default_cache()
+    cache = None
+    if cache_dir is not None:
+        print("Response cache", cache_dir, "mode", cache_mode)
+        cache = response_cache.ResponseCache(cache_dir, cache_mode, cache_max_bytes, cache_ttl)
+    response_cache.set_default_cache(cache)
+    try:
+
+        # Adaptive rate limit, retries and deadlines of every query
+        configure_queries(query_delay, max_rate, max_retries, connect_timeout, read_timeout)
+
+        # Duplicates of the slowest queries
+        hedger = hedging.Hedger(hedge_quantile, max_workers=max_workers) if hedge else None
+        hedging.set_default_hedger(hedger)
+
+        # Select validation
+        print("Validation of schema option", validator_arr)
+        select_validator(validator_arr)
+
+        # Stats API schema validation, compiled once for the whole run
+        validator = None
+        if yaml_file is not None:
+            print("Validating stats API responses against", yaml_file)
+            validator = schema_validator.StatsResponseValidator(schema_validator.load_schema(yaml_file), entry_pt)
+        schema_validator.set_default_validator(validator)
+
+        # Form metadata facet counts ADC API query
+        adc_api_query_url = base_url + "/airr/v1/" + "repertoire"
+        print("ADC API no filters query, pages of", page_size, "repertoires")
+
+        # Generate repertoire id's page by page, the first repertoires are queried while later pages are
+        # still being enumerated. Only the IDs are kept
+        rep_ids = []
+
+        def enumerate_repertoires():
+            for repertoire_id in iter_repertoire_ids(adc_api_query_url, adc_json_files, page_size):
+                rep_ids.append(repertoire_id)
+                yield repertoire_id
+
+        # Initialize query entry points
+        # Facet count entry point
+        facet_url = base_url
+        # Stats API entry point
+        stats_url = base_url + "/irplus/v1/stats/" + entry_pt
+
+        # Sanity check
+        stats_name = statistic_name_of(entry_pt)
+
+        # Results of every run, kept across runs
+        history_store = None
+        if history_db is not None:
+            print("History of results in", history_db)
+            history_store = history.HistoryStore(history_db)
+            run_id = history_store.start_run(repository_name, base_url, entry_pt, stats_name,
+                                             {"max_workers": max_workers, "batch_size": batch_size,
+                                              "bulk_facet": bulk_facet, "stream": stream})
+
+        # Resume: only query repertoires without results in the checkpoint
+        run_checkpoint = None
+        pending_ids = enumerate_repertoires()
+        if checkpoint_file is not None:
+            run_checkpoint = checkpoint.Checkpoint(checkpoint_file)
+            pending_ids = (i for i in pending_ids if not run_checkpoint.done(i))
+            print("Checkpoint", checkpoint_file + ":", "repertoires with results are not queried again")
+
+        # Either one stats API query per repertoire, or one per batch of repertoires
+        # Timings recorded while processing an item are tagged with its repertoire ID(s)
+        if batch_size > 1:
+            items = batched(pending_ids, batch_size)
+
+            def task(item):
+                with timings.tagged(repertoire_id=[str(i) for i in item]):
+                    return process_stats_batch(stats_url, facet_url, item, relative_path_facet, stats_name,
+                                               bulk_facet, stream)
         else:
-            stats_name = stats_name
-        stats_of_interest = stats_api_ct[(stats_api_ct["statistic_name"] == stats_name) &
-                                         (stats_api_ct['repertoire_id'] == repertoire_id)]
-        annotation_fc_ct['StatsAPICount'] = stats_of_interest['total'].values
+            items = pending_ids
 
-        # Compare values
-        run_test = int(annotation_fc_ct['FacetCountAPI'].values[0]) == int(annotation_fc_ct['StatsAPICount'].values[0])
-        annotation_fc_ct["Result"] = run_test
-        print("TEST RESULT---->", run_test)
-        print(annotation_fc_ct)
+            def task(item):
+                with timings.tagged(repertoire_id=str(item)):
+                    return [process_repertoire(stats_url, facet_url, item, relative_path_stats, relative_path_facet,
+                                               stats_name, bulk_facet, stream)]
 
-        result_df.append(annotation_fc_ct)
+        # Repertoires that failed are recorded, the others are still validated
+        failed = []
+        task = guarded(task, failed, run_checkpoint)
 
-    # Generate CSV with results
-    generate_sum_count_total_test(details_dir, sum_count_total, stats_name)
-    generate_results_file(details_dir, result_df, stats_name)
+        # Begin iteration
+        if max_workers > 1:
+            results = run_concurrent_queries(task, items, max_workers)
+        else:
+            results = run_serial_queries(task, items)
+
+        # With a checkpoint, results of this and previous runs are read back from it one repertoire at a time
+        if run_checkpoint is not None:
+            for _ in results:
+                pass
+            print("Checkpoint", checkpoint_file + ":", len(rep_ids), "repertoires enumerated")
+            if failed:
+                print("Failed repertoires are queried again by the next run")
+            rep_ids = [i for i in rep_ids if run_checkpoint.done(i)]
+            results = (run_checkpoint.results(i) for i in rep_ids)
+
+        # Results files, each repertoire's results are appended as soon as they are available
+        # Sum of count vs reported total
+        sum_count_sink = result_writer.ResultSink(
+            result_path_prefix(details_dir, repository_name, stats_name, "SumCountTotalStat"), output_format,
+            compression)
+        # Facet count vs reported total
+        result_sink = result_writer.ResultSink(
+            result_path_prefix(details_dir, repository_name, stats_name, "FinalCount"), output_format, compression)
+        # Stats API schema violations
+        violation_sink = result_writer.ResultSink(
+            result_path_prefix(details_dir, repository_name, stats_name, "SchemaViolations"), output_format,
+            compression)
+
+        def write_violations():
+            if validator is not None:
+                violations = validator.violations()
+                report_violations(violations)
+                violation_sink.append(pd.DataFrame(violations))
+
+        # Only the totals of stats_name are kept for the bulk facet count comparison
+        bulk_totals = []
+        # Junction length distributions, checked all at once after the last repertoire
+        histogram_set = None
+        if histogram_checks and stats_name == 'junction_length':
+            histogram_set = histograms.HistogramSet(max_length=max_junction_length)
+        for result in results:
+            [stats_api_sum_count, annotation_fc_ct] = result
+            with profiling.stage("output"):
+                write_violations()
+                sum_count_sink.append(stats_api_sum_count)
+                if annotation_fc_ct is not None:
+                    result_sink.append(annotation_fc_ct)
+                if history_store is not None:
+                    history_store.add_sum_count(run_id, stats_api_sum_count)
+                    if annotation_fc_ct is not None:
+                        history_store.add_facet_counts(run_id, annotation_fc_ct, stats_name)
+            if histogram_set is not None:
+                histogram_set.add(stats_api_sum_count)
+            if bulk_facet and stats_name != 'gene_usage':
+                bulk_totals.append(stats_api_sum_count.loc[stats_api_sum_count["statistic_name"] == stats_name,
+                                                           ["statistic_name", "repertoire_id", "total"]])
+
+        if run_checkpoint is not None:
+            run_checkpoint.close()
+
+        failed_ids = set(repertoire_id for repertoire_id, _ in failed)
+        rep_ids = [i for i in rep_ids if str(i) not in failed_ids]
+
+        # Facet count vs reported total for all repertoires at once
+        if bulk_facet and stats_name != 'gene_usage' and bulk_totals:
+            print("Facet count query for all repertoires")
+            facet_counts = bulk_facet_counts(facet_url, rep_ids)
+            annotation_fc_ct = compare_facet_counts(rep_ids, pd.concat(bulk_totals), facet_counts, stats_name)
+            print(annotation_fc_ct)
+            result_sink.append(annotation_fc_ct)
+            if history_store is not None:
+                history_store.add_facet_counts(run_id, annotation_fc_ct, stats_name)
+
+        with profiling.stage("output"):
+            paths = {"sum_count": sum_count_sink.close(), "final_count": result_sink.close()}
+
+        # Junction length distributions of all repertoires
+        if histogram_set is not None:
+            checks = check_junction_histograms(histogram_set, facet_url if histogram_facets else None, max_workers)
+            paths["histogram_checks"] = write_results(
+                result_path_prefix(details_dir, repository_name, stats_name, "HistogramChecks"), [checks],
+                output_format, compression)
+        if failed:
+            print(len(failed), "repertoire(s) failed:", sorted(failed_ids))
+            paths["failed_repertoires"] = write_results(
+                result_path_prefix(details_dir, repository_name, stats_name, "FailedRepertoires"),
+                [pd.DataFrame(failed, columns=["repertoire_id", "reason"])], output_format, compression)
+        if validator is not None:
+            write_violations()
+            paths["schema_violations"] = violation_sink.close()
+            if paths["schema_violations"] is None:
+                print("All stats API responses follow the schema")
+
+        if hedger is not None:
+            print("Hedged queries:", hedger.hedged, "of which", hedger.won, "answered first by the duplicate")
+            hedger.close()
+            hedging.set_default_hedger(None)
+
+        recorder.print_summary()
+        recorder.close()
+
+        if history_store is not None:
+            history_store.add_failures(run_id, failed)
+            history_store.add_timings(run_id, recorder.summary())
+            history_store.finish_run(run_id, "partial" if failed else "ok")
+            history_store.close()
+
+        if profiler is not None:
+            profiler.print_summary()
+            print("Profiles written to", profiler.write())
+            profiling.set_default_profiler(None)
+
+        return paths
+    finally:
+        response_cache.set_default_cache(previous_cache)
 
 
 if __name__ == "__main__":
-    main()
+    main(**cli.main_options(getArguments()))
@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+
+"""
+CPU and memory profiling of the stages of a run
+
+Code marks its stages with profiling.stage(name) (or the profiled(name) decorator):
+
+    enumeration   ADC API repertoire enumeration
+    query         stats API and facet count queries, including retries. Streamed stats API
+                  responses are parsed while they are downloaded, so their parsing counts here
+    decode        JSON parsing of query responses
+    validation    Stats API schema checks and AIRR schema validation (select_validator)
+    aggregation   ApiStats total and sum of count computations
+    facet         comparison of stats API results with facet counts
+    output        writing results files and history
+
+Stages nest, a query made while enumerating repertoires is counted as enumeration/query, and the
+time and CPU profile of a stage exclude those of the stages nested in it. Every call of a stage is
+timed. A random sample of calls (sample_rate) is also run under cProfile, and a smaller one
+(memory_rate) under tracemalloc, when no other call is tracing memory: tracing allocations slows
+pandas and JSON parsing down several times, cProfile about twice. The cost is thus low enough to
+leave profiling on in production runs, at the default rates the slowdown is a few percent.
+tracemalloc is process-wide, so in concurrent runs the memory of a stage includes allocations made
+by other threads at the same time.
+
+write() saves, per stage, its merged cProfile statistics (<stage>.prof, for pstats or snakeviz),
+the functions with most cumulative time (<stage>.txt) and the lines that allocated most of the
+memory still held at the end of traced calls (<stage>.allocations.txt), and stages.json with the
+time, calls and peak memory of every stage. Memory of a stage includes the stages nested in it.
+"""
+import contextlib
+import cProfile
+import functools
+import io
+import json
+import os
+import pstats
+import random
+import threading
+import time
+import tracemalloc
+
+# Allocation sites kept per stage between writes, the largest ones
+MAX_ALLOCATION_SITES = 1000
+
+
+class _Call:
+    # One call of a stage on the stack of a thread
+
+    def __init__(self, path, sampled, traced):
+        self.path = path
+        self.sampled = sampled
+        self.traced = traced
+        self.start = time.perf_counter()
+        # Seconds spent in nested stages
+        self.nested = 0.0
+        self.profile = None
+        # False if the profile could not be enabled
+        self.profiling = False
+        self.memory = False
+
+
+class StageStats:
+
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.sampled = 0
+        self.memory_samples = 0
+        self.peak_bytes = 0
+        self.retained_bytes = 0
+        self.profile = None
+        # "file:line" -> [bytes, blocks] still allocated at the end of traced calls
+        self.allocations = {}
+
+    def summary(self):
+        return {"calls": self.calls, "seconds": self.seconds,
+                "mean": self.seconds / self.calls if self.calls else None, "sampled": self.sampled,
+                "memory_samples": self.memory_samples, "peak_bytes": self.peak_bytes,
+                "mean_retained_bytes": self.retained_bytes / self.memory_samples if self.memory_samples else None}
+
+
+class Profiler:
+
+    def __init__(self, output_dir, sample_rate=0.05, memory_rate=0.01, top=25, nframes=1, seed=None):
+        """
+        :param output_dir: directory the profiles are written to by write()
+        :param sample_rate: float, fraction of the calls of each stage profiled, 1 profiles all of them
+        :param memory_rate: float, fraction of the calls of each stage traced with tracemalloc, 0 for none
+        :param top: int, number of functions and allocation sites written per stage
+        :param nframes: int, frames of traceback kept by tracemalloc per allocation
+        :param seed: random seed of the sampling
+        """
+        self.output_dir = output_dir
+        self.sample_rate = sample_rate
+        self.memory_rate = memory_rate
+        self.top = top
+        self.nframes = nframes
+        self._random = random.Random(seed)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # Only one sampled call traces memory at a time, tracemalloc is process-wide
+        self._memory_lock = threading.Lock()
+        # stage path -> StageStats
+        self._stages = {}
+
+    def _stack(self):
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    @staticmethod
+    def _enable(call):
+        # Python 3.12+ allows only one active profiler per process, calls sampled at the same time
+        # in other threads are then only timed
+        try:
+            call.profile.enable()
+            call.profiling = True
+        except ValueError:
+            call.profiling = False
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Time (and, for sampled calls, profile) the code run inside the block as a call of a stage
+
+        :param name: string, stage name, e.g. query
+        """
+        stack = self._stack()
+        parent = stack[-1] if stack else None
+        if parent is not None:
+            # Nested stages are sampled with the call they are part of, their memory is traced by it
+            call = _Call(parent.path + "/" + name, parent.sampled, False)
+            if parent.profiling:
+                parent.profile.disable()
+        else:
+            with self._lock:
+                sampled = self._random.random() < self.sample_rate
+                traced = self._random.random() < self.memory_rate
+            call = _Call(name, sampled, traced)
+
+        if call.traced and not tracemalloc.is_tracing() and self._memory_lock.acquire(blocking=False):
+            call.memory = True
+            tracemalloc.start(self.nframes)
+        if call.sampled:
+            call.profile = cProfile.Profile()
+            self._enable(call)
+        stack.append(call)
+        try:
+            yield
+        finally:
+            if call.profiling:
+                call.profile.disable()
+            end = time.perf_counter()
+            snapshot = None
+            peak = 0
+            if call.memory:
+                snapshot = tracemalloc.take_snapshot()
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                self._memory_lock.release()
+            stack.pop()
+            if parent is not None:
+                parent.nested += end - call.start
+                if parent.profile is not None and parent.profiling:
+                    self._enable(parent)
+            self._record(call, end - call.start - call.nested, snapshot, peak)
+
+    def _record(self, call, seconds, snapshot, peak):
+        stats_profile = None
+        if call.profile is not None:
+            try:
+                stats_profile = pstats.Stats(call.profile, stream=io.StringIO())
+            except TypeError:
+                # Nothing was profiled, e.g. the profiler could not be enabled
+                pass
+        allocations = []
+        if snapshot is not None:
+            # Allocations of the profiling itself
+            snapshot = snapshot.filter_traces([tracemalloc.Filter(False, module.__file__)
+                                               for module in (tracemalloc, cProfile, pstats, contextlib)] +
+                                              [tracemalloc.Filter(False, __file__)])
+            allocations = snapshot.statistics("lineno")
+
+        with self._lock:
+            stats = self._stages.get(call.path)
+            if stats is None:
+                stats = self._stages[call.path] = StageStats()
+            stats.calls += 1
+            stats.seconds += seconds
+            if call.sampled:
+                stats.sampled += 1
+            if stats_profile is not None:
+                if stats.profile is None:
+                    stats.profile = stats_profile
+                else:
+                    stats.profile.add(stats_profile)
+            if snapshot is not None:
+                stats.memory_samples += 1
+                stats.peak_bytes = max(stats.peak_bytes, peak)
+                for statistic in allocations:
+                    stats.retained_bytes += statistic.size
+                    frame = statistic.traceback[0]
+                    site = stats.allocations.setdefault("%s:%d" % (frame.filename, frame.lineno), [0, 0])
+                    site[0] += statistic.size
+                    site[1] += statistic.count
+                if len(stats.allocations) > 2 * MAX_ALLOCATION_SITES:
+                    largest = sorted(stats.allocations.items(), key=lambda item: -item[1][0])
+                    stats.allocations = dict(largest[:MAX_ALLOCATION_SITES])
+
+    def summary(self):
+        """
+        :return: dict stage path -> {calls, seconds, mean, sampled, memory_samples, peak_bytes,
+                 mean_retained_bytes}, seconds exclude nested stages
+        """
+        with self._lock:
+            return {path: stats.summary() for path, stats in sorted(self._stages.items())}
+
+    def write(self, output_dir=None):
+        """
+        Write the profiles of every stage, see the module documentation
+
+        :param output_dir: directory, default the one given to the constructor
+        :return: path of stages.json
+        """
+        output_dir = output_dir or self.output_dir
+        os.makedirs(output_dir, exist_ok=True)
+        with self._lock:
+            for path, stats in self._stages.items():
+                prefix = os.path.join(output_dir, path.replace("/", "."))
+                if stats.profile is not None:
+                    stats.profile.dump_stats(prefix + ".prof")
+                    with open(prefix + ".txt", "w") as f:
+                        stats.profile.stream = f
+                        f.write("Stage %s: %d calls, %d profiled\n" % (path, stats.calls, stats.sampled))
+                        stats.profile.sort_stats("cumulative").print_stats(self.top)
+                        stats.profile.stream = io.StringIO()
+                if stats.allocations:
+                    with open(prefix + ".allocations.txt", "w") as f:
+                        f.write("Stage %s: memory still allocated at the end of %d traced calls, by line\n"
+                                % (path, stats.memory_samples))
+                        f.write("%12s %10s  %s\n" % ("KiB", "blocks", "line"))
+                        for site, (size, count) in sorted(stats.allocations.items(),
+                                                          key=lambda item: -item[1][0])[:self.top]:
+                            f.write("%12.1f %10d  %s\n" % (size / 1024.0, count, site))
+            summary = {path: stats.summary() for path, stats in sorted(self._stages.items())}
+
+        summary_path = os.path.join(output_dir, "stages.json")
+        with open(summary_path, "w") as f:
+            json.dump({"sample_rate": self.sample_rate, "memory_rate": self.memory_rate, "stages": summary}, f,
+                      indent=2)
+        return summary_path
+
+    def print_summary(self):
+        summary = self.summary()
+        if not summary:
+            return
+        total = sum(stats["seconds"] for stats in summary.values()) or 1.0
+        print("PROFILE BY STAGE (seconds exclude nested stages, %g%% of calls profiled, %g%% memory traced)"
+              % (100 * self.sample_rate, 100 * self.memory_rate))
+        print("%-32s %8s %10s %10s %7s %8s %12s" % ("stage", "calls", "seconds", "mean", "share", "sampled",
+                                                   "peak MiB"))
+        for path, stats in summary.items():
+            print("%-32s %8d %10.3f %10.5f %6.1f%% %8d %12.1f" % (path, stats["calls"], stats["seconds"],
+                                                                 stats["mean"], 100 * stats["seconds"] / total,
+                                                                 stats["sampled"], stats["peak_bytes"] / 2 ** 20))
+        print("------------------------------------------------------")
+
+
+# Profiler used by stage(), None when profiling is off
+_default_profiler = None
+# Block used by stage() when profiling is off
+_null_stage = contextlib.nullcontext()
+
+
+def set_default_profiler(profiler):
+    """
+    :param profiler: Profiler used by stage(), or None to turn profiling off
+    """
+    global _default_profiler
+    _default_profiler = profiler
+
+
+def get_default_profiler():
+    """
+    :return: Profiler used by stage(), None if profiling is off
+    """
+    return _default_profiler
+
+
+def stage(name):
+    """
+    :param name: string, stage name
+    :return: context manager timing the block as a call of the stage with the default profiler. Does
+             nothing when profiling is off
+    """
+    profiler = _default_profiler
+    if profiler is None:
+        return _null_stage
+    return profiler.stage(name)
+
+
+def profiled(name):
+    """
+    Decorator running every call of a function as a call of a stage, see stage()
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+
+"""
+Adaptive rate limiting and retries of API queries
+
+AdaptiveLimiter paces requests to a node with additive increase / multiplicative decrease: every
+request that succeeds with a healthy latency raises the rate a little, every throttled (429, 503),
+failed (502, 504) or timed out request, or a latency well above the usual one, cuts it. The rate
+is cut at most once per second, so that a burst of errors from requests already in flight counts
+as one sign of overload. A Retry-After header pauses all requests for the time asked by the server.
+
+call() performs a request through the limiter and retries transient failures with exponential
+backoff and full jitter.
+"""
+import http.client
+import random
+import socket
+import ssl
+import threading
+import time
+import urllib.error
+
+# HTTP status codes worth retrying, the node is overloaded or restarting
+TRANSIENT_CODES = (429, 502, 503, 504)
+# Status codes that mean the request rate is too high
+THROTTLE_CODES = (429, 503)
+# Errors worth retrying: timeouts, and connections dropped by a node that is overloaded or restarting
+TRANSIENT_ERRORS = (socket.timeout, TimeoutError, ConnectionResetError, ConnectionAbortedError, BrokenPipeError,
+                    http.client.RemoteDisconnected, http.client.IncompleteRead)
+# Errors of a misconfiguration that retrying cannot fix, e.g. a certificate that does not verify or a
+# host name that does not resolve. A refused connection (wrong port) is not transient either
+PERMANENT_ERRORS = (ssl.SSLError, socket.gaierror)
+
+
+def is_transient(error):
+    """
+    :param error: exception raised by a query
+    :return: True if the query may succeed when retried
+    """
+    if isinstance(error, urllib.error.HTTPError):
+        return error.code in TRANSIENT_CODES
+    if isinstance(error, urllib.error.URLError):
+        reason = error.reason
+        if isinstance(reason, str):
+            return "timed out" in reason
+        error = reason
+    return isinstance(error, TRANSIENT_ERRORS) and not isinstance(error, PERMANENT_ERRORS)
+
+
+def retry_after(error):
+    """
+    :param error: exception raised by a query
+    :return: float, seconds the server asked to wait in a Retry-After header, None if it did not
+    """
+    headers = getattr(error, "headers", None)
+    if headers is None:
+        return None
+    value = headers.get("Retry-After")
+    try:
+        return max(float(value), 0.0)
+    except (TypeError, ValueError):
+        # HTTP dates are not supported, fall back to the backoff delay
+        return None
+
+
+class AdaptiveLimiter:
+
+    def __init__(self, initial_rate=1.0, min_rate=0.5, max_rate=20.0, increase=0.25, decrease=0.5,
+                 slow_factor=3.0, cooldown=1.0):
+        """
+        :param initial_rate: float, requests per second to start with
+        :param min_rate: float, lowest rate the limiter backs off to
+        :param max_rate: float, highest rate, None for no limit
+        :param increase: float, requests per second added after each healthy response
+        :param decrease: float, factor the rate is multiplied by when the node is overloaded
+        :param slow_factor: float, a response slower than slow_factor times the average latency
+                            counts as a sign of overload
+        :param cooldown: float, seconds after a cut during which the rate is not cut again
+        """
+        self.rate = initial_rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.slow_factor = slow_factor
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        # Earliest time the next request may be sent
+        self._next_time = 0.0
+        # Exponentially weighted average latency of successful requests
+        self._latency = None
+        # Time of the last cut of the rate
+        self._cut_time = float("-inf")
+
+    def acquire(self):
+        """
+        Block until the next request may be sent
+        """
+        with self._lock:
+            now = time.monotonic()
+            send_time = max(now, self._next_time)
+            self._next_time = send_time + 1.0 / self.rate
+        delay = send_time - now
+        if delay > 0:
+            time.sleep(delay)
+
+    def _set_rate(self, rate):
+        if self.max_rate is not None:
+            rate = min(rate, self.max_rate)
+        self.rate = max(rate, self.min_rate)
+
+    def _cut(self, factor):
+        now = time.monotonic()
+        if now - self._cut_time >= self.cooldown:
+            self._cut_time = now
+            self._set_rate(self.rate * factor)
+
+    def success(self, latency):
+        """
+        :param latency: float, seconds the request took
+        """
+        with self._lock:
+            if self._latency is not None and latency > self.slow_factor * self._latency:
+                # Slow response, ease off before the node starts failing
+                self._cut((1 + self.decrease) / 2)
+            else:
+                self._set_rate(self.rate + self.increase)
+            self._latency = latency if self._latency is None else 0.9 * self._latency + 0.1 * latency
+
+    def cooling_down(self):
+        """
+        :return: True if the rate was cut less than cooldown seconds ago, the node is overloaded
+        """
+        with self._lock:
+            return time.monotonic() - self._cut_time < self.cooldown
+
+    def overloaded(self, pause=None):
+        """
+        :param pause: float, seconds no request should be sent for (Retry-After), None for no pause
+        """
+        with self._lock:
+            self._cut(self.decrease)
+            if pause:
+                self._next_time = max(self._next_time, time.monotonic() + pause)
+
+
+class RetryPolicy:
+
+    def __init__(self, max_retries=4, base_delay=0.5, max_delay=30.0):
+        """
+        :param max_retries: int, number of retries after the first attempt
+        :param base_delay: float, seconds of the first backoff
+        :param max_delay: float, longest backoff in seconds
+        """
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt, server_delay=None):
+        """
+        :param attempt: int, number of attempts made so far
+        :param server_delay: float, seconds asked by the server with Retry-After, if any
+        :return: float, seconds to wait before the next attempt: full jitter exponential backoff, at
+                 least what the server asked for
+        """
+        backoff = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+        return max(backoff, server_delay or 0.0)
+
+
+def call(request, description="", limiter=None, policy=None):
+    """
+    Perform a request through the rate limiter, retrying transient failures
+
+    :param request: callable performing one attempt, raising on failure
+    :param description: string, e.g. the URL, printed with retries
+    :param limiter: AdaptiveLimiter, defaults to get_default_limiter(). None to not limit
+    :param policy: RetryPolicy, defaults to get_default_policy()
+    :return: whatever request returns
+    :raises: the last error once retries are exhausted, or any non transient error
+    """
+    if limiter is None:
+        limiter = get_default_limiter()
+    if policy is None:
+        policy = get_default_policy()
+
+    attempt = 0
+    while True:
+        attempt += 1
+        if limiter is not None:
+            limiter.acquire()
+        start_time = time.perf_counter()
+        try:
+            result = request()
+        except Exception as e:
+            if not is_transient(e):
+                raise
+            server_delay = retry_after(e)
+            if limiter is not None:
+                limiter.overloaded(server_delay)
+            if policy is None or attempt > policy.max_retries:
+                raise
+            delay = policy.delay(attempt, server_delay)
+            print("Retrying", description, "in %.1f seconds after" % delay, repr(e))
+            time.sleep(delay)
+            continue
+        if limiter is not None:
+            limiter.success(time.perf_counter() - start_time)
+        return result
+
+
+# Limiter and retry policy used by callers that do not provide their own
+_default_limiter = None
+_default_policy = RetryPolicy()
+
+
+def set_default_limiter(limiter):
+    """
+    :param limiter: AdaptiveLimiter used by default, or None to not limit requests
+    """
+    global _default_limiter
+    _default_limiter = limiter
+
+
+def get_default_limiter():
+    """
+    :return: AdaptiveLimiter used by default, None if requests are not limited
+    """
+    return _default_limiter
+
+
+def set_default_policy(policy):
+    """
+    :param policy: RetryPolicy used by default, or None to not retry
+    """
+    global _default_policy
+    _default_policy = policy
+
+
+def get_default_policy():
+    """
+    :return: RetryPolicy used by default, None if failed requests are not retried
+    """
+    return _default_policy
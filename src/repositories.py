@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+
+"""
+Stats API validation across many repositories
+
+Runs main.main() for every repository of a repositories file in its own worker process, so the
+JSON parsing and pandas work of one repository does not compete with the others for the GIL, and
+merges their results into one report with a repository column.
+
+The repositories file is a JSON (or YAML) list with one object per repository:
+
+    [{"name": "COVID19-1", "base_url": "https://covid19-1.ireceptor.org", "max_workers": 4},
+     {"name": "IPA1", "base_url": "https://ipa1.ireceptor.org", "max_workers": 1, "query_delay": 2}]
+
+name and base_url are required. Any other key is a main() option that overrides the default for
+that repository only, e.g. max_workers, batch_size, query_delay and max_rate to give each repository
+its own concurrency and rate limit, or relative_path_stats and relative_path_facet for its query files.
+Each repository writes its results and a log of its output in <details_dir>/<name>/.
+"""
+import argparse
+import contextlib
+import inspect
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import yaml
+
+import main as validation
+import result_writer
+
+# main() options that cannot be set per repository
+RESERVED_OPTIONS = ("base_url", "repository_name", "details_dir")
+
+
+def load_repositories(path):
+    """
+    :param path: path to repositories file, JSON or YAML
+    :return: list of dicts with at least name and base_url
+    """
+    with open(path, "r") as f:
+        repositories = yaml.safe_load(f)
+
+    if not isinstance(repositories, list):
+        raise ValueError("repositories file must contain a list of repositories")
+
+    options = inspect.signature(validation.main).parameters
+    names = set()
+    for repository in repositories:
+        if "name" not in repository or "base_url" not in repository:
+            raise ValueError("repository without name or base_url: " + str(repository))
+        if repository["name"] in names:
+            raise ValueError("repository name used twice: " + repository["name"])
+        names.add(repository["name"])
+        unknown = [key for key in repository if key not in options and key != "name"]
+        unknown += [key for key in repository if key in RESERVED_OPTIONS and key != "base_url"]
+        if unknown:
+            raise ValueError("unknown options for repository " + repository["name"] + ": " + ", ".join(unknown))
+
+    return repositories
+
+
+def repository_path(path, name):
+    """
+    :param path: path to a file shared by all repositories, e.g. checkpoints.jsonl
+    :param name: repository name
+    :return: path to the file of one repository, e.g. checkpoints_COVID19-1.jsonl. None for None
+    """
+    if path is None:
+        return None
+    root, extension = os.path.splitext(path)
+    return root + "_" + name + extension
+
+
+def repository_options(repository, details_dir, options):
+    """
+    :param repository: dict from the repositories file
+    :param details_dir: directory where the results of all repositories are stored
+    :param options: dict with main() options shared by all repositories
+    :return: dict with the main() keyword arguments of the repository
+    """
+    name = repository["name"]
+    kwargs = dict(options)
+    # Per-repository files, so that worker processes never write to the same file
+    kwargs["timings_file"] = repository_path(kwargs.get("timings_file"), name)
+    kwargs["checkpoint_file"] = repository_path(kwargs.get("checkpoint_file"), name)
+    kwargs.update({key: value for key, value in repository.items() if key != "name"})
+    kwargs["repository_name"] = name
+    kwargs["details_dir"] = os.path.join(details_dir, name, "")
+    return kwargs
+
+
+def validate_repository(name, kwargs):
+    """
+    Run main() for one repository, in a worker process. Its output goes to <details_dir>/<name>.log
+
+    :param name: repository name
+    :param kwargs: main() keyword arguments, see repository_options
+    :return: dict with name, status ('ok', 'partial' if some repertoires failed or 'error'),
+             seconds, log, the paths of the 'sum_count' and 'final_count' results files and the error if any
+    """
+    os.makedirs(kwargs["details_dir"], exist_ok=True)
+    log_path = os.path.join(kwargs["details_dir"], name + ".log")
+    summary = {"name": name, "status": "ok", "log": log_path, "sum_count": None, "final_count": None,
+               "error": None}
+    start_time = time.perf_counter()
+    with open(log_path, "w") as log, contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+        try:
+            paths = validation.main(**kwargs)
+            summary.update(paths)
+            if paths.get("failed_repertoires"):
+                summary["status"] = "partial"
+        except Exception as e:
+            traceback.print_exc()
+            summary["status"] = "error"
+            summary["error"] = repr(e)
+    summary["seconds"] = time.perf_counter() - start_time
+    return summary
+
+
+def merge_results(summaries, path_prefix, key, output_format="csv", compression=None):
+    """
+    Concatenate the results files of every repository into one, one repository at a time
+
+    :param summaries: list of validate_repository() results
+    :param path_prefix: path of the merged file without extension
+    :param key: 'sum_count' or 'final_count'
+    :return: path of the merged file, None if no repository has results
+    """
+    sink = result_writer.ResultSink(path_prefix, output_format, compression)
+    for summary in summaries:
+        if summary.get(key) is None:
+            continue
+        df = result_writer.read_results(summary[key])
+        df.insert(0, "repository", summary["name"])
+        sink.append(df)
+    return sink.close()
+
+
+def validate_repositories(repositories, details_dir, processes=None, **options):
+    """
+    Run the validation of every repository in parallel worker processes and merge the results
+
+    :param repositories: list of dicts, see load_repositories
+    :param details_dir: directory where results are stored, one subdirectory per repository
+    :param processes: int, number of repositories validated at the same time. None for one per repository
+    :param options: main() options shared by all repositories
+    :return: list with the validate_repository() result of every repository, in repositories order
+    """
+    options.setdefault("entry_pt", inspect.signature(validation.main).parameters["entry_pt"].default)
+    output_format = options.get("output_format", "csv")
+    compression = options.get("compression")
+    stats_name = validation.statistic_name_of(options["entry_pt"])
+    os.makedirs(details_dir, exist_ok=True)
+
+    summaries = {}
+    with ProcessPoolExecutor(max_workers=processes or len(repositories)) as executor:
+        futures = {executor.submit(validate_repository, repository["name"],
+                                   repository_options(repository, details_dir, options)): repository["name"]
+                   for repository in repositories}
+        # Report repositories as they finish, a slow one does not hold up the others
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                summary = future.result()
+            except Exception as e:
+                summary = {"name": name, "status": "error", "error": repr(e), "seconds": 0, "log": None,
+                           "sum_count": None, "final_count": None}
+            summaries[name] = summary
+            print("%-20s %-8s %8.1fs  log: %s" % (name, summary["status"], summary["seconds"], summary["log"]))
+            if summary["error"]:
+                print("    ", summary["error"])
+
+    summaries = [summaries[repository["name"]] for repository in repositories]
+
+    # Merged report tagged by repository
+    print("Merging results of", len(summaries), "repositories")
+    for key, suffix in (("sum_count", "SumCountTotalStat"), ("final_count", "FinalCount"),
+                        ("schema_violations", "SchemaViolations"), ("histogram_checks", "HistogramChecks"),
+                        ("failed_repertoires", "FailedRepertoires")):
+        if not any(summary.get(key) for summary in summaries):
+            continue
+        merge_results(summaries, validation.result_path_prefix(os.path.join(details_dir, ""), "AllRepositories",
+                                                         stats_name, suffix),
+                      key, output_format, compression)
+
+    return summaries
+
+
+def getArguments():
+    """
+    This function facilitates reading parameters
+
+    """
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description="Validate the Stats API of many repositories in parallel processes"
+    )
+    parser.add_argument(
+        "repositories_file",
+        help="JSON or YAML list of repositories, each with a name, a base_url and optional main() options")
+    parser.add_argument(
+        "details_dir",
+        help="Directory where results are stored, one subdirectory per repository")
+    parser.add_argument(
+        "--entry-point",
+        default="rearrangement/count",
+        help="Stats API entry point: rearrangement/count, rearrangement/junction_length or rearrangement/gene_usage")
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=None,
+        help="Number of repositories validated at the same time, default one per repository")
+    parser.add_argument(
+        "--max-workers",
+        type=int,
+        default=1,
+        help="Default number of repertoires queried concurrently in each repository")
+    parser.add_argument(
+        "--query-delay",
+        type=float,
+        default=1,
+        help="Default seconds between queries to start with in each repository, the rate then adapts")
+    parser.add_argument(
+        "--max-rate",
+        type=float,
+        default=20.0,
+        help="Default highest number of queries per second sent to each repository")
+    parser.add_argument(
+        "--output-format",
+        choices=result_writer.FORMATS,
+        default="csv",
+        help="Format of the results files")
+    parser.add_argument(
+        "--compression",
+        default=None,
+        help="'gzip' for csv output, Parquet codec for parquet output")
+    parser.add_argument(
+        "--cache-dir",
+        default=None,
+        help="Directory of the response cache shared by all repositories")
+    parser.add_argument(
+        "--checkpoint-file",
+        default=None,
+        help="JSONL checkpoint file, one per repository is derived from it")
+    parser.add_argument(
+        "--timings-file",
+        default=None,
+        help="JSONL timings file, one per repository is derived from it")
+    parser.add_argument(
+        "--history-db",
+        default=None,
+        help="SQLite database the results of every repository are added to, shared by all repositories")
+
+    return parser.parse_args()
+
+
+def main():
+    options = getArguments()
+    summaries = validate_repositories(load_repositories(options.repositories_file), options.details_dir,
+                                      options.processes,
+                                      entry_pt=options.entry_point,
+                                      max_workers=options.max_workers,
+                                      query_delay=options.query_delay,
+                                      max_rate=options.max_rate,
+                                      output_format=options.output_format,
+                                      compression=options.compression,
+                                      cache_dir=options.cache_dir,
+                                      checkpoint_file=options.checkpoint_file,
+                                      timings_file=options.timings_file,
+                                      history_db=options.history_db)
+    failed = [summary["name"] for summary in summaries if summary["status"] != "ok"]
+    if failed:
+        print("Repositories that did not complete:", ", ".join(failed))
+
+
+if __name__ == "__main__":
+    main()
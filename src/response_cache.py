@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+
+"""
+Content-addressed on-disk cache of API responses
+
+Entries are keyed on the query URL and the canonicalized JSON query body, and stored as
+<cache_dir>/<key[:2]>/<key>.body with a <key>.meta JSON sidecar. The body is written once, so
+its modification time is the creation time used for TTL expiry; the modification time of the
+sidecar is updated on every hit and is the last access time used for LRU eviction.
+
+Modes:
+    readwrite: serve fresh entries from the cache, query and store on a miss
+    record:    always query and store, never serve from the cache
+    replay:    only serve from the cache, never touch the network
+    off:       bypass the cache
+"""
+import contextlib
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+MODES = ("readwrite", "record", "replay", "off")
+# Fraction of max_bytes eviction brings the cache down to. Eviction lists the whole cache, leaving
+# room below the limit means it runs once per that much new data rather than on every store
+EVICTION_TARGET = 0.9
+
+
+def cache_key(query_url, query_dict):
+    """
+    :param query_url: string, entry point of the query (URL)
+    :param query_dict: dict with the query body
+    :return: hex digest uniquely identifying the (URL, canonicalized query body) pair
+    """
+    canonical = json.dumps(query_dict, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256((query_url + "\n" + canonical).encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+
+    def __init__(self, cache_dir, mode="readwrite", max_bytes=1 << 30, ttl=None):
+        """
+        :param cache_dir: directory where responses are stored, created if needed
+        :param mode: one of MODES
+        :param max_bytes: int, total size of stored responses above which least recently used
+                          entries are evicted. None for no limit
+        :param ttl: float, seconds after which an entry is no longer served. None for no expiry
+        """
+        if mode not in MODES:
+            raise ValueError("cache mode must be one of " + ", ".join(MODES))
+        self.cache_dir = cache_dir
+        self.mode = mode
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self._size = sum(entry[1] for entry in self._entries())
+
+    @property
+    def reads(self):
+        return self.mode in ("readwrite", "replay")
+
+    @property
+    def writes(self):
+        return self.mode in ("readwrite", "record")
+
+    @property
+    def offline(self):
+        return self.mode == "replay"
+
+    def _paths(self, key):
+        directory = os.path.join(self.cache_dir, key[:2])
+        return os.path.join(directory, key + ".body"), os.path.join(directory, key + ".meta")
+
+    def _entries(self):
+        # (key, body size, creation time, last access time) of every stored entry
+        for directory in os.listdir(self.cache_dir):
+            directory = os.path.join(self.cache_dir, directory)
+            if not os.path.isdir(directory):
+                continue
+            for name in os.listdir(directory):
+                if not name.endswith(".meta"):
+                    continue
+                key = name[:-len(".meta")]
+                body_path, meta_path = self._paths(key)
+                try:
+                    yield (key, os.path.getsize(body_path), os.path.getmtime(body_path),
+                           os.path.getmtime(meta_path))
+                except OSError:
+                    continue
+
+    def _remove(self, key):
+        for path in self._paths(key):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def metadata(self, query_url, query_dict):
+        """
+        :return: dict with url, query, charset, created and size of a fresh entry, None on a miss
+        """
+        key = cache_key(query_url, query_dict)
+        body_path, meta_path = self._paths(key)
+        try:
+            with open(meta_path, "r") as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not os.path.exists(body_path):
+            return None
+        if self._expired(meta["created"], time.time()):
+            return None
+        # Record the access for LRU eviction
+        try:
+            os.utime(meta_path)
+        except OSError:
+            pass
+        return meta
+
+    def open(self, query_url, query_dict):
+        """
+        :return: (binary file object with the stored body, charset) of a fresh entry, None on a miss
+        """
+        meta = self.metadata(query_url, query_dict)
+        if meta is None:
+            return None
+        body_path, _ = self._paths(cache_key(query_url, query_dict))
+        try:
+            return open(body_path, "rb"), meta["charset"]
+        except OSError:
+            return None
+
+    def get(self, query_url, query_dict):
+        """
+        :return: decoded body of a fresh entry, None on a miss
+        """
+        entry = self.open(query_url, query_dict)
+        if entry is None:
+            return None
+        f, charset = entry
+        with f:
+            return f.read().decode(charset)
+
+    @contextlib.contextmanager
+    def store(self, query_url, query_dict, charset="utf-8"):
+        """
+        Yield a binary file object to write a response body into. The entry is committed when the
+        block exits normally and discarded if it raises
+
+        :param query_url: string, entry point of the query (URL)
+        :param query_dict: dict with the query body
+        :param charset: charset of the body that will be written
+        """
+        key = cache_key(query_url, query_dict)
+        body_path, meta_path = self._paths(key)
+        os.makedirs(os.path.dirname(body_path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(body_path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                yield f
+            size = os.path.getsize(tmp_path)
+            meta = {"url": query_url, "query": query_dict, "charset": charset,
+                    "created": time.time(), "size": size}
+            with self._lock:
+                old_size = os.path.getsize(body_path) if os.path.exists(body_path) else 0
+                os.replace(tmp_path, body_path)
+                with open(meta_path, "w") as f:
+                    json.dump(meta, f)
+                self._size += size - old_size
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self.evict()
+
+    def put(self, query_url, query_dict, body, charset="utf-8"):
+        """
+        :param body: str with the response body
+        """
+        with self.store(query_url, query_dict, charset) as f:
+            f.write(body.encode(charset))
+
+    def _expired(self, created, now):
+        return self.ttl is not None and now - created > self.ttl
+
+    def evict(self, force=False):
+        """
+        Once the cache is over max_bytes, remove entries until it fits in EVICTION_TARGET of
+        max_bytes, expired entries first and then least recently used ones. Expired entries are
+        never served, so they are only swept when the cache is over its size limit, or on every
+        call if force is True
+
+        :param force: bool, also remove all expired entries when the cache is within max_bytes
+        """
+        with self._lock:
+            over_size = self.max_bytes is not None and self._size > self.max_bytes
+            if not over_size and not (force and self.ttl is not None):
+                return
+            now = time.time()
+            entries = sorted(self._entries(),
+                             key=lambda entry: (not self._expired(entry[2], now), entry[3]))
+            size = sum(entry[1] for entry in entries)
+            target = self.max_bytes * EVICTION_TARGET if over_size else self.max_bytes
+            for key, entry_size, created, accessed in entries:
+                expired = self._expired(created, now)
+                if not expired and (self.max_bytes is None or size <= target):
+                    continue
+                self._remove(key)
+                size -= entry_size
+            self._size = size
+
+
+class TeeReader:
+    # Binary file object wrapper that copies everything read from fp into
+    # sink, used to record a response while it is being parsed as a stream
+
+    def __init__(self, fp, sink):
+        self.fp = fp
+        self.sink = sink
+
+    def read(self, size=-1):
+        data = self.fp.read(size)
+        self.sink.write(data)
+        return data
+
+
+# Cache used by callers that do not provide their own
+_default_cache = None
+
+
+def set_default_cache(cache):
+    """
+    :param cache: ResponseCache used by default, or None to disable caching
+    """
+    global _default_cache
+    _default_cache = cache
+
+
+def get_default_cache():
+    """
+    :return: ResponseCache used by default, None if caching is disabled
+    """
+    return _default_cache
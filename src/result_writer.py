@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+
+"""
+Incremental writers for validation results
+
+A ResultSink appends each repertoire's dataframe to its output file as soon as it is available,
+instead of concatenating every dataframe at the end of the run, so memory stays flat no matter
+how many repertoires are validated.
+
+Formats:
+    csv:     plain CSV, optionally gzip compressed. Same layout as pd.concat(...).to_csv()
+    parquet: one Parquet row group per append, compressed, dictionary-encoded columns
+    arrow:   Arrow IPC stream, one record batch per append, dictionary-encoded columns. Each batch
+             has its own dictionaries, written as replacements of the previous ones: dictionary
+             deltas would be compared by the writer with the whole dictionary written so far at
+             every batch, a cost growing with the square of the number of repertoires
+
+Parquet and Arrow output require pyarrow.
+"""
+import gzip
+import json
+
+
+FORMATS = ("csv", "parquet", "arrow")
+EXTENSIONS = {"csv": ".csv", "parquet": ".parquet", "arrow": ".arrows"}
+
+# Columns with few distinct values, stored dictionary-encoded in columnar formats
+DICTIONARY_COLUMNS = ("repository", "repertoire_id", "statistic_name", "RepertoireID(JSON)",
+                      "sample_processing_id", "data_processing_id")
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("pyarrow is required for parquet and arrow output, install it with 'pip install pyarrow'")
+    return pyarrow
+
+
+def _columnar_value(value):
+    # Columnar formats need one type per column. Nested values (the data of
+    # a statistic) are stored as JSON, mixed scalars (ResultSum is True,
+    # False, 0 or -1) as strings.
+    if value is None:
+        return None
+    if isinstance(value, (list, dict)):
+        return json.dumps(value)
+    if isinstance(value, float) and value != value:
+        return None
+    return str(value)
+
+
+class ResultSink:
+
+    def __init__(self, path_prefix, output_format="csv", compression=None):
+        """
+        :param path_prefix: path of the output file without extension
+        :param output_format: one of FORMATS
+        :param compression: for csv, 'gzip' or None. For parquet, any codec supported by pyarrow
+                            (default 'snappy'). Ignored for arrow
+        """
+        if output_format not in FORMATS:
+            raise ValueError("output format must be one of " + ", ".join(FORMATS))
+        self.output_format = output_format
+        self.compression = compression
+        self.path = self.path_of(path_prefix, output_format, compression)
+        if output_format != "csv":
+            self._pa = _import_pyarrow()
+        self.rows = 0
+        self._columns = None
+        self._writer = None
+        # Schema of the first dataframe appended, later ones are cast to it
+        self._schema = None
+        # Columns written as strings: those holding strings, objects or booleans in the first dataframe.
+        # Booleans because result columns such as ResultSum are True or False in some dataframes and
+        # mixed with 0 or -1 in others
+        self._string_columns = None
+
+    @staticmethod
+    def path_of(path_prefix, output_format="csv", compression=None):
+        """
+        :return: path of the file written by a ResultSink with these arguments
+        """
+        path = path_prefix + EXTENSIONS[output_format]
+        if output_format == "csv" and compression == "gzip":
+            path += ".gz"
+        return path
+
+    def append(self, df):
+        """
+        Write a dataframe at the end of the output
+
+        :param df: dataframe, its columns must be the same as those of the first dataframe appended.
+                   Missing columns are written as empty values, extra columns are dropped
+        :return: None
+        """
+        if df is None or df.empty:
+            return
+        if self._columns is None:
+            self._columns = list(df.columns)
+        else:
+            df = df.reindex(columns=self._columns)
+
+        if self.output_format == "csv":
+            self._append_csv(df)
+        elif self.output_format == "parquet":
+            self._append_parquet(df)
+        else:
+            self._append_arrow(df)
+        self.rows += df.shape[0]
+
+    def _append_csv(self, df):
+        if self._writer is None:
+            if self.compression == "gzip":
+                self._writer = gzip.open(self.path, "wt", newline="")
+            else:
+                self._writer = open(self.path, "w", newline="")
+            df.to_csv(self._writer)
+        else:
+            df.to_csv(self._writer, header=False)
+
+    def _arrays(self, df, dictionary_encode):
+        pa = self._pa
+        if self._string_columns is None:
+            from pandas.api.types import is_bool_dtype, is_object_dtype, is_string_dtype
+            self._string_columns = set(column for column in self._columns
+                                       if is_string_dtype(df[column]) or is_object_dtype(df[column]) or
+                                       is_bool_dtype(df[column]))
+        arrays = []
+        for column in self._columns:
+            values = df[column]
+            if column in self._string_columns:
+                array = pa.array([_columnar_value(value) for value in values], type=pa.string())
+                if dictionary_encode and column in DICTIONARY_COLUMNS:
+                    # Dictionary of the values of this batch only
+                    array = array.dictionary_encode()
+                arrays.append(array)
+            else:
+                # Missing values are nulls, so that an integer column with some missing values can be
+                # cast back to integers
+                arrays.append(pa.array(values, from_pandas=True))
+        return arrays
+
+    def _append_parquet(self, df):
+        pa = self._pa
+        table = pa.Table.from_arrays(self._arrays(df, dictionary_encode=False), names=self._columns)
+        if self._writer is None:
+            self._schema = table.schema
+            use_dictionary = [column for column in self._columns if column in DICTIONARY_COLUMNS]
+            self._writer = pa.parquet.ParquetWriter(self.path, self._schema, compression=self.compression or "snappy",
+                                                    use_dictionary=use_dictionary)
+        self._writer.write_table(table.cast(self._schema))
+
+    def _append_arrow(self, df):
+        pa = self._pa
+        table = pa.Table.from_arrays(self._arrays(df, dictionary_encode=True), names=self._columns)
+        if self._writer is None:
+            self._schema = table.schema
+            self._writer = pa.ipc.new_stream(self.path, self._schema)
+        self._writer.write_table(table.cast(self._schema))
+
+    def close(self):
+        """
+        Finish the output file
+
+        :return: path of the file written, None if nothing was appended
+        """
+        if self._writer is None:
+            print("No results to write to", self.path)
+            return None
+        self._writer.close()
+        self._writer = None
+        print("Wrote", self.rows, "rows to", self.path)
+        return self.path
+
+
+def read_results(path, dtype=None):
+    """
+    Load a file written by ResultSink
+
+    :param path: path of the output file
+    :param dtype: dict column -> type of csv columns, e.g. str for repertoire IDs that look like numbers.
+                  Parquet and arrow files keep the types they were written with
+    :return: dataframe
+    """
+    if path.endswith(".parquet"):
+        return _import_pyarrow().parquet.read_table(path).to_pandas()
+    if path.endswith(".arrows"):
+        pa = _import_pyarrow()
+        with pa.ipc.open_stream(path) as reader:
+            return reader.read_all().to_pandas()
+    # pandas is only loaded when results are read back, writing works on the dataframes given
+    import pandas as pd
+    return pd.read_csv(path, index_col=0, dtype=dtype)
@@ -0,0 +1,473 @@
+# -*- coding: utf-8 -*-
+
+"""
+Validation of Stats API responses against the Stats API YAML schema
+
+The schema (an OpenAPI document, or a plain JSON schema of the response) is compiled once into a
+tree of small check functions, with $ref resolved at compile time, so validating a response is a
+single pass over it with no schema lookups. Violations are reported per repertoire and statistic.
+
+Supported keywords: $ref, type, nullable, enum, properties, required, additionalProperties, items,
+minItems, maxItems, minimum, maximum, minLength, maxLength, allOf, anyOf, oneOf. Other keywords
+(format, description, example, ...) are ignored.
+"""
+import threading
+
+import yaml
+
+import jsonstream
+
+# Violations kept per response, a response that does not follow the schema at all would
+# otherwise produce one violation per statistic
+MAX_VIOLATIONS = 100
+
+_TYPES = {"object": lambda value: isinstance(value, dict),
+          "array": lambda value: isinstance(value, list),
+          "string": lambda value: isinstance(value, str),
+          "integer": lambda value: isinstance(value, int) and not isinstance(value, bool),
+          "number": lambda value: isinstance(value, (int, float)) and not isinstance(value, bool),
+          "boolean": lambda value: isinstance(value, bool),
+          "null": lambda value: value is None}
+
+
+def load_schema(path):
+    """
+    :param path: path to YAML (or JSON) schema file
+    :return: schema document
+    """
+    with open(path, "r") as f:
+        return yaml.safe_load(f)
+
+
+def resolve_pointer(document, ref):
+    """
+    :param document: schema document
+    :param ref: local reference, e.g. '#/components/schemas/Statistic'
+    :return: the referenced part of the document
+    :raises ValueError: for references outside the document or that do not exist
+    """
+    if not ref.startswith("#"):
+        raise ValueError("only local references are supported: " + ref)
+    node = document
+    for token in ref[1:].split("/"):
+        if not token:
+            continue
+        token = token.replace("~1", "/").replace("~0", "~")
+        try:
+            node = node[int(token)] if isinstance(node, list) else node[token]
+        except (KeyError, IndexError, ValueError):
+            raise ValueError("unresolvable reference " + ref)
+    return node
+
+
+def path_list(path):
+    """
+    :param path: linked path (parent_path, key) built during validation, () for the root
+    :return: list of keys from the root
+    """
+    keys = []
+    while path:
+        path, key = path
+        keys.append(key)
+    keys.reverse()
+    return keys
+
+
+class SchemaCompiler:
+    # Compiles schemas into check(value, path, errors) functions. path is a
+    # linked (parent_path, key) tuple, only turned into a list when a
+    # violation is found, and errors a list of (path, message)
+
+    def __init__(self, document):
+        self.document = document
+        # $ref -> compiled check, shared by every use of the reference
+        self._refs = {}
+
+    def resolve(self, schema):
+        """
+        :return: schema with its $ref followed, None for None
+        """
+        seen = set()
+        while isinstance(schema, dict) and "$ref" in schema:
+            if schema["$ref"] in seen:
+                raise ValueError("circular reference " + schema["$ref"])
+            seen.add(schema["$ref"])
+            schema = resolve_pointer(self.document, schema["$ref"])
+        return schema
+
+    def compile(self, schema):
+        """
+        :param schema: schema (part of the document)
+        :return: check(value, path, errors) function
+        """
+        if schema is True or schema is None or schema == {}:
+            return _accept
+        if schema is False:
+            return _reject
+        if "$ref" in schema:
+            return self._compile_ref(schema["$ref"])
+
+        checks = []
+        types = schema.get("type")
+        nullable = schema.get("nullable", False)
+        if isinstance(types, list):
+            nullable = nullable or "null" in types
+            types = [t for t in types if t != "null"]
+        elif types is not None:
+            types = [types]
+        if types:
+            checks.append(_type_check(types))
+        if "enum" in schema:
+            checks.append(_enum_check(schema["enum"]))
+        if "properties" in schema or "required" in schema or "additionalProperties" in schema:
+            checks.append(self._object_check(schema))
+        if "items" in schema or "minItems" in schema or "maxItems" in schema:
+            checks.append(self._array_check(schema))
+        if "minimum" in schema or "maximum" in schema:
+            checks.append(_range_check(schema.get("minimum"), schema.get("maximum")))
+        if "minLength" in schema or "maxLength" in schema:
+            checks.append(_length_check(schema.get("minLength"), schema.get("maxLength")))
+        for sub_schema in schema.get("allOf", []):
+            checks.append(self.compile(sub_schema))
+        if "anyOf" in schema:
+            checks.append(_any_of_check([self.compile(s) for s in schema["anyOf"]], exactly_one=False))
+        if "oneOf" in schema:
+            checks.append(_any_of_check([self.compile(s) for s in schema["oneOf"]], exactly_one=True))
+
+        if len(checks) == 1 and not nullable:
+            return checks[0]
+
+        def check(value, path, errors):
+            if value is None and nullable:
+                return
+            for sub_check in checks:
+                sub_check(value, path, errors)
+
+        return check
+
+    def _compile_ref(self, ref):
+        if ref not in self._refs:
+            # Registered before compiling, so that recursive schemas terminate
+            compiled = []
+            self._refs[ref] = lambda value, path, errors: compiled[0](value, path, errors)
+            compiled.append(self.compile(resolve_pointer(self.document, ref)))
+            self._refs[ref] = compiled[0]
+        return self._refs[ref]
+
+    def _object_check(self, schema):
+        properties = {key: self.compile(sub_schema) for key, sub_schema in schema.get("properties", {}).items()}
+        required = list(schema.get("required", []))
+        additional = schema.get("additionalProperties", True)
+        check_additional = None if additional is True else self.compile(additional)
+
+        def check(value, path, errors):
+            if not isinstance(value, dict):
+                return
+            for key in required:
+                if key not in value:
+                    errors.append((path, "missing required property '%s'" % key))
+            for key, item in value.items():
+                property_check = properties.get(key)
+                if property_check is not None:
+                    property_check(item, (path, key), errors)
+                elif check_additional is not None:
+                    if additional is False:
+                        errors.append((path, "unexpected property '%s'" % key))
+                    else:
+                        check_additional(item, (path, key), errors)
+
+        return check
+
+    def _array_check(self, schema):
+        items = self.compile(schema["items"]) if "items" in schema else None
+        min_items = schema.get("minItems")
+        max_items = schema.get("maxItems")
+
+        def check(value, path, errors):
+            if not isinstance(value, list):
+                return
+            if min_items is not None and len(value) < min_items:
+                errors.append((path, "fewer than %d items" % min_items))
+            if max_items is not None and len(value) > max_items:
+                errors.append((path, "more than %d items" % max_items))
+            if items is not None:
+                for index, item in enumerate(value):
+                    items(item, (path, index), errors)
+
+        return check
+
+
+def _accept(value, path, errors):
+    pass
+
+
+def _reject(value, path, errors):
+    errors.append((path, "no value allowed"))
+
+
+def _type_check(types):
+    tests = [_TYPES[t] for t in types if t in _TYPES]
+    expected = " or ".join(types)
+
+    def check(value, path, errors):
+        for test in tests:
+            if test(value):
+                return
+        errors.append((path, "expected %s, got %s" % (expected, type(value).__name__ if value is not None
+                                                         else "null")))
+
+    return check
+
+
+def _enum_check(values):
+    def check(value, path, errors):
+        if value not in values:
+            errors.append((path, "%r is not one of %r" % (value, values)))
+
+    return check
+
+
+def _range_check(minimum, maximum):
+    def check(value, path, errors):
+        if not isinstance(value, (int, float)) or isinstance(value, bool):
+            return
+        if minimum is not None and value < minimum:
+            errors.append((path, "%r is less than %r" % (value, minimum)))
+        if maximum is not None and value > maximum:
+            errors.append((path, "%r is more than %r" % (value, maximum)))
+
+    return check
+
+
+def _length_check(min_length, max_length):
+    def check(value, path, errors):
+        if not isinstance(value, str):
+            return
+        if min_length is not None and len(value) < min_length:
+            errors.append((path, "shorter than %d characters" % min_length))
+        if max_length is not None and len(value) > max_length:
+            errors.append((path, "longer than %d characters" % max_length))
+
+    return check
+
+
+def _any_of_check(checks, exactly_one):
+    def check(value, path, errors):
+        matches = 0
+        for sub_check in checks:
+            sub_errors = []
+            sub_check(value, path, sub_errors)
+            if not sub_errors:
+                matches += 1
+        if matches == 0:
+            errors.append((path, "does not match any of the allowed schemas"))
+        elif exactly_one and matches > 1:
+            errors.append((path, "matches more than one of the allowed schemas"))
+
+    return check
+
+
+def _lookup(value, *keys):
+    # value[key0][key1]..., None if any of them is missing
+    for key in keys:
+        try:
+            value = value[key]
+        except (KeyError, IndexError, TypeError):
+            return None
+    return value
+
+
+def find_response_schema(document, entry_pt=None):
+    """
+    :param document: schema document. Either an OpenAPI document, or a schema with a Result property
+    :param entry_pt: stats API entry point, e.g. rearrangement/count, used to pick the response schema
+                     of an OpenAPI document
+    :return: schema of the response of the entry point
+    :raises ValueError: if the document has no Stats API response schema
+    """
+    if "paths" in document:
+        for path, operations in document["paths"].items():
+            if entry_pt is not None and not path.rstrip("/").endswith("/" + entry_pt.strip("/")):
+                continue
+            for operation in operations.values():
+                if not isinstance(operation, dict):
+                    continue
+                response = operation.get("responses", {}).get("200") or operation.get("responses", {}).get(200)
+                if response is None:
+                    continue
+                content = response.get("content", {})
+                for media_type in ("application/json", "*/*"):
+                    if media_type in content and "schema" in content[media_type]:
+                        return content[media_type]["schema"]
+
+    if "Result" in document.get("properties", {}):
+        return document
+    for schema in document.get("components", {}).get("schemas", {}).values():
+        if "Result" in schema.get("properties", {}):
+            return schema
+    raise ValueError("no Stats API response schema found" + (" for " + entry_pt if entry_pt else ""))
+
+
+class StatsResponseValidator:
+
+    def __init__(self, document, entry_pt=None, max_violations=MAX_VIOLATIONS):
+        """
+        :param document: Stats API schema document, see load_schema
+        :param entry_pt: stats API entry point whose responses are validated, e.g. rearrangement/count
+        :param max_violations: int, violations kept per response
+        """
+        self.max_violations = max_violations
+        compiler = SchemaCompiler(document)
+        response_schema = find_response_schema(document, entry_pt)
+        self._check_response = compiler.compile(response_schema)
+
+        # Checks of the response itself for responses parsed as a stream (required keys, Info, ...),
+        # its Result entries are checked one by one below
+        root_schema = dict(compiler.resolve(response_schema))
+        root_schema["properties"] = dict(root_schema.get("properties", {}), Result={})
+        self._root_check = compiler.compile(root_schema)
+
+        # Checks of the items of a Result entry, for responses parsed as a stream
+        entry_schema = compiler.resolve(compiler.resolve(
+            compiler.resolve(response_schema).get("properties", {}).get("Result")) or {}).get("items")
+        entry_schema = compiler.resolve(entry_schema) or {}
+        self._entry_required = list(entry_schema.get("required", []))
+        self._entry_checks = {key: compiler.compile(sub_schema)
+                              for key, sub_schema in entry_schema.get("properties", {}).items()}
+        statistics_schema = compiler.resolve(entry_schema.get("properties", {}).get("statistics")) or {}
+        self._statistic_check = compiler.compile(statistics_schema.get("items"))
+
+        self._lock = threading.Lock()
+        self._violations = []
+
+    def check_response(self, json_resp, query_url=None):
+        """
+        Validate a whole parsed response
+
+        :param json_resp: JSON object with stats API response
+        :param query_url: string, URL the response came from, stored with its violations
+        :return: list of violations of this response, see violations()
+        """
+        errors = []
+        self._check_response(json_resp, (), errors)
+        violations = [self._violation(query_url, path_list(path), message, json_resp)
+                      for path, message in errors[:self.max_violations]]
+        return self._add(violations, len(errors))
+
+    def check_items(self, items, query_url=None):
+        """
+        Validate the Result entries of a response parsed as a stream, item by item
+
+        :param items: iterable of (result_index, key, value), see jsonstream
+        :param query_url: string, URL the response came from, stored with its violations
+        :return: generator yielding the same items once they are checked
+        """
+        # Keys of the response outside of its Result entries, with their values
+        response = {}
+        entry = None
+        errors = []
+        for index, key, value in items:
+            if index is None:
+                response[key] = value
+                yield index, key, value
+                continue
+            if entry is None or entry["index"] != index:
+                self._finish_entry(entry, errors, query_url)
+                entry = {"index": index, "keys": set(), "repertoire": None, "statistics": {}}
+                errors = []
+            path = (((), "Result"), index)
+            if key == jsonstream.EMPTY:
+                # An empty entry, or an empty statistics array: the key is present with no items
+                if value is not None:
+                    entry["keys"].add(value)
+                    if value in self._entry_checks:
+                        self._entry_checks[value]([], (path, value), errors)
+                yield index, key, value
+                continue
+            entry["keys"].add(key)
+            if key == "statistics":
+                # Only the names of statistics with violations are kept
+                statistic = len(entry["statistics"])
+                violation_count = len(errors)
+                self._statistic_check(value, ((path, "statistics"), statistic), errors)
+                entry["statistics"][statistic] = value.get("statistic_name") \
+                    if len(errors) > violation_count and isinstance(value, dict) else None
+            elif key in self._entry_checks:
+                self._entry_checks[key](value, (path, key), errors)
+                if key == "repertoires":
+                    entry["repertoire"] = value
+            yield index, key, value
+        self._finish_entry(entry, errors, query_url)
+
+        errors = []
+        self._root_check(response, (), errors)
+        self._add([self._violation(query_url, path_list(path), message, response)
+                   for path, message in errors[:self.max_violations]], len(errors))
+
+    def _finish_entry(self, entry, errors, query_url):
+        # Report the violations of a Result entry once all of it, including its repertoire, is seen
+        if entry is None:
+            return
+        path = (((), "Result"), entry["index"])
+        for key in self._entry_required:
+            if key not in entry["keys"]:
+                errors.append((path, "missing required property '%s'" % key))
+        # Same layout as a parsed response, enough to name the repertoire and statistics
+        json_resp = {"Result": {entry["index"]: {"repertoires": entry["repertoire"],
+                                                 "statistics": {index: {"statistic_name": name}
+                                                                for index, name in entry["statistics"].items()}}}}
+        self._add([self._violation(query_url, path_list(error_path), message, json_resp)
+                   for error_path, message in errors[:self.max_violations]], len(errors))
+
+    def _violation(self, query_url, keys, message, json_resp):
+        # Repertoire and statistic a violation belongs to, from its path Result/<i>/statistics/<j>/...
+        repertoire_id = None
+        statistic_name = None
+        if len(keys) > 1 and keys[0] == "Result" and isinstance(keys[1], int):
+            entry = _lookup(json_resp, "Result", keys[1])
+            repertoire_id = _lookup(entry, "repertoires", "repertoire_id")
+            if len(keys) > 3 and keys[2] == "statistics":
+                statistic_name = _lookup(entry, "statistics", keys[3], "statistic_name")
+        return {"query_url": query_url, "repertoire_id": repertoire_id, "statistic_name": statistic_name,
+                "path": "/".join(str(key) for key in keys), "message": message}
+
+    def _add(self, violations, total):
+        if total > len(violations):
+            print("Schema validation:", total - len(violations), "more violations not kept")
+        if violations:
+            with self._lock:
+                self._violations.extend(violations)
+        return violations
+
+    def violations(self, clear=True):
+        """
+        :param clear: bool, if True the violations returned are forgotten
+        :return: list of dicts with query_url, repertoire_id, statistic_name, path and message of the
+                 violations found since the last call
+        """
+        with self._lock:
+            violations = self._violations
+            if clear:
+                self._violations = []
+            else:
+                violations = list(violations)
+        return violations
+
+
+# Validator used by callers that do not provide their own
+_default_validator = None
+
+
+def set_default_validator(validator):
+    """
+    :param validator: StatsResponseValidator used by default, or None to disable validation
+    """
+    global _default_validator
+    _default_validator = validator
+
+
+def get_default_validator():
+    """
+    :return: StatsResponseValidator used by default, None if validation is disabled
+    """
+    return _default_validator
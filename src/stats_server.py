@@ -0,0 +1,465 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Local stand-in for an iReceptor node, for scale testing without touching production
+
+Serves synthetic but self-consistent data for a configurable number of repertoires:
+
+    POST /airr/v1/repertoire                                  ADC repertoire query (from, size, fields)
+    POST /airr/v1/rearrangement                               ADC facet query
+    POST /irplus/v1/stats/rearrangement/count                 Stats API
+    POST /irplus/v1/stats/rearrangement/junction_length       Stats API
+    POST /irplus/v1/stats/rearrangement/gene_usage            Stats API
+
+For every repertoire the rearrangement count, the gene usage at call/gene/subgroup level and the
+junction length histograms all agree with each other and with the facet counts, unless a count
+mismatch is injected. Latency, HTTP errors and mismatches can be injected to exercise the
+validation and the HTTP client. Responses are gzip or deflate compressed when the client accepts
+it, like the nginx front end of production nodes.
+
+Example:
+
+    python stats_server.py --repertoires 1000 --port 8080 --query-dir ./local-queries
+    # then, from Python:
+    main.main(base_url="http://127.0.0.1:8080", details_dir="./local-output/",
+              adc_json_files="./local-queries/nofilters.json",
+              relative_path_stats="./local-queries/stats_repertoire_id_",
+              relative_path_facet="./local-queries/facet_repertoire_id_")
+"""
+import argparse
+import functools
+import http.server
+import json
+import os
+import random
+import threading
+import time
+import zlib
+
+# Gene segments and levels reported by the gene_usage endpoint
+SEGMENTS = ("v", "d", "j")
+LEVELS = ("call", "gene", "subgroup")
+# Smaller responses are sent uncompressed, as nginx does by default
+COMPRESSION_MIN_SIZE = 1024
+
+
+def split_count(rng, total, n_parts):
+    """
+    :param rng: random.Random
+    :param total: int, count to split
+    :param n_parts: int, number of parts
+    :return: list of n_parts non-negative ints adding up to total
+    """
+    weights = [rng.random() ** 2 for _ in range(n_parts)]
+    weight_sum = sum(weights) or 1.0
+    parts = [int(total * w / weight_sum) for w in weights]
+    for i in range(total - sum(parts)):
+        parts[i % n_parts] += 1
+    return parts
+
+
+class SyntheticRepository:
+    """
+    Deterministic synthetic repository. Repertoire data is generated on first use from the
+    repository seed and the repertoire index, so any number of repertoires can be served
+    """
+
+    def __init__(self, n_repertoires=100, min_rearrangements=1000, max_rearrangements=100000, n_families=7,
+                 n_genes=8, n_alleles=3, max_junction_aa_length=40, mismatch_rate=0.0, seed=0, rep_ids=None):
+        """
+        :param n_repertoires: int, number of repertoires
+        :param min_rearrangements: int, minimum number of rearrangements per repertoire
+        :param max_rearrangements: int, maximum number of rearrangements per repertoire
+        :param n_families: int, number of subgroups per gene segment
+        :param n_genes: int, number of genes per subgroup
+        :param n_alleles: int, number of alleles per gene. Together with n_families and n_genes this
+                          sets the size of gene_usage responses
+        :param max_junction_aa_length: int, longest junction in amino acids
+        :param mismatch_rate: float, fraction of repertoires whose stats API totals are off by one
+        :param seed: int, random seed
+        :param rep_ids: list of repertoire IDs used instead of generated ones, e.g. those of the sample
+                        query files. n_repertoires is then its length
+        """
+        if rep_ids is not None:
+            n_repertoires = len(rep_ids)
+        self.n_repertoires = n_repertoires
+        self.min_rearrangements = min_rearrangements
+        self.max_rearrangements = max_rearrangements
+        self.n_families = n_families
+        self.n_genes = n_genes
+        self.n_alleles = n_alleles
+        self.max_junction_aa_length = max_junction_aa_length
+        self.mismatch_rate = mismatch_rate
+        self.seed = seed
+        if rep_ids is None:
+            rep_ids = [self.repertoire_id(i) for i in range(n_repertoires)]
+        self.repertoire_ids = [str(i) for i in rep_ids]
+        self._index = {repertoire_id: i for i, repertoire_id in enumerate(self.repertoire_ids)}
+
+    def repertoire_id(self, index):
+        return "%08x%016x" % (self.seed, index)
+
+    def __contains__(self, repertoire_id):
+        return repertoire_id in self._index
+
+    def metadata(self, repertoire_id):
+        """
+        :return: dict with the ADC repertoire metadata of a repertoire
+        """
+        index = self._index[repertoire_id]
+        return {"repertoire_id": repertoire_id,
+                "study": {"study_id": "SYNTHETIC-%d" % self.seed},
+                "subject": {"subject_id": "subject-%d" % index},
+                "sample": [{"sample_id": "sample-%d" % index, "sample_processing_id": None}],
+                "data_processing": [{"data_processing_id": None, "primary_annotation": True}]}
+
+    @functools.lru_cache(maxsize=4096)
+    def rearrangements(self, repertoire_id):
+        """
+        :return: dict with the rearrangement count of a repertoire, its counts per value of every
+                 facetable field and whether its stats API totals are mismatched
+        """
+        index = self._index[repertoire_id]
+        rng = random.Random(self.seed * 1000003 + index)
+        count = rng.randint(self.min_rearrangements, self.max_rearrangements)
+        fields = {}
+
+        for segment in SEGMENTS:
+            calls = ["IGH%s%d-%d*%02d" % (segment.upper(), family + 1, gene + 1, allele + 1)
+                     for family in range(self.n_families)
+                     for gene in range(self.n_genes)
+                     for allele in range(self.n_alleles)]
+            call_counts = dict(zip(calls, split_count(rng, count, len(calls))))
+            gene_counts = {}
+            subgroup_counts = {}
+            for call, call_count in call_counts.items():
+                gene = call.split("*")[0]
+                subgroup = gene.split("-")[0]
+                gene_counts[gene] = gene_counts.get(gene, 0) + call_count
+                subgroup_counts[subgroup] = subgroup_counts.get(subgroup, 0) + call_count
+            fields[segment + "_call"] = call_counts
+            fields[segment + "_gene"] = gene_counts
+            fields[segment + "_subgroup"] = subgroup_counts
+
+        aa_lengths = list(range(5, self.max_junction_aa_length + 1))
+        aa_counts = dict(zip(aa_lengths, split_count(rng, count, len(aa_lengths))))
+        fields["junction_aa_length"] = aa_counts
+        fields["junction_length"] = {3 * length: aa_count for length, aa_count in aa_counts.items()}
+
+        fields["repertoire_id"] = {repertoire_id: count}
+
+        return {"count": count,
+                "fields": fields,
+                "mismatch": rng.random() < self.mismatch_rate}
+
+    def facet(self, field, rep_ids):
+        """
+        :param field: string, field to facet on
+        :param rep_ids: list of repertoire IDs the facet is restricted to
+        :return: list of {field: value, "count": count}, zero counts omitted
+        """
+        totals = {}
+        for repertoire_id in rep_ids:
+            for value, count in self.rearrangements(repertoire_id)["fields"][field].items():
+                totals[value] = totals.get(value, 0) + count
+        return [{field: value, "count": count} for value, count in totals.items() if count > 0]
+
+    def statistics(self, repertoire_id, stats_entry):
+        """
+        :param stats_entry: string, one of count, junction_length, gene_usage
+        :return: list with the Stats API statistics of a repertoire
+        """
+        rearrangements = self.rearrangements(repertoire_id)
+        delta = 1 if rearrangements["mismatch"] else 0
+
+        def statistic(name, field):
+            data = [{"key": str(key), "count": count}
+                    for key, count in rearrangements["fields"][field].items()]
+            return {"statistic_name": name, "total": rearrangements["count"] + delta, "data": data}
+
+        if stats_entry == "count":
+            count = rearrangements["count"]
+            return [{"statistic_name": "rearrangement_count", "total": count + delta,
+                     "data": [{"key": "rearrangement_count", "count": count}]}]
+        if stats_entry == "junction_length":
+            return [statistic("junction_length", "junction_length"),
+                    statistic("junction_aa_length", "junction_aa_length")]
+        if stats_entry == "gene_usage":
+            return [statistic("%s_%s_unique" % (segment, level), "%s_%s" % (segment, level))
+                    for segment in SEGMENTS for level in LEVELS]
+        raise KeyError(stats_entry)
+
+
+def filtered_repertoire_ids(repository, filters):
+    """
+    :param repository: SyntheticRepository
+    :param filters: ADC API filter, only repertoire_id with '=', 'in' and 'and' are supported
+    :return: list of repertoire IDs selected by the filter
+    :raises ValueError: on unsupported filters
+    """
+    if not filters:
+        return list(repository.repertoire_ids)
+
+    op = filters.get("op")
+    content = filters.get("content")
+    if op == "and":
+        selected = set(repository.repertoire_ids)
+        for sub_filter in content:
+            selected &= set(filtered_repertoire_ids(repository, sub_filter))
+        return [i for i in repository.repertoire_ids if i in selected]
+    if op in ("=", "in") and content.get("field") == "repertoire_id":
+        values = content.get("value")
+        if op == "=":
+            values = [values]
+        return [str(value) for value in values if str(value) in repository]
+    raise ValueError("unsupported filter " + json.dumps(filters))
+
+
+class StatsRequestHandler(http.server.BaseHTTPRequestHandler):
+    # Keep connections alive, like the real nodes
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately, do not let Nagle delay the body
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            http.server.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def accepted_encoding(self):
+        # Compression used for the response, from the Accept-Encoding of the request
+        accepted = [value.split(";")[0].strip().lower()
+                    for value in (self.headers.get("Accept-Encoding") or "").split(",")]
+        for encoding in ("gzip", "deflate"):
+            if encoding in accepted:
+                return encoding
+        return None
+
+    def send_json(self, status, body, extra_headers=None):
+        payload = json.dumps(body).encode("utf-8")
+        encoding = self.accepted_encoding() if self.server.compression else None
+        if encoding is not None and len(payload) >= COMPRESSION_MIN_SIZE:
+            wbits = 16 + zlib.MAX_WBITS if encoding == "gzip" else zlib.MAX_WBITS
+            compressor = zlib.compressobj(6, zlib.DEFLATED, wbits)
+            payload = compressor.compress(payload) + compressor.flush()
+        else:
+            encoding = None
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        if encoding is not None:
+            self.send_header("Content-Encoding", encoding)
+        self.send_header("Vary", "Accept-Encoding")
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in (extra_headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_POST(self):
+        server = self.server
+        length = int(self.headers.get("Content-Length") or 0)
+        raw_query = self.rfile.read(length)
+        server.count_request(self.path)
+
+        # Injected latency and errors
+        delay = server.latency + server.rng_uniform(0, server.latency_jitter)
+        if delay > 0:
+            time.sleep(delay)
+        if server.error_rate and server.rng_uniform(0, 1) < server.error_rate:
+            status = server.rng_choice(server.error_codes)
+            headers = {"Retry-After": "1"} if status in (429, 503) else None
+            self.send_json(status, {"message": "injected error"}, headers)
+            return
+
+        try:
+            query = json.loads(raw_query or b"{}")
+            status, body = self.route(query)
+        except ValueError as e:
+            status, body = 400, {"message": str(e)}
+        self.send_json(status, body)
+
+    def route(self, query):
+        repository = self.server.repository
+        info = {"title": "Synthetic iReceptor node", "version": "1.0"}
+        path = self.path.rstrip("/")
+
+        if path == "/airr/v1/repertoire":
+            rep_ids = filtered_repertoire_ids(repository, query.get("filters"))
+            start = int(query.get("from", 0))
+            size = query.get("size")
+            rep_ids = rep_ids[start:] if size is None else rep_ids[start:start + int(size)]
+            repertoires = [repository.metadata(i) for i in rep_ids]
+            fields = query.get("fields")
+            if fields:
+                keep = set(field.split(".")[0] for field in fields)
+                repertoires = [{key: value for key, value in repertoire.items() if key in keep}
+                               for repertoire in repertoires]
+            return 200, {"Info": info, "Repertoire": repertoires}
+
+        if path == "/airr/v1/rearrangement":
+            field = query.get("facets")
+            if not field:
+                raise ValueError("only facet queries are supported")
+            rep_ids = filtered_repertoire_ids(repository, query.get("filters"))
+            if field not in ("repertoire_id", "junction_length", "junction_aa_length") and \
+                    field not in ["%s_%s" % (segment, level) for segment in SEGMENTS for level in LEVELS]:
+                raise ValueError("unsupported facet field " + field)
+            return 200, {"Info": info, "Facet": repository.facet(field, rep_ids)}
+
+        prefix = "/irplus/v1/stats/rearrangement/"
+        if path.startswith(prefix) and path[len(prefix):] in ("count", "junction_length", "gene_usage"):
+            stats_entry = path[len(prefix):]
+            result = []
+            for item in query.get("repertoires", []):
+                repertoire_id = str(item["repertoire"]["repertoire_id"])
+                if repertoire_id not in repository:
+                    continue
+                result.append({"repertoires": {"repertoire_id": repertoire_id,
+                                               "sample_processing_id": None,
+                                               "data_processing_id": None},
+                               "statistics": repository.statistics(repertoire_id, stats_entry)})
+            return 200, {"Info": info, "Result": result}
+
+        return 404, {"message": "unknown entry point " + self.path}
+
+
+class StatsServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, repository, latency=0.0, latency_jitter=0.0, error_rate=0.0,
+                 error_codes=(500, 503, 429), seed=0, verbose=False, compression=True):
+        """
+        :param address: (host, port) to listen on, port 0 picks a free port
+        :param repository: SyntheticRepository served
+        :param latency: float, seconds added to every response
+        :param latency_jitter: float, up to this many more seconds added at random to every response
+        :param error_rate: float, fraction of requests answered with an error status
+        :param error_codes: HTTP status codes of injected errors
+        :param seed: int, random seed of the injections
+        :param verbose: bool, log every request
+        :param compression: bool, compress responses when the client accepts gzip or deflate
+        """
+        http.server.ThreadingHTTPServer.__init__(self, address, StatsRequestHandler)
+        self.repository = repository
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.error_codes = tuple(error_codes)
+        self.verbose = verbose
+        self.compression = compression
+        self.request_counts = {}
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return "http://%s:%d" % (host, port)
+
+    def rng_uniform(self, low, high):
+        with self._lock:
+            return self._rng.uniform(low, high)
+
+    def rng_choice(self, values):
+        with self._lock:
+            return self._rng.choice(values)
+
+    def count_request(self, path):
+        with self._lock:
+            self.request_counts[path] = self.request_counts.get(path, 0) + 1
+
+
+def serve_in_thread(repository, host="127.0.0.1", port=0, **kwargs):
+    """
+    Start a StatsServer in a daemon thread
+
+    :param repository: SyntheticRepository served
+    :param kwargs: passed on to StatsServer
+    :return: the running StatsServer, stop it with shutdown() and server_close()
+    """
+    server = StatsServer((host, port), repository, **kwargs)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def write_query_files(query_dir, rep_ids):
+    """
+    Write the per-repertoire query files and the repertoire query main() expects
+
+    :param query_dir: directory where the files are written, created if needed
+    :param rep_ids: list of repertoire IDs
+    :return: None
+    """
+    os.makedirs(query_dir, exist_ok=True)
+    with open(os.path.join(query_dir, "nofilters.json"), "w") as f:
+        json.dump({}, f)
+    for repertoire_id in rep_ids:
+        with open(os.path.join(query_dir, "stats_repertoire_id_" + repertoire_id + ".json"), "w") as f:
+            json.dump({"repertoires": [{"repertoire": {"repertoire_id": repertoire_id}}]}, f)
+        with open(os.path.join(query_dir, "facet_repertoire_id_" + repertoire_id + ".json"), "w") as f:
+            json.dump({"filters": {"op": "=", "content": {"field": "repertoire_id", "value": repertoire_id}},
+                       "facets": "repertoire_id"}, f)
+
+
+def getArguments():
+    """
+    This function facilitates reading parameters
+
+    """
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description="Local synthetic stand-in for the iReceptor ADC and Stats APIs"
+    )
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on")
+    parser.add_argument("--port", type=int, default=8080, help="Port to listen on")
+    parser.add_argument("--repertoires", type=int, default=100, help="Number of repertoires")
+    parser.add_argument("--min-rearrangements", type=int, default=1000,
+                        help="Minimum number of rearrangements per repertoire")
+    parser.add_argument("--max-rearrangements", type=int, default=100000,
+                        help="Maximum number of rearrangements per repertoire")
+    parser.add_argument("--families", type=int, default=7, help="Subgroups per gene segment")
+    parser.add_argument("--genes", type=int, default=8, help="Genes per subgroup")
+    parser.add_argument("--alleles", type=int, default=3,
+                        help="Alleles per gene, scales the size of gene_usage responses")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every response")
+    parser.add_argument("--latency-jitter", type=float, default=0.0,
+                        help="Up to this many more seconds added at random to every response")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="Fraction of requests answered with an error status")
+    parser.add_argument("--error-codes", default="500,503,429",
+                        help="Comma-separated HTTP status codes of injected errors")
+    parser.add_argument("--mismatch-rate", type=float, default=0.0,
+                        help="Fraction of repertoires whose stats API totals disagree with their data")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    parser.add_argument("--query-dir", default=None,
+                        help="If given, write per-repertoire query files for main() into this directory")
+    parser.add_argument("--no-compression", action="store_true",
+                        help="Never compress responses, even when the client accepts gzip or deflate")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Log every request")
+    return parser.parse_args()
+
+
+def main():
+    options = getArguments()
+    repository = SyntheticRepository(options.repertoires, options.min_rearrangements, options.max_rearrangements,
+                                     options.families, options.genes, options.alleles,
+                                     mismatch_rate=options.mismatch_rate, seed=options.seed)
+    if options.query_dir:
+        write_query_files(options.query_dir, repository.repertoire_ids)
+        print("Query files written to", options.query_dir)
+
+    server = StatsServer((options.host, options.port), repository, options.latency, options.latency_jitter,
+                         options.error_rate, [int(code) for code in options.error_codes.split(",")],
+                         options.seed, options.verbose, not options.no_compression)
+    print("Serving", options.repertoires, "synthetic repertoires on", server.base_url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
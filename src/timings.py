@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+
+"""
+Per-phase latency instrumentation of queries
+
+Every query is recorded as one JSON line with its endpoint, the repertoire(s) it was made for,
+the response size and the time spent in each phase:
+
+    connect:    TCP connection and TLS handshake (0 when a keep-alive connection is reused)
+    ttfb:       sending the request until the response headers arrive (server think time)
+    transfer:   reading the response body
+    decode:     JSON parsing of the body
+    cache_read: reading the response from the response cache
+    process:    pandas processing of the response in ApiStats
+
+At the end of a run the recorder summarizes p50/p95/p99 of every phase per endpoint.
+"""
+import contextlib
+import json
+import threading
+import time
+import urllib.parse
+
+PHASES = ("connect", "ttfb", "transfer", "decode", "cache_read", "process", "total")
+
+# Tags of the records made by the current thread, see tagged()
+_context = threading.local()
+
+
+@contextlib.contextmanager
+def tagged(**tags):
+    """
+    Attach tags (e.g. repertoire_id) to every record made by the current thread inside the block
+    """
+    previous = getattr(_context, "tags", {})
+    _context.tags = dict(previous, **tags)
+    try:
+        yield
+    finally:
+        _context.tags = previous
+
+
+def current_tags():
+    return dict(getattr(_context, "tags", {}))
+
+
+def endpoint_of(query_url, with_host=False):
+    """
+    :param query_url: string, URL of a query
+    :param with_host: bool, if True the host (and port) of the URL is kept in front of the path
+    :return: path of the URL, used to group records per endpoint
+    """
+    parts = urllib.parse.urlsplit(query_url)
+    if with_host:
+        return parts.netloc + (parts.path or "/")
+    return parts.path or "/"
+
+
+def percentile(sorted_values, fraction):
+    """
+    Nearest-rank percentile
+
+    :param sorted_values: non-empty sorted list of numbers
+    :param fraction: float between 0 and 1
+    """
+    rank = max(int(round(fraction * len(sorted_values) + 0.5)) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+class TimedReader:
+    # Binary file object wrapper that accumulates the time spent and bytes
+    # read in read(), used to separate transfer from decode time when a
+    # response is parsed as a stream
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.seconds = 0.0
+        self.bytes = 0
+
+    def read(self, size=-1):
+        start_time = time.perf_counter()
+        data = self.fp.read(size)
+        self.seconds += time.perf_counter() - start_time
+        self.bytes += len(data)
+        return data
+
+
+class TimingRecorder:
+
+    def __init__(self, path=None, by_host=False):
+        """
+        :param path: JSONL file records are appended to. None keeps them in memory only
+        :param by_host: bool, if True endpoints include the host of the URL, to tell servers apart
+        """
+        self.path = path
+        self.by_host = by_host
+        self._file = open(path, "a") if path else None
+        self._lock = threading.Lock()
+        # (endpoint, phase) -> list of seconds
+        self._samples = {}
+
+    def record(self, query_url, phases, size=None, **fields):
+        """
+        :param query_url: string, URL of the query, or endpoint label
+        :param phases: dict phase -> seconds
+        :param size: int, response size in bytes
+        :param fields: additional values stored with the record
+        :return: the record
+        """
+        endpoint = endpoint_of(query_url, self.by_host) if "://" in query_url else query_url
+        record = current_tags()
+        record.update(fields)
+        record.update({"time": time.time(), "endpoint": endpoint, "size": size,
+                       "phases": {phase: round(seconds, 6) for phase, seconds in phases.items()}})
+
+        with self._lock:
+            for phase, seconds in phases.items():
+                self._samples.setdefault((endpoint, phase), []).append(seconds)
+            if self._file is not None:
+                self._file.write(json.dumps(record) + "\n")
+                self._file.flush()
+        return record
+
+    def samples(self, endpoint, phase="total"):
+        """
+        :return: sorted list of the seconds recorded for a phase of an endpoint
+        """
+        with self._lock:
+            return sorted(self._samples.get((endpoint, phase), []))
+
+    def summary(self):
+        """
+        :return: dict endpoint -> phase -> {count, mean, p50, p95, p99} in seconds
+        """
+        with self._lock:
+            samples = {key: sorted(values) for key, values in self._samples.items()}
+
+        result = {}
+        for (endpoint, phase), values in sorted(samples.items()):
+            result.setdefault(endpoint, {})[phase] = {"count": len(values),
+                                                      "mean": sum(values) / len(values),
+                                                      "p50": percentile(values, 0.50),
+                                                      "p95": percentile(values, 0.95),
+                                                      "p99": percentile(values, 0.99)}
+        return result
+
+    def print_summary(self):
+        summary = self.summary()
+        if not summary:
+            return
+        print("LATENCY SUMMARY (in seconds)")
+        print("%-50s %-10s %8s %10s %10s %10s" % ("endpoint", "phase", "count", "p50", "p95", "p99"))
+        for endpoint, phases in summary.items():
+            for phase in PHASES:
+                if phase not in phases:
+                    continue
+                stats = phases[phase]
+                print("%-50s %-10s %8d %10.4f %10.4f %10.4f" % (endpoint, phase, stats["count"], stats["p50"],
+                                                                stats["p95"], stats["p99"]))
+        print("------------------------------------------------------")
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+# Recorder used by callers that do not provide their own
+_default_recorder = None
+
+
+def set_default_recorder(recorder):
+    """
+    :param recorder: TimingRecorder used by default, or None to disable recording
+    """
+    global _default_recorder
+    _default_recorder = recorder
+
+
+def get_default_recorder():
+    """
+    :return: TimingRecorder used by default, None if recording is disabled
+    """
+    return _default_recorder
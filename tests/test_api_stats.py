@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+"""
+Sum of counts of each statistic against its reported total, for statistics with, without and
+with countless data
+"""
+import io
+import json
+import os
+import sys
+
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "src"))
+
+import jsonstream  # noqa: E402
+import main  # noqa: E402
+
+RESPONSE = {"Info": {"title": "stats", "version": "1"}, "Result": [
+    {"repertoires": {"repertoire_id": "1", "sample_processing_id": "s1", "data_processing_id": "d1"},
+     "statistics": [
+         # HAS_COUNT, sum equal to the total
+         {"statistic_name": "v_call", "total": 7, "data": [{"key": "a", "count": 3}, {"key": "b", "count": 4}]},
+         # HAS_COUNT, sum different from the total
+         {"statistic_name": "d_call", "total": 7, "data": [{"key": "a", "count": 3}, {"key": "b"}]},
+         # NO_DATA
+         {"statistic_name": "rearrangement_count", "total": 7},
+     ]},
+    {"statistics": [
+        # NO_COUNT, listed before the repertoire of its entry
+        {"statistic_name": "junction_length", "total": 5, "data": [{"key": "12"}, {"key": "15"}]},
+        # NO_DATA, data is not a list
+        {"statistic_name": "j_call", "total": 0, "data": None},
+        # NO_COUNT, an empty data list has no count either
+        {"statistic_name": "c_call", "total": 0, "data": []},
+    ], "repertoires": {"repertoire_id": "2"}},
+    {"repertoires": {"repertoire_id": "3"}, "statistics": []},
+]}
+
+EXPECTED = {
+    "statistic_name": ["v_call", "d_call", "rearrangement_count", "junction_length", "j_call", "c_call"],
+    "repertoire_id": ["1", "1", "1", "2", "2", "2"],
+    "sample_processing_id": ["s1", "s1", "s1", None, None, None],
+    "has_data": [main.HAS_COUNT, main.HAS_COUNT, main.NO_DATA, main.NO_COUNT, main.NO_DATA, main.NO_COUNT],
+    "SumOfCounts(StatsAPI)": [7, 3, 0, -1, 0, -1],
+    "ResultSum": [True, False, 0, -1, 0, -1],
+}
+
+
+def api_stats(flat=None):
+    return main.ApiStats(None, RESPONSE, None, flat=flat)
+
+
+@pytest.mark.parametrize("source", ["parsed", "stream"])
+def test_flatten(source):
+    if source == "parsed":
+        flat = main.flatten_stats_response(RESPONSE)
+    else:
+        fp = io.BytesIO(json.dumps(RESPONSE).encode("utf-8"))
+        flat = main.flatten_stats_items(jsonstream.iter_stats_stream(fp, chunk_size=5))
+    for column in ("statistic_name", "repertoire_id", "sample_processing_id"):
+        assert flat[column] == EXPECTED[column]
+    assert flat["has_data"].tolist() == EXPECTED["has_data"]
+    assert flat["sum_count"].tolist() == EXPECTED["SumOfCounts(StatsAPI)"]
+
+
+def test_flatten_without_data():
+    flat = main.flatten_stats_items(jsonstream.iter_stats_json(RESPONSE), keep_data=False)
+    assert flat["data"] == [None] * 6
+    assert flat["sum_count"].tolist() == EXPECTED["SumOfCounts(StatsAPI)"]
+
+
+@pytest.mark.parametrize("streamed", [False, True])
+def test_sum_count(streamed):
+    stats = api_stats(main.flatten_stats_items(jsonstream.iter_stats_json(RESPONSE), keep_data=False)
+                      if streamed else None)
+    total_count_df = stats.get_total_count()
+    assert total_count_df["statistic_name"].tolist() == EXPECTED["statistic_name"]
+    assert total_count_df["total"].tolist() == [7, 7, 7, 5, 0, 0]
+
+    sum_count_df = stats.get_sum_count(total_count_df)
+    assert sum_count_df["SumOfCounts(StatsAPI)"].tolist() == EXPECTED["SumOfCounts(StatsAPI)"]
+    result_sum = sum_count_df["ResultSum"].tolist()
+    assert result_sum == EXPECTED["ResultSum"]
+    # True and False are kept apart from the 0 and -1 flags
+    assert [type(value) for value in result_sum[:2]] == [bool, bool]
+    assert [type(value) for value in result_sum[2:]] == [int, int, int, int]
+
+
+def test_no_statistics():
+    stats = main.ApiStats(None, {"Result": [{"repertoires": {"repertoire_id": "1"}, "statistics": []}]}, None)
+    assert stats.get_total_count().empty
+
+
+def test_flags_agree_with_sum_count():
+    flat = main.flatten_stats_response(RESPONSE)
+    assert np.all(flat["sum_count"][flat["has_data"] == main.NO_DATA] == 0)
+    assert np.all(flat["sum_count"][flat["has_data"] == main.NO_COUNT] == -1)
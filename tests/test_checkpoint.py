@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+"""
+A checkpoint file must be resumable, including after a run killed while writing its last line
+"""
+import json
+import os
+import sys
+
+import pandas as pd
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "src"))
+
+import checkpoint  # noqa: E402
+
+SUM_COUNT = pd.DataFrame({"repertoire_id": ["1", "1"], "statistic_name": ["v_call", "rearrangement_count"],
+                          "total": [7, 7], "ResultSum": [True, 0]})
+RESULT = pd.DataFrame({"repertoire_id": ["1"], "statistic_name": ["v_call"], "Result": [True]})
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "run" / "checkpoint.jsonl")
+
+
+def read_lines(path):
+    with open(path, "rb") as f:
+        return f.read().split(b"\n")
+
+
+def test_resume(path):
+    run = checkpoint.Checkpoint(path)
+    run.save("1", SUM_COUNT, RESULT)
+    run.save(2, SUM_COUNT, None)
+    run.mark_failed("3", "timed out")
+    run.close()
+
+    resumed = checkpoint.Checkpoint(path)
+    assert resumed.done("1") and resumed.done(2) and resumed.done("2")
+    assert not resumed.done("3") and not resumed.done("4")
+    assert resumed.failed_ids() == ["3"]
+    sum_count_df, result_df = resumed.results("1")
+    pd.testing.assert_frame_equal(sum_count_df, SUM_COUNT)
+    pd.testing.assert_frame_equal(result_df, RESULT)
+    assert resumed.results("2")[1] is None
+    assert resumed.results("3") is None
+    resumed.close()
+
+
+def test_last_line_wins(path):
+    run = checkpoint.Checkpoint(path)
+    run.mark_failed("1", "timed out")
+    run.save("1", SUM_COUNT, RESULT)
+    run.save("2", SUM_COUNT, RESULT)
+    run.mark_failed("2", "HTTP Error 503")
+    run.close()
+
+    resumed = checkpoint.Checkpoint(path)
+    assert resumed.done("1")
+    assert not resumed.done("2")
+    assert resumed.failed_ids() == ["2"]
+    resumed.close()
+
+
+@pytest.mark.parametrize("cut", [1, 20, -2])
+def test_truncated_last_line(path, cut):
+    run = checkpoint.Checkpoint(path)
+    run.save("1", SUM_COUNT, RESULT)
+    run.save("2", SUM_COUNT, RESULT)
+    run.close()
+
+    # Kill the run in the middle of writing the line of repertoire 2
+    with open(path, "rb") as f:
+        content = f.read()
+    second_line = content.index(b"\n") + 1
+    with open(path, "wb") as f:
+        f.write(content[:second_line + cut] if cut > 0 else content[:cut])
+
+    resumed = checkpoint.Checkpoint(path)
+    assert resumed.done("1")
+    assert not resumed.done("2")
+    # Entries appended after the partial line are read back
+    resumed.save("2", SUM_COUNT, RESULT)
+    resumed.mark_failed("3", "timed out")
+    resumed.close()
+
+    lines = read_lines(path)
+    assert lines[-1] == b""
+    assert json.loads(lines[-2])["repertoire_id"] == "3"
+    assert json.loads(lines[-3])["repertoire_id"] == "2"
+
+    resumed = checkpoint.Checkpoint(path)
+    assert resumed.done("1") and resumed.done("2")
+    assert resumed.failed_ids() == ["3"]
+    pd.testing.assert_frame_equal(resumed.results("2")[0], SUM_COUNT)
+    resumed.close()
+
+
+def test_complete_last_line_not_padded(path):
+    run = checkpoint.Checkpoint(path)
+    run.save("1", SUM_COUNT, RESULT)
+    run.close()
+    checkpoint.Checkpoint(path).close()
+    assert read_lines(path)[1:] == [b""]
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+
+"""
+Incremental parsing of Stats API responses must yield the same items whatever the chunk size
+"""
+import io
+import json
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "src"))
+
+import jsonstream  # noqa: E402
+from jsonstream import EMPTY  # noqa: E402
+
+INFO = {"title": "stats", "version": "1"}
+GENE_USAGE = {"statistic_name": "v_call", "total": 7,
+              "data": [{"key": "IGHV1-2*01", "count": 3}, {"key": "IGHV3-23*01", "count": 4}]}
+COUNT = {"statistic_name": "rearrangement_count", "total": 7}
+
+RESPONSE = {"Info": INFO, "Result": [
+    {"repertoires": {"repertoire_id": "1"}, "statistics": [GENE_USAGE, COUNT]},
+    {"statistics": [COUNT], "repertoires": {"repertoire_id": "2"}},
+    {"repertoires": {"repertoire_id": "3"}, "statistics": []},
+    {},
+], "Messages": ["done"]}
+
+ITEMS = [
+    (None, "Info", INFO),
+    (None, "Result", None),
+    (0, "repertoires", {"repertoire_id": "1"}),
+    (0, "statistics", GENE_USAGE),
+    (0, "statistics", COUNT),
+    (1, "statistics", COUNT),
+    (1, "repertoires", {"repertoire_id": "2"}),
+    (2, "repertoires", {"repertoire_id": "3"}),
+    (2, EMPTY, "statistics"),
+    (3, EMPTY, None),
+    (None, "Messages", ["done"]),
+]
+
+
+def stream(text, chunk_size=65536, encoding="utf-8"):
+    return list(jsonstream.iter_stats_stream(io.BytesIO(text.encode(encoding)), encoding, chunk_size))
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 7, 64, 65536])
+def test_chunk_boundaries(chunk_size):
+    assert stream(json.dumps(RESPONSE), chunk_size) == ITEMS
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7])
+def test_whitespace_between_tokens(chunk_size):
+    assert stream(json.dumps(RESPONSE, indent=4), chunk_size) == ITEMS
+
+
+def test_parsed_response_items():
+    assert list(jsonstream.iter_stats_json(RESPONSE)) == ITEMS
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 65536])
+def test_escaped_strings(chunk_size):
+    # Quotes, backslashes and brackets inside strings must not end or open a value
+    statistic = {"statistic_name": "v_call", "total": 1,
+                 "data": [{"key": 'a\\"b]}{[\\\\', "count": 1}, {"key": "é☃", "count": 0}]}
+    response = {"Result": [{"repertoires": {"repertoire_id": 'x"\\'}, "statistics": [statistic]}]}
+    assert stream(json.dumps(response), chunk_size) == list(jsonstream.iter_stats_json(response))
+    # Multi-byte characters split across chunks
+    assert stream(json.dumps(response, ensure_ascii=False), chunk_size) == list(jsonstream.iter_stats_json(response))
+
+
+@pytest.mark.parametrize("chunk_size", [1, 65536])
+def test_scalars(chunk_size):
+    response = {"Result": [{"statistics": [{"statistic_name": "x", "total": 12.5, "data": None}],
+                            "flag": True, "other": False, "missing": None, "count": -3}]}
+    assert stream(json.dumps(response), chunk_size) == list(jsonstream.iter_stats_json(response))
+
+
+def test_empty_result():
+    assert stream('{"Info": {}, "Result": []}') == [(None, "Info", {}), (None, "Result", None)]
+
+
+def test_missing_result():
+    assert stream('{"Info": {}}') == [(None, "Info", {})]
+    with pytest.raises(KeyError):
+        list(jsonstream.iter_stats_json({"Info": {}}))
+
+
+@pytest.mark.parametrize("length", [0, 1, 10, 30, 60, 100, -1])
+def test_truncated_input(length):
+    # A body cut anywhere, e.g. a dropped connection, is an error rather than a shorter response
+    text = json.dumps(RESPONSE)
+    assert length < len(text)
+    with pytest.raises(ValueError):
+        stream(text[:length], chunk_size=7)
+
+
+@pytest.mark.parametrize("text", ['[]', '{"Result": {}}', '{"Result": [[]]}', '{"Result": [{"statistics": {}}]}',
+                                  '{"Result": [{} {}]}'])
+def test_not_a_stats_response(text):
+    with pytest.raises(ValueError):
+        stream(text)
+
+
+def test_consumed_lazily():
+    # Items are yielded before the rest of the body is read
+    fp = io.BytesIO(json.dumps(RESPONSE).encode("utf-8"))
+    items = jsonstream.iter_stats_stream(fp, chunk_size=16)
+    assert next(items) == (None, "Info", INFO)
+    assert fp.tell() < len(fp.getvalue())
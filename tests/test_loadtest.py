@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+"""
+Latency histogram buckets must cover every value once and report it within the precision asked for
+"""
+import os
+import random
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "src"))
+
+import loadtest  # noqa: E402
+
+
+def sample_values(histogram):
+    # Every value around the exact range, then a spread up to about an hour in microseconds
+    values = list(range(4 * histogram._sub_count))
+    for shift in range(histogram._sub_bits, 32):
+        for offset in (-1, 0, 1):
+            values.append((1 << shift) + offset)
+    rng = random.Random(0)
+    values.extend(rng.randrange(1 << 32) for _ in range(10000))
+    return values
+
+
+@pytest.mark.parametrize("digits", [1, 2, 3])
+def test_bucket_bounds(digits):
+    histogram = loadtest.LatencyHistogram(digits)
+    for value in sample_values(histogram):
+        index = histogram._index(value)
+        highest = histogram._highest(index)
+        # The bucket holds the value, and the highest value of the bucket is close to it
+        assert value <= highest
+        assert highest - value <= max(value, 1) * 10 ** -digits
+        if value < 2 * 10 ** digits:
+            assert highest == value
+
+
+@pytest.mark.parametrize("digits", [1, 2, 3])
+def test_buckets_contiguous(digits):
+    # Each bucket starts right after the previous one ends
+    histogram = loadtest.LatencyHistogram(digits)
+    for index in range(20 * histogram._sub_count):
+        assert histogram._index(histogram._highest(index)) == index
+        assert histogram._index(histogram._highest(index) + 1) == index + 1
+
+
+def test_percentiles():
+    histogram = loadtest.LatencyHistogram(2)
+    # 1 ms to 10 s
+    latencies = [i / 1000 for i in range(1, 10001)]
+    random.Random(0).shuffle(latencies)
+    for latency in latencies:
+        histogram.record(latency)
+
+    assert histogram.count == 10000
+    assert histogram.min == 0.001
+    assert histogram.max == 10.0
+    assert histogram.summary()["mean"] == pytest.approx(5.0005)
+    for fraction, expected in ((0.5, 5.0), (0.9, 9.0), (0.99, 9.9), (0.999, 9.99)):
+        assert histogram.percentile(fraction) == pytest.approx(expected, rel=1e-2)
+        assert histogram.percentile(fraction) >= expected
+    assert histogram.percentile(0) == pytest.approx(0.001, rel=1e-2)
+    # Never above the largest latency recorded, even if its bucket goes further
+    assert histogram.percentile(1) == 10.0
+
+
+def test_empty():
+    histogram = loadtest.LatencyHistogram()
+    assert histogram.percentile(0.5) is None
+    summary = histogram.summary()
+    assert summary["count"] == 0
+    assert summary["mean"] is None and summary["p50"] is None
+    assert histogram.to_dict()["buckets"] == []
+
+
+def test_negative_and_zero_latencies():
+    histogram = loadtest.LatencyHistogram()
+    histogram.record(-0.5)
+    histogram.record(0.0)
+    assert histogram.to_dict()["buckets"] == [[0.0, 2]]
+
+
+def test_merge():
+    rng = random.Random(1)
+    latencies = [rng.expovariate(10) for _ in range(2000)]
+    whole = loadtest.LatencyHistogram()
+    parts = [loadtest.LatencyHistogram() for _ in range(3)]
+    for i, latency in enumerate(latencies):
+        whole.record(latency)
+        parts[i % 3].record(latency)
+
+    merged = loadtest.LatencyHistogram()
+    for part in parts:
+        merged.merge(part)
+    merged.merge(loadtest.LatencyHistogram())
+
+    assert merged.count == whole.count
+    assert merged.min == whole.min and merged.max == whole.max
+    assert merged.total == pytest.approx(whole.total)
+    assert merged.to_dict()["buckets"] == whole.to_dict()["buckets"]
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+"""
+Repertoires must be enumerated one page at a time, each page requested only once the previous one
+is consumed
+"""
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "src"))
+
+import main  # noqa: E402
+import stats_server  # noqa: E402
+
+URL = "http://node/airr/v1/repertoire"
+
+
+class FakeRepository:
+
+    def __init__(self, n_repertoires, fail_from=None):
+        self.rep_ids = [str(i) for i in range(n_repertoires)]
+        self.fail_from = fail_from
+        self.queries = []
+
+    def execute_query(self, query_url, query_dict):
+        assert query_url == URL
+        self.queries.append(dict(query_dict))
+        if self.fail_from is not None and query_dict["from"] >= self.fail_from:
+            return None
+        page = self.rep_ids[query_dict["from"]:query_dict["from"] + query_dict["size"]]
+        return {"Info": {}, "Repertoire": [{"repertoire_id": repertoire_id} for repertoire_id in page]}
+
+
+@pytest.fixture
+def repository(monkeypatch, request):
+    fake = FakeRepository(*request.param)
+    monkeypatch.setattr(main, "execute_query", fake.execute_query)
+    return fake
+
+
+@pytest.mark.parametrize("repository, pages", [((0,), [0]), ((5,), [0]), ((10,), [0, 10]), ((25,), [0, 10, 20]),
+                                               ((30,), [0, 10, 20, 30])],
+                         indirect=["repository"])
+def test_pages(repository, pages):
+    assert list(main.iter_repertoire_ids(URL, {}, page_size=10)) == repository.rep_ids
+    assert [query["from"] for query in repository.queries] == pages
+
+
+@pytest.mark.parametrize("repository", [(25,)], indirect=True)
+def test_query_kept(repository):
+    filters = {"op": "=", "content": {"field": "study.study_id", "value": "PRJNA1"}}
+    base_query = {"filters": filters, "fields": ["subject"], "size": 1, "from": 7}
+    list(main.iter_repertoire_ids(URL, base_query, page_size=10))
+    for query in repository.queries:
+        assert query["filters"] == filters
+        assert query["fields"] == ["repertoire_id"]
+        assert query["size"] == 10
+    # The query given is not modified
+    assert base_query == {"filters": filters, "fields": ["subject"], "size": 1, "from": 7}
+
+
+@pytest.mark.parametrize("repository", [(25,)], indirect=True)
+def test_lazy(repository):
+    rep_ids = main.iter_repertoire_ids(URL, {}, page_size=10)
+    assert repository.queries == []
+    for _ in range(10):
+        next(rep_ids)
+    assert len(repository.queries) == 1
+    next(rep_ids)
+    assert len(repository.queries) == 2
+
+
+@pytest.mark.parametrize("repository", [(25, 10)], indirect=True)
+def test_failed_page(repository):
+    rep_ids = main.iter_repertoire_ids(URL, {}, page_size=10)
+    assert [next(rep_ids) for _ in range(10)] == repository.rep_ids[:10]
+    with pytest.raises(RuntimeError):
+        next(rep_ids)
+
+
+def test_synthetic_node():
+    repository = stats_server.SyntheticRepository(n_repertoires=23, min_rearrangements=10, max_rearrangements=20)
+    server = stats_server.serve_in_thread(repository)
+    try:
+        url = "http://%s:%d/airr/v1/repertoire" % server.server_address
+        rep_ids = list(main.iter_repertoire_ids(url, {}, page_size=5))
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert rep_ids == repository.repertoire_ids
+    assert server.request_counts["/airr/v1/repertoire"] == 5
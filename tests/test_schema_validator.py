@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+"""
+Stats API responses validated as a stream must have the same violations as when parsed whole
+"""
+import io
+import json
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "src"))
+
+import jsonstream  # noqa: E402
+import schema_validator  # noqa: E402
+
+SCHEMA = os.path.join(ROOT, "sample-files", "YAML-Files", "stats-api.yaml")
+INFO = {"title": "stats", "version": "1"}
+
+RESPONSES = {
+    "empty statistics": {"Info": INFO, "Result": [{"repertoires": {"repertoire_id": "1"}, "statistics": []}]},
+    "empty entry": {"Info": INFO, "Result": [{}]},
+    "missing statistics": {"Info": INFO, "Result": [{"repertoires": {"repertoire_id": "1"}}]},
+    "invalid statistic": {"Info": INFO, "Result": [
+        {"repertoires": {"repertoire_id": "1"},
+         "statistics": [{"statistic_name": "rearrangement_count", "total": "12"}]},
+        {"statistics": []}]},
+    "missing Info": {"Result": [{"repertoires": {"repertoire_id": "1"}, "statistics": []}]},
+    "invalid Info": {"Info": {"title": 1}, "Result": []},
+    "missing Result": {"Info": INFO},
+}
+
+
+@pytest.fixture(scope="module")
+def validator():
+    return schema_validator.StatsResponseValidator(schema_validator.load_schema(SCHEMA), "rearrangement/count")
+
+
+def sort_key(violation):
+    return violation["path"], violation["message"]
+
+
+@pytest.mark.parametrize("name", sorted(RESPONSES))
+def test_stream_matches_parsed(validator, name):
+    response = RESPONSES[name]
+    parsed = validator.check_response(response, "url")
+    validator.violations()
+
+    items = jsonstream.iter_stats_stream(io.BytesIO(json.dumps(response).encode("utf-8")), chunk_size=7)
+    for _ in validator.check_items(items, "url"):
+        pass
+    streamed = validator.violations()
+
+    assert sorted(streamed, key=sort_key) == sorted(parsed, key=sort_key)
+
+
+@pytest.mark.parametrize("name", sorted(name for name in RESPONSES if "Result" in RESPONSES[name]))
+def test_stream_items_match_parsed_items(name):
+    response = RESPONSES[name]
+    streamed = list(jsonstream.iter_stats_stream(io.BytesIO(json.dumps(response).encode("utf-8"))))
+    assert streamed == list(jsonstream.iter_stats_json(response))